@@ -1,139 +1,670 @@
-from flask import Flask, render_template, request, session
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, abort, jsonify, render_template, request, session
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
+import atexit
+import collections
 import datetime
+import signal
 import sqlite3
+import time
 
-app = Flask(__name__)
+import eventlet
+from eventlet import event, greenio, patcher, tpool
+
+import config
+
+if config.BACKPLANE == 'redis':
+    # Redis 消息队列的订阅任务需要非阻塞的 socket；写入线程仍使用真实线程
+    eventlet.monkey_patch(thread=False)
+
+import history
+import message_ids
+import offline_delivery
+import private_history
+from backplane import create_backplane
+from assets import AssetManifest, page_shell
+import broadcast
+from instrumentation import CONTENT_TYPE, LAG_SAMPLE_INTERVAL, ChatMetrics, local_recipients, payload_size
+from message_store import create_message_store
+import migrations
+from presence import PresenceDeltas, user_room
+from rate_limit import RateLimiter
+from recent_history import RecentHistory
+from repository import Repository
+from snapshot import create_snapshot
+import retention
+import rooms
+import search
+from serializers import COLUMNAR, encode_batch, json_module, socketio_serializer, wants_columnar
+from typing_state import TypingAggregator
+
+metrics = ChatMetrics()
+# 发送队列积压过多时丢弃输入状态、断开跟不上的连接
+backpressure = broadcast.Backpressure()
+
+
+class CommitWaiter:
+    """在 greenlet 中等待写入线程完成的 Future，不占用 tpool 的线程
+
+    eventlet 的 hub 不是线程安全的，写入线程不能直接 send 事件：完成回调把事件放进队列，
+    再往 socketpair 写一个字节唤醒 hub 上的分发 greenlet，由它 send。在途消息再多，
+    也只有这一个 greenlet 和一对 socket，不会受 tpool 线程数（默认 20）限制。
+    """
+
+    def __init__(self):
+        reader, self._writer = patcher.original('socket').socketpair()
+        reader.setblocking(False)
+        self._writer.setblocking(False)
+        self._reader = greenio.GreenSocket(reader)
+        # deque 的 append/popleft 是线程安全的
+        self._done = collections.deque()
+        self._dispatcher = None
+
+    def wait(self, future):
+        if future.done():
+            return future.result()
+        if self._dispatcher is None:
+            self._dispatcher = eventlet.spawn(self._dispatch)
+        done = event.Event()
+        future.add_done_callback(lambda _: self._notify(done))
+        done.wait()
+        return future.result()
+
+    def _notify(self, done):
+        # 在写入线程中执行
+        self._done.append(done)
+        try:
+            self._writer.send(b'\0')
+        except BlockingIOError:
+            # 缓冲区已满：分发 greenlet 还有没读的唤醒，会一并处理队列
+            pass
+
+    def _dispatch(self):
+        while True:
+            self._reader.recv(4096)
+            while self._done:
+                self._done.popleft().send()
+
+
+class InstrumentedSocketIO(SocketIO):
+    """为每个事件处理函数和每次 emit 记录指标"""
+
+    # 创建后由 broadcast.fast_path_supported 决定是否走只编码一次的发送路径
+    encode_once = False
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+
+        def decorator(handler):
+            register(metrics.instrument(message, handler))
+            return handler
+        return decorator
+
+    def emit(self, event, *args, **kwargs):
+        namespace = kwargs.get('namespace', '/')
+        to = kwargs.get('to') or kwargs.get('room')
+        data = args[0] if args else None
+        encoded = None
+        # 进程内广播：只编码一次，所有接收者复用同一个 Engine.IO 包
+        if (self.encode_once and not kwargs.get('callback')
+                and not isinstance(self.server.manager, PubSubManager)):
+            encoded = broadcast.encode_event(self.server.packet_class, event, data, namespace)
+        if encoded is None:
+            metrics.observe_emit(event, payload_size(data),
+                                 local_recipients(self.server.manager, namespace, to))
+            return super().emit(event, *args, **kwargs)
+        skip_sid = kwargs.get('skip_sid')
+        if not kwargs.get('include_self', True) and not skip_sid:
+            skip_sid = request.sid
+        eio_pkt, size = encoded
+        targets = broadcast.recipients(self.server.manager, namespace, to, skip_sid)
+        deliver, dropped, slow = backpressure.split(self.server.eio, targets, event)
+        metrics.observe_emit(event, size, len(deliver))
+        metrics.observe_backpressure(event, dropped, len(slow))
+        for eio_sid in deliver:
+            self.server._send_eio_packet(eio_sid, eio_pkt)
+        for eio_sid in slow:
+            self.start_background_task(backpressure.abort, self.server.eio, eio_sid)
+
+
+# 静态资源由 static_file 按指纹和预压缩版本提供，不用 Flask 自带的静态路由
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins='*')
-users = {}
-# 私聊会话状态表：记录当前正在进行的私聊会话
-# 格式：{username: other_username} 表示username正在和other_username私聊
-private_chat_sessions = {}
-
-def init_db():
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS private_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_username TEXT NOT NULL,
-                receiver_username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                is_read INTEGER DEFAULT 0
-            )
-        ''')
-        conn.commit()
+asset_manifest = AssetManifest()
+# 渲染好的页面外壳，第一次请求时生成
+index_page = None
+# 在线用户、私聊会话状态表都放在 backplane 中，多进程部署时各进程共享
+backplane = create_backplane()
+socketio = InstrumentedSocketIO(app, async_mode='eventlet', cors_allowed_origins='*',
+                                message_queue=backplane.message_queue_url, json=json_module(),
+                                serializer=socketio_serializer())
+# 只编码一次和背压依赖库的内部接口，库版本未经验证时退回公开的 emit
+socketio.encode_once = broadcast.fast_path_supported(socketio.server)
+# 在线列表的增量广播：新连接拿全量快照，之后只收合并后的增量
+presence_deltas = PresenceDeltas(backplane)
+# “正在输入”状态按聊天室周期汇总广播
+typing_aggregator = TypingAggregator()
+repository = Repository()
+atexit.register(repository.close)
+# 向前翻页、搜索翻页在只读快照上查询，不和主库争用
+snapshot = create_snapshot(metrics=repository.metrics)
+if snapshot is not None:
+    atexit.register(snapshot.close)
+message_store = create_message_store(metrics=repository.metrics)
+atexit.register(message_store.close)
+commit_waiter = CommitWaiter()
+atexit.register(backplane.close)
+# 最近消息的内存缓存；多进程部署时其他进程的写入不经过本进程，只在单进程时启用
+recent_history = RecentHistory(enabled=backplane.message_queue_url is None)
+# 每个连接的聊天、私信、输入状态事件按令牌桶限流
+rate_limiter = RateLimiter()
+# 连接时声明接受列式批量负载的连接
+columnar_sids = set()
+# 最近发送的 client_id，重试的消息按第一次的结果应答
+recent_sends = message_ids.RecentSends()
+# 私信的 client_id 与聊天室消息分开去重，与两张表各自的唯一索引一致
+recent_private_sends = message_ids.RecentSends()
+# 优雅关闭时保存的会话，重启后凭 token 恢复；draining 为真时正在关闭
+resume_store = backplane.resume_store()
+draining = False
+metrics.track_queries(repository.metrics)
+metrics.gauge('chat_connected_sockets', 'Socket.IO connections on this process.',
+              lambda: local_recipients(socketio.server.manager, '/', None))
+metrics.gauge('chat_private_sessions', 'Active private chat sessions.',
+              backplane.private_session_count)
+if snapshot is not None:
+    metrics.gauge('chat_read_snapshot_age_seconds', 'Seconds since the read snapshot was refreshed.',
+                  snapshot.age)
 
 @app.route('/')
 def index():
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT username, message, timestamp FROM messages ORDER BY timestamp ASC')
-        messages = cursor.fetchall()
-    return render_template('index.html', messages=messages)
+    # 页面外壳与聊天室无关，只渲染一次；聊天室和消息由页面加载后请求 /history
+    global index_page
+    if index_page is None:
+        index_page = page_shell(render_template('index.html', asset_url=asset_manifest.url,
+                                          default_room=rooms.DEFAULT_ROOM, wire_format=config.WIRE_FORMAT))
+    return static_response(index_page.respond(request.headers.get('If-None-Match'),
+                                              request.headers.get('Accept-Encoding')))
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    """带指纹的文件长期缓存，按 Accept-Encoding 返回预压缩的版本"""
+    result = asset_manifest.respond(filename, request.headers.get('If-None-Match'),
+                                    request.headers.get('Accept-Encoding'))
+    if result is None:
+        abort(404)
+    return static_response(result)
+
+def static_response(result):
+    status, body, headers = result
+    return Response(body, status=status, headers=headers)
+
+@app.route('/history')
+def load_history():
+    """按 id 游标向前翻页加载某个聊天室的历史消息"""
+    room = rooms.normalize_room(request.args.get('room'))
+    if room is None:
+        return jsonify({'error': 'invalid room'}), 400
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', type=int)
+    page = load_history_page(room, before, limit)
+    return jsonify(encode_batch(page, 'messages', request.args.get('encoding') == COLUMNAR))
+
+def load_history_page(room, before=None, limit=None):
+    """优先从内存缓存取一页历史，覆盖不到时才查询数据库"""
+    page = recent_history.page(room, before, limit)
+    if page is None and recent_history.enabled and not recent_history.is_loaded(room):
+        recent_history.load(room, *run_query('history_recent', history.fetch_latest, room,
+                                             recent_history.capacity))
+        page = recent_history.page(room, before, limit)
+    if page is None:
+        page = run_history_query('history_page', 'messages', before, history.fetch_page, room, before, limit)
+    return page
+
+@app.route('/search')
+def search_messages():
+    """在某个聊天室的公共消息中全文搜索，按 id 游标向前翻页"""
+    room = rooms.normalize_room(request.args.get('room'))
+    if room is None:
+        return jsonify({'error': 'invalid room'}), 400
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', type=int)
+    try:
+        return jsonify(run_history_query('search_messages', 'messages', before, search.search_messages,
+                                         room, request.args.get('q'), before, limit))
+    except search.SearchQueryError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+@app.route('/stats/db')
+def db_stats():
+    """各查询的调用次数与耗时分布（毫秒）"""
+    return jsonify(repository.metrics.snapshot())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
 
 @socketio.on('connect')
-def test_connect():
+def test_connect(auth=None):
+    if draining:
+        return False
+    if wants_columnar(auth):
+        columnar_sids.add(request.sid)
+    start_background_tasks()
     emit('my response', {'data': 'Connected'})
+    emit('presence_snapshot', presence_deltas.snapshot())
+
+@socketio.on('presence_sync')
+def handle_presence_sync(data=None):
+    """客户端发现增量版本号不连续时请求全量快照"""
+    emit('presence_snapshot', presence_deltas.snapshot())
 
 @socketio.on('disconnect')
 def test_disconnect():
-    if request.sid in users:
-        username = users[request.sid].get('username')
-        
-        # 清理用户的私聊会话状态
-        if username and is_user_in_private_chat(username):
-            other_username = private_chat_sessions.get(username)
-            remove_private_chat_session(username)
-            
-            # 通知对方用户已断线
-            if other_username:
-                other_sid = get_sid_by_username(other_username)
-                if other_sid:
-                    emit('private_chat_ended_by_disconnect', {
-                        'username': username,
-                        'message': f'{username} 已断线，私聊会话结束'
-                    }, to=other_sid)
-        
-        del users[request.sid]
-    
-    user_list = [user['username'] for user in users.values()]
-    emit('user list', {'users': user_list}, broadcast=True)
+    rate_limiter.forget(request.sid)
+    columnar_sids.discard(request.sid)
+    released = backplane.release(request.sid)
+    # 排空期间断开的连接会在重启后恢复，不算下线
+    if draining:
+        return
+    # 同一用户还有其他标签页在线时，不算下线
+    if released and released.last_session:
+        user_went_offline(released.username)
     print('Client disconnected')
 
+def user_went_offline(username):
+    """用户的最后一个连接已断开：结束私聊并通知对方，从在线列表中移除"""
+    # 清理用户的私聊会话状态
+    if is_user_in_private_chat(username):
+        other_username = remove_private_chat_session(username)
+
+        # 通知对方用户已断线
+        if other_username and backplane.is_online(other_username):
+            socketio.emit('private_chat_ended_by_disconnect', {
+                'username': username,
+                'message': f'{username} 已断线，私聊会话结束'
+            }, to=user_room(other_username))
+
+    presence_deltas.user_removed(username)
+    typing_aggregator.remove_user(username)
+
 @socketio.on('user joined')
 def handle_user_joined(data):
     username = data['username']
-    if any(user.get('username') == username for user in users.values()):
+    room = rooms.normalize_room(data.get('room')) or rooms.DEFAULT_ROOM
+    join_user(username, data.get('token'), room)
+
+@socketio.on('resume')
+def handle_resume(data):
+    """断线或服务重启后恢复会话，并在同一次往返中补发 last_id 之后的消息"""
+    data = data or {}
+    username = data.get('username')
+    room = rooms.normalize_room(data.get('room')) or rooms.DEFAULT_ROOM
+    try:
+        last_id = int(data.get('last_id') or 0)
+    except (TypeError, ValueError):
+        return
+    if not username:
+        return
+    saved = resume_store.take(username, data.get('token'))
+    if not join_user(username, data.get('token'), room, resumed=True, restored=saved is not None):
+        return
+    if saved is not None and saved.get('partner'):
+        # 双方都回来后才重建私聊
+        if backplane.is_online(saved['partner']):
+            add_private_chat_session(username, saved['partner'])
+    emit('missed_messages', batch({'room': room, **catch_up_chunk(room, last_id)}, 'messages'))
+
+def join_user(username, token, room, resumed=False, restored=False):
+    """让当前连接认领用户名并加入聊天室，失败返回 False
+
+    resumed：通过 resume 事件加入，补齐的消息由服务端直接发送；
+    restored：重启前保存的同一会话，不再广播加入、不重新投递离线私信
+    """
+    claim = backplane.claim(username, request.sid, token)
+    if claim is None:
         emit('username taken', {'username': username})
-    else:
-        users[request.sid] = {'username': username}
-        emit('join successful', {'username': username})
-        user_list = [user['username'] for user in users.values()]
-        emit('user list', {'users': user_list}, broadcast=True)
-        emit('user joined', data, broadcast=True, include_self=False)
-
-        with sqlite3.connect('chat.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT sender_username, message, timestamp FROM private_messages WHERE receiver_username = ? AND is_read = 0', (username,))
-            unread_messages = cursor.fetchall()
-            for msg in unread_messages:
-                emit('missed_private_message', {
-                    'sender_username': msg[0],
-                    'message': msg[1],
-                    'timestamp': msg[2]
-                })
-
-            cursor.execute('UPDATE private_messages SET is_read = 1 WHERE receiver_username = ?', (username,))
-            conn.commit()
+        return False
+    join_room(user_room(username))
+    join_room(rooms.room_channel(room))
+    emit('join successful', {'username': username, 'token': claim.token, 'room': room, 'resumed': resumed})
+    # 同一用户新开的标签页不需要再广播上线和投递离线消息
+    if claim.first_session:
+        # 上线只记入增量，不再单独广播 user joined：客户端按增量中新出现的用户显示加入提示，
+        # 重连风暴时也只是每个合并窗口一个包
+        presence_deltas.user_added(username)
+        if not restored:
+            # 离线私信分块投递，客户端确认一块后再发下一块
+            send_missed_private_messages(username)
+    return True
+
+@socketio.on('join room')
+def handle_join_room(data):
+    """加入聊天室，之后才能收到该聊天室的消息和输入状态"""
+    if not backplane.username_of(request.sid):
+        return
+    room = rooms.normalize_room((data or {}).get('room'))
+    if room is None:
+        emit('room error', {'message': '聊天室名称只能包含字母、数字、下划线和连字符，最长 32 个字符'})
+        return
+    join_room(rooms.room_channel(room))
+    emit('room joined', {'room': room})
+
+@socketio.on('leave room')
+def handle_leave_room(data):
+    username = backplane.username_of(request.sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if not username or room is None:
+        return
+    leave_room(rooms.room_channel(room))
+    typing_aggregator.stop(room, username)
+    emit('room left', {'room': room})
+
+def in_room(room):
+    """当前连接是否已加入聊天室"""
+    return rooms.room_channel(room) in socketio.server.rooms(request.sid)
+
+def batch(payload, key):
+    """按当前连接协商的编码返回批量负载"""
+    return encode_batch(payload, key, request.sid in columnar_sids)
+
+def rate_limit_key(username):
+    """加入后按用户名限流，重连和多开标签页共用同一组令牌桶"""
+    return ('user', username) if username else request.sid
+
+def within_rate_limit(event):
+    """当前用户的 event 是否还在限流预算内；超出时通知客户端，每次耗尽只通知一次"""
+    key = rate_limit_key(backplane.username_of(request.sid))
+    allowed, retry_after, notify = rate_limiter.check(key, event)
+    if not allowed:
+        metrics.observe_rate_limited(event)
+        if notify:
+            emit('rate_limited', {'event': event, 'retry_after': round(retry_after, 3)})
+    return allowed
+
+@socketio.on('catch up')
+def handle_catch_up(data):
+    """重连后补齐 after_id 之后错过的消息，每次一页，客户端按 has_more 继续请求"""
+    room = rooms.normalize_room((data or {}).get('room'))
+    try:
+        after_id = int((data or {}).get('after_id') or 0)
+    except (TypeError, ValueError):
+        return
+    if room is None or not in_room(room):
+        return
+    emit('missed_messages', batch({'room': room, **catch_up_chunk(room, after_id)}, 'messages'))
+
+def catch_up_chunk(room, after_id):
+    """after_id 之后的一页消息，优先从内存缓存取"""
+    chunk = recent_history.since(room, after_id)
+    if chunk is None:
+        chunk = run_query('history_after', history.fetch_after, room, after_id)
+    return chunk
+
+@socketio.on('search')
+def handle_search(data):
+    """全文搜索：scope 为 'room' 时搜聊天室公共消息，为 'private' 时搜自己的私信"""
+    if not within_rate_limit('search'):
+        return
+    data = data or {}
+    username = backplane.username_of(request.sid)
+    scope = data.get('scope', 'room')
+    query = data.get('q')
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return
+    try:
+        if scope == 'private' and username:
+            page = run_history_query('search_private_messages', 'private_messages', before,
+                                     search.search_private_messages, username, query, data.get('with'),
+                                     before, data.get('limit'))
+        elif scope == 'room':
+            room = rooms.normalize_room(data.get('room'))
+            if room is None:
+                return
+            page = run_history_query('search_messages', 'messages', before, search.search_messages,
+                                     room, query, before, data.get('limit'))
+        else:
+            return
+    except search.SearchQueryError as exc:
+        emit('search error', {'q': query, 'message': str(exc)})
+        return
+    emit('search results', batch({'scope': scope, 'q': query, 'before': before, **page}, 'results'))
+
+@socketio.on('missed_private_messages_ack')
+def handle_missed_private_messages_ack(data):
+    """客户端确认收到一块离线私信：只把确认过的标为已读，然后发下一块"""
+    username = backplane.username_of(request.sid)
+    ids = offline_delivery.parse_ack(data)
+    if not username or not ids:
+        return
+    offline_delivery.mark_read(message_store, username, ids)
+    send_missed_private_messages(username, after_id=max(ids))
+
+@socketio.on('private_message_ack')
+def handle_private_message_ack(data):
+    """接收者确认收到实时投递的私信，这时才标为已读"""
+    username = backplane.username_of(request.sid)
+    ids = offline_delivery.parse_ack(data)
+    if username and ids:
+        offline_delivery.mark_read(message_store, username, ids)
+
+def send_missed_private_messages(username, after_id=0):
+    chunk = run_query('unread_chunk', offline_delivery.fetch_unread, username, after_id)
+    if chunk['messages']:
+        emit('missed_private_messages', batch(chunk, 'messages'))
 
 @socketio.on('chat message')
-def handle_message(data):
-    data['timestamp'] = datetime.datetime.now().strftime('%H:%M')
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO messages (username, message, timestamp) VALUES (?, ?, ?)',
-                       (data['username'], data['message'], data['timestamp']))
-        conn.commit()
-    emit('chat message', data, broadcast=True)
-
-def get_sid_by_username(username):
-    for sid, user_data in users.items():
-        if user_data.get('username') == username:
-            return sid
+def handle_message(data=None):
+    """返回值作为发送方的应答：{client_id, id, seq}，被拒绝时为 {client_id, error}"""
+    if not isinstance(data, dict):
+        return {'client_id': None, 'error': 'invalid'}
+    client_id = message_ids.normalize_client_id(data.get('client_id'))
+    if not within_rate_limit('chat message'):
+        return {'client_id': client_id, 'error': 'rate_limited'}
+    if not is_text(data.get('message')):
+        return {'client_id': client_id, 'error': 'invalid'}
+    room = rooms.normalize_room(data.get('room'))
+    # 只能向已加入的聊天室发消息，消息只发给该聊天室内的连接
+    if room is None or not in_room(room):
+        return {'client_id': client_id, 'error': 'not_in_room'}
+    # 发送者以连接登记的用户名为准，不信任客户端提供的 username：
+    # 去重键和入库的用户名都用它，否则可以冒用别人的名字或占用别人的 client_id
+    username = backplane.username_of(request.sid)
+    if not username:
+        return {'client_id': client_id, 'error': 'not_joined'}
+    data['username'] = username
+    if client_id is not None:
+        sent = recent_sends.get(username, client_id)
+        if sent is not None:
+            # 重试：按第一次的结果应答，不再写入和广播
+            return delivery_ack(client_id, wait_for_store(sent))
+    now = datetime.datetime.now()
+    data['room'] = room
+    data['timestamp'] = now.strftime('%H:%M')
+    data['created_at'] = int(now.timestamp() * 1000)
+    future = message_store.save_message(
+        username, data['message'], data['timestamp'], data['created_at'], room, client_id)
+    if client_id is not None:
+        recent_sends.put(username, client_id, future)
+    recent_history.track(future, data)
+    stored = wait_for_store(future)
+    if stored is not None:
+        if stored.duplicate:
+            return delivery_ack(client_id, stored)
+        data['id'] = stored.id
+        data['seq'] = stored.seq
+    emit('chat message', data, to=rooms.room_channel(room))
+    return delivery_ack(client_id, stored)
+
+def is_text(value):
+    """消息正文、接收者等字段必须是非空字符串"""
+    return isinstance(value, str) and bool(value)
+
+def delivery_ack(client_id, stored):
+    """发送方的应答：落盘后带上 id 和会话内序号；enqueue 模式下只确认已接收"""
+    if stored is None:
+        return {'client_id': client_id, 'queued': True}
+    return {'client_id': client_id, 'id': stored.id, 'seq': stored.seq}
+
+_background_tasks_started = False
+
+def start_background_tasks():
+    """启动后台任务，只启动一次
+
+    直接运行本文件时在 socketio.run 之前启动（与 FastAPI 版的 lifespan 一致），
+    心跳、归档、快照刷新和会话过期不依赖有客户端连接；由其他方式托管 app 时，
+    退回到第一次有客户端连接时启动。
+    """
+    global _background_tasks_started
+    if _background_tasks_started:
+        return
+    _background_tasks_started = True
+    socketio.start_background_task(flush_presence_deltas)
+    socketio.start_background_task(flush_typing_state)
+    socketio.start_background_task(monitor_event_loop_lag)
+    if snapshot is not None:
+        socketio.start_background_task(refresh_snapshot)
+    socketio.start_background_task(expire_resumable_sessions)
+    socketio.start_background_task(backplane_heartbeat)
+    if config.RETENTION_DAYS > 0:
+        socketio.start_background_task(run_retention)
+
+def flush_presence_deltas():
+    """每个合并窗口广播一次在线列表增量"""
+    while True:
+        socketio.sleep(config.PRESENCE_BATCH_INTERVAL_MS / 1000)
+        delta = presence_deltas.drain()
+        if delta:
+            socketio.emit('presence_delta', delta)
+
+def flush_typing_state():
+    """每个周期最多发一次输入状态汇总，且只在输入者集合变化时发送"""
+    while True:
+        socketio.sleep(config.TYPING_INTERVAL_MS / 1000)
+        for room, typing_users in typing_aggregator.collect():
+            # 多进程部署时每个进程只汇总自己的连接，客户端按 node 合并
+            socketio.emit('typing_state', {'room': room, 'users': typing_users,
+                                           'node': backplane.node_id}, to=rooms.room_channel(room))
+
+def monitor_event_loop_lag():
+    """测量定时器比预期晚多久触发，反映 eventlet hub 是否被阻塞"""
+    interval = LAG_SAMPLE_INTERVAL
+    while True:
+        start = time.perf_counter()
+        socketio.sleep(interval)
+        metrics.observe_lag(time.perf_counter() - start - interval)
+
+def run_retention():
+    """定期归档过期消息；在 tpool 中执行，避免阻塞 eventlet 的 hub"""
+    while True:
+        socketio.sleep(config.RETENTION_INTERVAL_S)
+        start = time.perf_counter()
+        try:
+            result = tpool.execute(retention.run)
+        except (sqlite3.Error, OSError) as exc:
+            repository.metrics.observe('retention', time.perf_counter() - start, error=True)
+            print('Retention failed:', exc)
+            continue
+        repository.metrics.observe('retention', time.perf_counter() - start)
+        recent_history.discard_through(result['max_message_id'])
+
+def refresh_snapshot():
+    """按配置的间隔重新生成只读快照"""
+    while True:
+        try:
+            tpool.execute(snapshot.refresh)
+        except (sqlite3.Error, OSError) as exc:
+            print('Snapshot refresh failed:', exc)
+        socketio.sleep(config.READ_SNAPSHOT_INTERVAL_S)
+
+def expire_resumable_sessions():
+    """保存的会话过期后，没有回来的用户按下线处理：通知其私聊对象"""
+    delay = resume_store.expires_in()
+    if delay is None:
+        return
+    socketio.sleep(delay)
+    for username, saved in resume_store.expire().items():
+        partner = saved.get('partner')
+        if not partner:
+            continue
+        # 共享的后端里私聊会话还在，先结束；对方已经开始新的私聊时不再通知
+        if backplane.private_partner(username) == partner:
+            remove_private_chat_session(username)
+        elif is_user_in_private_chat(partner):
+            continue
+        if backplane.is_online(partner):
+            socketio.emit('private_chat_ended_by_disconnect', {
+                'username': username,
+                'message': f'{username} 已断线，私聊会话结束'
+            }, to=user_room(partner))
+
+def backplane_heartbeat():
+    """续期本进程在 backplane 中的心跳；已崩溃进程上的用户按下线处理"""
+    while True:
+        try:
+            for username in backplane.heartbeat():
+                user_went_offline(username)
+        except Exception as exc:
+            # 下一个周期重试；连续失败超过心跳 TTL 时，本进程的连接会被其他进程清理
+            print('Backplane heartbeat failed:', exc)
+        socketio.sleep(config.BACKPLANE_HEARTBEAT_S)
+
+def drain():
+    """优雅关闭：拒绝新连接，保存可恢复的会话，通知客户端错开时间重连，再等客户端断开"""
+    global draining
+    draining = True
+    resume_store.save(backplane.local_sessions())
+    socketio.emit('server_shutdown', {'reconnect_window_ms': config.DRAIN_RECONNECT_WINDOW_MS})
+    deadline = time.monotonic() + config.DRAIN_TIMEOUT_S
+    while local_recipients(socketio.server.manager, '/', None) and time.monotonic() < deadline:
+        socketio.sleep(0.1)
+
+def stop_gracefully():
+    drain()
+    # 在后台任务中抛出 SystemExit 会结束 socketio.run，atexit 中的清理照常执行
+    raise SystemExit
+
+def handle_exit_signal(signum, frame):
+    # 排空期间再收到信号就直接退出
+    if draining:
+        raise SystemExit
+    socketio.start_background_task(stop_gracefully)
+
+def run_query(name, fn, *args):
+    """在 tpool 中通过 repository 执行读查询，避免阻塞 eventlet 的 hub"""
+    return tpool.execute(repository.run, name, fn, *args)
+
+def run_history_query(name, table, before, fn, *args):
+    """游标 before 之前的行都已在快照中时查快照，否则查主库"""
+    if snapshot is not None and snapshot.covers(table, before):
+        return tpool.execute(snapshot.run, name, fn, *args)
+    return run_query(name, fn, *args)
+
+def wait_for_store(future):
+    """按持久化策略等待消息落盘；只挂起当前 greenlet，不阻塞 eventlet 的 hub"""
+    if message_store.wait_for_commit:
+        return commit_waiter.wait(future)
     return None
 
 def is_user_in_private_chat(username):
     """检查用户是否正在私聊中"""
-    return username in private_chat_sessions
+    return backplane.private_partner(username) is not None
 
 def add_private_chat_session(user1, user2):
-    """添加私聊会话记录"""
-    private_chat_sessions[user1] = user2
-    private_chat_sessions[user2] = user1
+    """添加私聊会话记录；任一方已在私聊中时返回 False"""
+    return backplane.start_private_session(user1, user2)
 
 def remove_private_chat_session(username):
-    """移除用户的私聊会话记录"""
-    if username in private_chat_sessions:
-        other_user = private_chat_sessions[username]
-        del private_chat_sessions[username]
-        if other_user in private_chat_sessions:
-            del private_chat_sessions[other_user]
+    """移除用户的私聊会话记录，返回对方用户名"""
+    return backplane.end_private_session(username)
 
 @socketio.on('private_chat_request')
 def handle_private_chat_request(data):
     recipient_username = data['recipient_username']
-    sender_username = users.get(request.sid, {}).get('username')
+    sender_username = backplane.username_of(request.sid)
     if not sender_username:
         return 
     
@@ -153,9 +684,8 @@ def handle_private_chat_request(data):
         })
         return
     
-    recipient_sid = get_sid_by_username(recipient_username)
-    if recipient_sid:
-        emit('private_chat_request', {'sender_username': sender_username}, to=recipient_sid)
+    if backplane.is_online(recipient_username):
+        emit('private_chat_request', {'sender_username': sender_username}, to=user_room(recipient_username))
     else:
         emit('private_chat_request_failed', {
             'error': 'user_offline',
@@ -165,24 +695,20 @@ def handle_private_chat_request(data):
 @socketio.on('private_chat_accepted')
 def handle_private_chat_accepted(data):
     sender_username = data['sender_username']
-    recipient_username = users.get(request.sid, {}).get('username')
+    recipient_username = backplane.username_of(request.sid)
     if not recipient_username:
         return
     
-    # 再次检查双方是否都空闲（防止并发请求导致的问题）
-    if is_user_in_private_chat(sender_username) or is_user_in_private_chat(recipient_username):
-        emit('private_chat_accept_failed', {
-            'error': 'session_conflict',
-            'message': '会话冲突，请稍后重试'
-        })
-        return
-    
-    sender_sid = get_sid_by_username(sender_username)
-    if sender_sid:
-        # 将双方加入私聊会话状态表
-        add_private_chat_session(sender_username, recipient_username)
-        
-        emit('private_chat_started', {'other_user': recipient_username}, to=sender_sid)
+    if backplane.is_online(sender_username):
+        # 将双方加入私聊会话状态表；检查双方是否空闲与写入是原子的（防止并发请求导致的问题）
+        if not add_private_chat_session(sender_username, recipient_username):
+            emit('private_chat_accept_failed', {
+                'error': 'session_conflict',
+                'message': '会话冲突，请稍后重试'
+            })
+            return
+
+        emit('private_chat_started', {'other_user': recipient_username}, to=user_room(sender_username))
         emit('private_chat_started', {'other_user': sender_username}, to=request.sid)
     else:
         emit('private_chat_accept_failed', {
@@ -193,73 +719,132 @@ def handle_private_chat_accepted(data):
 @socketio.on('private_chat_rejected')
 def handle_private_chat_rejected(data):
     sender_username = data['sender_username']
-    recipient_username = users.get(request.sid, {}).get('username')
+    recipient_username = backplane.username_of(request.sid)
     if not recipient_username:
         return
-    sender_sid = get_sid_by_username(sender_username)
-    if sender_sid:
-        emit('private_chat_rejected', {'recipient_username': recipient_username}, to=sender_sid)
+    if backplane.is_online(sender_username):
+        emit('private_chat_rejected', {'recipient_username': recipient_username}, to=user_room(sender_username))
 
 @socketio.on('private_chat_ended')
 def handle_private_chat_ended(data):
     """处理私聊结束事件"""
-    username = users.get(request.sid, {}).get('username')
+    username = backplane.username_of(request.sid)
     if not username:
         return
     
-    # 获取对方用户名
-    other_username = private_chat_sessions.get(username)
+    # 清理会话状态，并获取对方用户名
+    other_username = remove_private_chat_session(username)
     if other_username:
-        # 清理会话状态
-        remove_private_chat_session(username)
-        
         # 通知对方会话已结束
-        other_sid = get_sid_by_username(other_username)
-        if other_sid:
-            emit('private_chat_ended_by_other', {'username': username}, to=other_sid)
+        if backplane.is_online(other_username):
+            emit('private_chat_ended_by_other', {'username': username}, to=user_room(other_username))
         
         # 确认给发起者
         emit('private_chat_ended_confirmed', {'other_user': other_username})
 
 @socketio.on('private_message')
-def handle_private_message(data):
-    sender_username = users.get(request.sid, {}).get('username')
-    recipient_username = data['receiver_username']
-    message = data['message']
+def handle_private_message(data=None):
+    """返回值作为发送方的应答，与 chat message 相同"""
+    if not isinstance(data, dict):
+        return {'client_id': None, 'error': 'invalid'}
+    client_id = message_ids.normalize_client_id(data.get('client_id'))
+    if not within_rate_limit('private_message'):
+        return {'client_id': client_id, 'error': 'rate_limited'}
+    recipient_username = data.get('receiver_username')
+    message = data.get('message')
+    if not (is_text(recipient_username) and is_text(message)):
+        return {'client_id': client_id, 'error': 'invalid'}
+    sender_username = backplane.username_of(request.sid)
+    if not sender_username:
+        return {'client_id': client_id, 'error': 'not_joined'}
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    if sender_username and recipient_username and message:
-        recipient_sid = get_sid_by_username(recipient_username)
-
-        with sqlite3.connect('chat.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO private_messages (sender_username, receiver_username, message, timestamp) VALUES (?, ?, ?, ?)',
-                (sender_username, recipient_username, message, timestamp)
-            )
-            conn.commit()
-
-        if recipient_sid:
-            emit('private_message', {
-                'sender_username': sender_username,
-                'message': message,
-                'timestamp': timestamp
-            }, room=recipient_sid)
-
-        emit('private_message_sent', {
-            'recipient_username': recipient_username,
+    if client_id is not None:
+        sent = recent_private_sends.get(sender_username, client_id)
+        if sent is not None:
+            return delivery_ack(client_id, wait_for_store(sent))
+    # 接收者在线时直接投递，但先按未读入库，收到接收者的 private_message_ack 才标为已读；
+    # 连接已断但还没超时、或者还没发出去就断开时，留给上线时的离线投递。
+    # enqueue 模式下发出时还不知道 id，无法确认，只能按在线即已读入库
+    recipient_online = backplane.is_online(recipient_username)
+    future = message_store.save_private_message(
+        sender_username, recipient_username, message, timestamp,
+        is_read=recipient_online and not message_store.wait_for_commit, client_id=client_id)
+    if client_id is not None:
+        recent_private_sends.put(sender_username, client_id, future)
+    # id 用于客户端与加载的私聊记录去重；enqueue 模式下为 None
+    stored = wait_for_store(future)
+    if stored is not None and stored.duplicate:
+        return delivery_ack(client_id, stored)
+    message_id, seq = (stored.id, stored.seq) if stored is not None else (None, None)
+
+    if recipient_online:
+        emit('private_message', {
+            'id': message_id,
+            'seq': seq,
+            'sender_username': sender_username,
             'message': message,
             'timestamp': timestamp
-        }, room=request.sid)
+        }, room=user_room(recipient_username))
+
+    # 发送者的所有标签页都要看到这条消息
+    emit('private_message_sent', {
+        'id': message_id,
+        'seq': seq,
+        'client_id': client_id,
+        'recipient_username': recipient_username,
+        'message': message,
+        'timestamp': timestamp
+    }, room=user_room(sender_username))
+    return delivery_ack(client_id, stored)
+
+@socketio.on('private_history')
+def handle_private_history(data=None):
+    """按 id 游标向前翻页加载与某个用户的私聊记录
+
+    一页记录和错误都通过应答返回：{with, before, messages, next_cursor} 或 {error}
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        return {'error': 'invalid'}
+    username = backplane.username_of(request.sid)
+    if not username:
+        return {'error': 'not_joined'}
+    other_username = data.get('with')
+    if not isinstance(other_username, str) or not other_username:
+        return {'error': 'invalid'}
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return {'error': 'invalid'}
+    try:
+        page = run_history_query('private_history', 'private_messages', before, private_history.fetch_page,
+                                 username, other_username, before, data.get('limit'))
+    except sqlite3.Error as exc:
+        print('Private history failed:', exc)
+        return {'error': 'unavailable'}
+    return batch({'with': other_username, 'before': before, **page}, 'messages')
 
 @socketio.on('typing')
 def handle_typing(data):
-    emit('typing', data, broadcast=True, include_self=False)
+    if not within_rate_limit('typing'):
+        return
+    username = backplane.username_of(request.sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if username and room and in_room(room):
+        typing_aggregator.touch(room, username)
 
 @socketio.on('stop typing')
 def handle_stop_typing(data):
-    emit('stop typing', data, broadcast=True, include_self=False)
+    username = backplane.username_of(request.sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if username and room:
+        typing_aggregator.stop(room, username)
 
 if __name__ == '__main__':
-    init_db()
-    socketio.run(app)
\ No newline at end of file
+    migrations.migrate()
+    repository.run('history_warm', recent_history.warm)
+    for exit_signal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(exit_signal, handle_exit_signal)
+    start_background_tasks()
+    socketio.run(app, port=config.PORT)
\ No newline at end of file
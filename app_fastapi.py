@@ -1,65 +1,238 @@
+import asyncio
 import datetime
+import signal
 import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+
 import uvicorn
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from fastapi.templating import Jinja2Templates
 import socketio
-
-
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+import config
+import history
+import message_ids
+import offline_delivery
+import private_history
+from backplane import create_async_backplane
+from assets import AssetManifest, page_shell
+import broadcast
+from instrumentation import CONTENT_TYPE, LAG_SAMPLE_INTERVAL, ChatMetrics, local_recipients, payload_size
+from message_store import create_message_store
+import migrations
+from presence import PresenceDeltas, user_room
+from rate_limit import RateLimiter
+from recent_history import RecentHistory
+from repository import Repository
+from snapshot import create_snapshot
+import retention
+import rooms
+import search
+from serializers import COLUMNAR, encode_batch, json_module, socketio_serializer, wants_columnar
+from typing_state import TypingAggregator
+
+
+# 所有读查询都通过 repository 在线程池中执行，不阻塞事件循环
+repository = Repository()
+message_store = create_message_store(metrics=repository.metrics)
+# 向前翻页、搜索翻页在只读快照上查询，不和主库争用
+snapshot = create_snapshot(metrics=repository.metrics)
+# 在线用户、私聊会话状态表都放在 backplane 中，多进程部署时各进程共享；
+# 方法都是协程，使用 Redis 时等待网络往返也不阻塞事件循环
+backplane = create_async_backplane()
+# 最近消息的内存缓存；多进程部署时其他进程的写入不经过本进程，只在单进程时启用
+recent_history = RecentHistory(enabled=backplane.message_queue_url is None)
+metrics = ChatMetrics()
+metrics.track_queries(repository.metrics)
+# 发送队列积压过多时丢弃输入状态、断开跟不上的连接
+backpressure = broadcast.Backpressure()
+# 每个连接的聊天、私信、输入状态事件按令牌桶限流
+rate_limiter = RateLimiter()
+# 连接时声明接受列式批量负载的连接
+columnar_sids = set()
+# 最近发送的 client_id，重试的消息按第一次的结果应答
+recent_sends = message_ids.RecentSends()
+# 私信的 client_id 与聊天室消息分开去重，与两张表各自的唯一索引一致
+recent_private_sends = message_ids.RecentSends()
+# 优雅关闭时保存的会话，重启后凭 token 恢复；draining 为真时正在关闭
+resume_store = backplane.resume_store()
+draining = False
+# 进行中的私聊会话数，由 backplane_heartbeat 刷新
+private_session_count = 0
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await asyncio.to_thread(migrations.migrate)
+    await repository.arun('history_warm', recent_history.warm)
+    tasks = [
+        sio.start_background_task(flush_presence_deltas),
+        sio.start_background_task(flush_typing_state),
+        sio.start_background_task(monitor_event_loop_lag),
+    ]
+    if config.RETENTION_DAYS > 0:
+        tasks.append(sio.start_background_task(run_retention))
+    if snapshot is not None:
+        tasks.append(sio.start_background_task(refresh_snapshot))
+    tasks.append(sio.start_background_task(expire_resumable_sessions))
+    tasks.append(sio.start_background_task(backplane_heartbeat))
+    install_drain_on_exit()
+    yield
+    for task in tasks:
+        task.cancel()
+    # 关闭前把队列中尚未落盘的消息全部提交
+    await asyncio.to_thread(message_store.close)
+    await asyncio.to_thread(repository.close)
+    if snapshot is not None:
+        await asyncio.to_thread(snapshot.close)
+    await backplane.close()
+
+
+app = FastAPI(lifespan=lifespan)
+# 静态资源由 static_file 按指纹和预压缩版本提供
+asset_manifest = AssetManifest()
+
+
+class InstrumentedAsyncServer(socketio.AsyncServer):
+    """为每个事件处理函数和每次 emit 记录指标"""
+
+    # 创建后由 broadcast.fast_path_supported 决定是否走只编码一次的发送路径
+    encode_once = False
+
+    def on(self, event, handler=None, namespace=None):
+        register = super().on
+
+        def set_handler(handler):
+            register(event, metrics.instrument(event, handler), namespace)
+            return handler
+        if handler is None:
+            return set_handler
+        set_handler(handler)
+
+    async def emit(self, event, data=None, to=None, room=None, skip_sid=None, namespace=None,
+                   callback=None, ignore_queue=False):
+        namespace = namespace or '/'
+        room = to or room
+        encoded = None
+        # 进程内广播：只编码一次，所有接收者复用同一个 Engine.IO 包
+        if self.encode_once and callback is None and not isinstance(self.manager, AsyncPubSubManager):
+            encoded = broadcast.encode_event(self.packet_class, event, data, namespace)
+        if encoded is None:
+            metrics.observe_emit(event, payload_size(data), local_recipients(self.manager, namespace, room))
+            await super().emit(event, data, to=room, skip_sid=skip_sid, namespace=namespace,
+                               callback=callback, ignore_queue=ignore_queue)
+            return
+        eio_pkt, size = encoded
+        targets = broadcast.recipients(self.manager, namespace, room, skip_sid)
+        deliver, dropped, slow = backpressure.split(self.eio, targets, event)
+        metrics.observe_emit(event, size, len(deliver))
+        metrics.observe_backpressure(event, dropped, len(slow))
+        # 发送只是放入各连接的发送队列，逐个 await 即可，不必为每个接收者创建 task
+        for eio_sid in deliver:
+            await self._send_eio_packet(eio_sid, eio_pkt)
+        for eio_sid in slow:
+            self.start_background_task(backpressure.async_abort, self.eio, eio_sid)
+
+
+# 多进程部署时由 backplane 提供跨进程广播的 client manager
+sio = InstrumentedAsyncServer(async_mode='asgi', cors_allowed_origins='*',
+                              client_manager=backplane.async_client_manager(), json=json_module(),
+                              serializer=socketio_serializer())
+# 只编码一次和背压依赖库的内部接口，库版本未经验证时退回公开的 emit
+sio.encode_once = broadcast.fast_path_supported(sio)
 
 
 socket_app = socketio.ASGIApp(sio)
+metrics.gauge('chat_connected_sockets', 'Socket.IO connections on this process.',
+              lambda: local_recipients(sio.manager, '/', None))
+metrics.gauge('chat_private_sessions', 'Active private chat sessions.',
+              lambda: private_session_count)
+if snapshot is not None:
+    metrics.gauge('chat_read_snapshot_age_seconds', 'Seconds since the read snapshot was refreshed.',
+                  snapshot.age)
 
 
 templates = Jinja2Templates(directory="templates")
+# 页面外壳与聊天室无关，只渲染一次；聊天室和消息由页面加载后请求 /history
+index_page = page_shell(templates.get_template("index.html").render(
+    asset_url=asset_manifest.url, default_room=rooms.DEFAULT_ROOM, wire_format=config.WIRE_FORMAT))
 
 
-users = {}
-private_chat_sessions = {}
-
-def init_db():
-    """初始化数据库和表结构"""
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS private_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_username TEXT NOT NULL,
-                receiver_username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                is_read INTEGER DEFAULT 0
-            )
-        ''')
-        conn.commit()
+# 在线列表的增量广播：新连接拿全量快照，之后只收合并后的增量
+presence_deltas = PresenceDeltas(backplane)
+# “正在输入”状态按聊天室周期汇总广播
+typing_aggregator = TypingAggregator()
 
 # -----------------
 # 3. HTTP 路由 (FastAPI)
 # -----------------
-@app.get("/", response_class=HTMLResponse)
+@app.get("/")
 async def index(request: Request):
-    """渲染主聊天页面并加载历史公共消息"""
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT username, message, timestamp FROM messages ORDER BY timestamp ASC')
-        messages = cursor.fetchall()
-    # FastAPI 的模板渲染需要传递 request 对象
-    return templates.TemplateResponse("index.html", {"request": request, "messages": messages})
+    """主聊天页面，内容不变时返回 304"""
+    return static_response(index_page.respond(request.headers.get('if-none-match'),
+                                              request.headers.get('accept-encoding')))
+
+@app.get("/static/{filename:path}")
+async def static_file(request: Request, filename: str):
+    """带指纹的文件长期缓存，按 Accept-Encoding 返回预压缩的版本"""
+    result = asset_manifest.respond(filename, request.headers.get('if-none-match'),
+                                    request.headers.get('accept-encoding'))
+    if result is None:
+        raise HTTPException(status_code=404)
+    return static_response(result)
+
+def static_response(result):
+    status, body, headers = result
+    return Response(body, status_code=status, headers=headers)
+
+@app.get("/history")
+async def load_history(room: str | None = None, before: int | None = None, limit: int | None = None,
+                       encoding: str | None = None):
+    """按 id 游标向前翻页加载某个聊天室的历史消息"""
+    room = rooms.normalize_room(room)
+    if room is None:
+        raise HTTPException(status_code=400, detail='invalid room')
+    page = await load_history_page(room, before, limit)
+    return encode_batch(page, 'messages', encoding == COLUMNAR)
+
+async def load_history_page(room, before=None, limit=None):
+    """优先从内存缓存取一页历史，覆盖不到时才查询数据库"""
+    page = recent_history.page(room, before, limit)
+    if page is None and recent_history.enabled and not recent_history.is_loaded(room):
+        recent_history.load(room, *await repository.arun('history_recent', history.fetch_latest, room,
+                                                         recent_history.capacity))
+        page = recent_history.page(room, before, limit)
+    if page is None:
+        page = await run_history_query('history_page', 'messages', before, history.fetch_page, room,
+                                       before, limit)
+    return page
+
+@app.get("/search")
+async def search_messages(q: str | None = None, room: str | None = None, before: int | None = None,
+                          limit: int | None = None):
+    """在某个聊天室的公共消息中全文搜索，按 id 游标向前翻页"""
+    room = rooms.normalize_room(room)
+    if room is None:
+        raise HTTPException(status_code=400, detail='invalid room')
+    try:
+        return await run_history_query('search_messages', 'messages', before, search.search_messages,
+                                       room, q, before, limit)
+    except search.SearchQueryError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.get("/stats/db")
+async def db_stats():
+    """各查询的调用次数与耗时分布（毫秒）"""
+    return repository.metrics.snapshot()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
 
 # -----------------
 # 4. Socket.IO 事件处理 (python-socketio)
@@ -69,104 +242,431 @@ async def index(request: Request):
 # 所有 emit 操作都应使用 await sio.emit(...)
 
 @sio.on('connect')
-async def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     """客户端连接事件"""
+    if draining:
+        return False
+    if wants_columnar(auth):
+        columnar_sids.add(sid)
     print('Client connected:', sid)
     await sio.emit('my response', {'data': 'Connected'}, to=sid)
+    await sio.emit('presence_snapshot', await presence_deltas.asnapshot(), to=sid)
+
+@sio.on('presence_sync')
+async def handle_presence_sync(sid, data=None):
+    """客户端发现增量版本号不连续时请求全量快照"""
+    await sio.emit('presence_snapshot', await presence_deltas.asnapshot(), to=sid)
 
 @sio.on('disconnect')
 async def disconnect(sid):
     """客户端断开连接事件"""
-    if sid in users:
-        username = users[sid].get('username')
-        
-        # 清理用户的私聊会话状态
-        if username and is_user_in_private_chat(username):
-            other_username = private_chat_sessions.get(username)
-            remove_private_chat_session(username)
-            
-            # 通知对方用户已断线
-            if other_username:
-                other_sid = get_sid_by_username(other_username)
-                if other_sid:
-                    await sio.emit('private_chat_ended_by_disconnect', {
-                        'username': username,
-                        'message': f'{username} 已断线，私聊会话结束'
-                    }, to=other_sid)
-        
-        del users[sid]
-        
-        user_list = [user['username'] for user in users.values()]
-        # 广播更新后的用户列表
-        await sio.emit('user list', {'users': user_list})
+    rate_limiter.forget(sid)
+    columnar_sids.discard(sid)
+    released = await backplane.release(sid)
+    # 排空期间断开的连接会在重启后恢复，不算下线
+    if draining:
+        return
+    # 同一用户还有其他标签页在线时，不算下线
+    if released and released.last_session:
+        await user_went_offline(released.username)
     print('Client disconnected:', sid)
 
+async def user_went_offline(username):
+    """用户的最后一个连接已断开：结束私聊并通知对方，从在线列表中移除"""
+    # 清理用户的私聊会话状态
+    if await is_user_in_private_chat(username):
+        other_username = await remove_private_chat_session(username)
+
+        # 通知对方用户已断线
+        if other_username and await backplane.is_online(other_username):
+            await sio.emit('private_chat_ended_by_disconnect', {
+                'username': username,
+                'message': f'{username} 已断线，私聊会话结束'
+            }, to=user_room(other_username))
+
+    # 下线记入增量，由 flush_presence_deltas 合并广播
+    presence_deltas.user_removed(username)
+    typing_aggregator.remove_user(username)
+
 @sio.on('user joined')
 async def handle_user_joined(sid, data):
     """用户加入聊天室事件"""
     username = data['username']
-    if any(user.get('username') == username for user in users.values()):
+    room = rooms.normalize_room(data.get('room')) or rooms.DEFAULT_ROOM
+    await join_user(sid, username, data.get('token'), room)
+
+@sio.on('resume')
+async def handle_resume(sid, data):
+    """断线或服务重启后恢复会话，并在同一次往返中补发 last_id 之后的消息"""
+    data = data or {}
+    username = data.get('username')
+    room = rooms.normalize_room(data.get('room')) or rooms.DEFAULT_ROOM
+    try:
+        last_id = int(data.get('last_id') or 0)
+    except (TypeError, ValueError):
+        return
+    if not username:
+        return
+    saved = await asyncio.to_thread(resume_store.take, username, data.get('token'))
+    if not await join_user(sid, username, data.get('token'), room, resumed=True, restored=saved is not None):
+        return
+    if saved is not None and saved.get('partner'):
+        # 双方都回来后才重建私聊
+        if await backplane.is_online(saved['partner']):
+            await add_private_chat_session(username, saved['partner'])
+    chunk = await catch_up_chunk(room, last_id)
+    await sio.emit('missed_messages', batch(sid, {'room': room, **chunk}, 'messages'), to=sid)
+
+async def join_user(sid, username, token, room, resumed=False, restored=False):
+    """让连接认领用户名并加入聊天室，失败返回 False
+
+    resumed：通过 resume 事件加入，补齐的消息由服务端直接发送；
+    restored：重启前保存的同一会话，不再广播加入、不重新投递离线私信
+    """
+    claim = await backplane.claim(username, sid, token)
+    if claim is None:
         await sio.emit('username taken', {'username': username}, to=sid)
-    else:
-        users[sid] = {'username': username}
-        await sio.emit('join successful', {'username': username}, to=sid)
-        
-        user_list = [user['username'] for user in users.values()]
-        await sio.emit('user list', {'users': user_list})
-        
-        # 向其他用户广播新用户加入的消息
-        # 在 python-socketio 中, include_self=False 等价于 skip_sid=sid
-        await sio.emit('user joined', data, skip_sid=sid)
-
-        # 检查并发送离线消息
-        with sqlite3.connect('chat.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT sender_username, message, timestamp FROM private_messages WHERE receiver_username = ? AND is_read = 0', (username,))
-            unread_messages = cursor.fetchall()
-            for msg in unread_messages:
-                await sio.emit('missed_private_message', {
-                    'sender_username': msg[0],
-                    'message': msg[1],
-                    'timestamp': msg[2]
-                }, to=sid)
-            # 标记为已读
-            cursor.execute('UPDATE private_messages SET is_read = 1 WHERE receiver_username = ?', (username,))
-            conn.commit()
+        return False
+    await sio.enter_room(sid, user_room(username))
+    await sio.enter_room(sid, rooms.room_channel(room))
+    await sio.emit('join successful', {'username': username, 'token': claim.token, 'room': room,
+                                       'resumed': resumed}, to=sid)
+
+    # 同一用户新开的标签页不需要再广播上线和投递离线消息
+    if claim.first_session:
+        # 上线只记入增量，不再单独广播 user joined：客户端按增量中新出现的用户显示加入提示，
+        # 重连风暴时也只是每个合并窗口一个包
+        presence_deltas.user_added(username)
+        if not restored:
+            # 离线私信分块投递，客户端确认一块后再发下一块
+            await send_missed_private_messages(sid, username)
+    return True
+
+@sio.on('join room')
+async def handle_join_room(sid, data):
+    """加入聊天室，之后才能收到该聊天室的消息和输入状态"""
+    if not await backplane.username_of(sid):
+        return
+    room = rooms.normalize_room((data or {}).get('room'))
+    if room is None:
+        await sio.emit('room error', {
+            'message': '聊天室名称只能包含字母、数字、下划线和连字符，最长 32 个字符'
+        }, to=sid)
+        return
+    await sio.enter_room(sid, rooms.room_channel(room))
+    await sio.emit('room joined', {'room': room}, to=sid)
+
+@sio.on('leave room')
+async def handle_leave_room(sid, data):
+    username = await backplane.username_of(sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if not username or room is None:
+        return
+    await sio.leave_room(sid, rooms.room_channel(room))
+    typing_aggregator.stop(room, username)
+    await sio.emit('room left', {'room': room}, to=sid)
+
+def in_room(sid, room):
+    """连接是否已加入聊天室"""
+    return rooms.room_channel(room) in sio.rooms(sid)
+
+def batch(sid, payload, key):
+    """按连接 sid 协商的编码返回批量负载"""
+    return encode_batch(payload, key, sid in columnar_sids)
+
+def rate_limit_key(sid, username):
+    """加入后按用户名限流，重连和多开标签页共用同一组令牌桶"""
+    return ('user', username) if username else sid
+
+async def within_rate_limit(sid, event):
+    """连接 sid 所属用户的 event 是否还在限流预算内；超出时通知客户端，每次耗尽只通知一次"""
+    key = rate_limit_key(sid, await backplane.username_of(sid))
+    allowed, retry_after, notify = rate_limiter.check(key, event)
+    if not allowed:
+        metrics.observe_rate_limited(event)
+        if notify:
+            await sio.emit('rate_limited', {'event': event, 'retry_after': round(retry_after, 3)},
+                           to=sid)
+    return allowed
+
+@sio.on('catch up')
+async def handle_catch_up(sid, data):
+    """重连后补齐 after_id 之后错过的消息，每次一页，客户端按 has_more 继续请求"""
+    room = rooms.normalize_room((data or {}).get('room'))
+    try:
+        after_id = int((data or {}).get('after_id') or 0)
+    except (TypeError, ValueError):
+        return
+    if room is None or not in_room(sid, room):
+        return
+    chunk = await catch_up_chunk(room, after_id)
+    await sio.emit('missed_messages', batch(sid, {'room': room, **chunk}, 'messages'), to=sid)
+
+async def catch_up_chunk(room, after_id):
+    """after_id 之后的一页消息，优先从内存缓存取"""
+    chunk = recent_history.since(room, after_id)
+    if chunk is None:
+        chunk = await repository.arun('history_after', history.fetch_after, room, after_id)
+    return chunk
+
+@sio.on('search')
+async def handle_search(sid, data):
+    """全文搜索：scope 为 'room' 时搜聊天室公共消息，为 'private' 时搜自己的私信"""
+    if not await within_rate_limit(sid, 'search'):
+        return
+    data = data or {}
+    username = await backplane.username_of(sid)
+    scope = data.get('scope', 'room')
+    query = data.get('q')
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return
+    try:
+        if scope == 'private' and username:
+            page = await run_history_query('search_private_messages', 'private_messages', before,
+                                           search.search_private_messages, username, query,
+                                           data.get('with'), before, data.get('limit'))
+        elif scope == 'room':
+            room = rooms.normalize_room(data.get('room'))
+            if room is None:
+                return
+            page = await run_history_query('search_messages', 'messages', before, search.search_messages,
+                                           room, query, before, data.get('limit'))
+        else:
+            return
+    except search.SearchQueryError as exc:
+        await sio.emit('search error', {'q': query, 'message': str(exc)}, to=sid)
+        return
+    await sio.emit('search results', batch(sid, {'scope': scope, 'q': query, 'before': before, **page},
+                                           'results'), to=sid)
+
+@sio.on('missed_private_messages_ack')
+async def handle_missed_private_messages_ack(sid, data):
+    """客户端确认收到一块离线私信：只把确认过的标为已读，然后发下一块"""
+    username = await backplane.username_of(sid)
+    ids = offline_delivery.parse_ack(data)
+    if not username or not ids:
+        return
+    offline_delivery.mark_read(message_store, username, ids)
+    await send_missed_private_messages(sid, username, after_id=max(ids))
+
+@sio.on('private_message_ack')
+async def handle_private_message_ack(sid, data):
+    """接收者确认收到实时投递的私信，这时才标为已读"""
+    username = await backplane.username_of(sid)
+    ids = offline_delivery.parse_ack(data)
+    if username and ids:
+        offline_delivery.mark_read(message_store, username, ids)
+
+async def send_missed_private_messages(sid, username, after_id=0):
+    chunk = await repository.arun('unread_chunk', offline_delivery.fetch_unread, username, after_id)
+    if chunk['messages']:
+        await sio.emit('missed_private_messages', batch(sid, chunk, 'messages'), to=sid)
 
 @sio.on('chat message')
-async def handle_message(sid, data):
-    """处理公共聊天消息"""
-    data['timestamp'] = datetime.datetime.now().strftime('%H:%M')
-    with sqlite3.connect('chat.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO messages (username, message, timestamp) VALUES (?, ?, ?)',
-                       (data['username'], data['message'], data['timestamp']))
-        conn.commit()
-    await sio.emit('chat message', data)
+async def handle_message(sid, data=None):
+    """处理聊天室消息，只发给该聊天室内的连接
+
+    返回值作为发送方的应答：{client_id, id, seq}，被拒绝时为 {client_id, error}
+    """
+    if not isinstance(data, dict):
+        return {'client_id': None, 'error': 'invalid'}
+    client_id = message_ids.normalize_client_id(data.get('client_id'))
+    if not await within_rate_limit(sid, 'chat message'):
+        return {'client_id': client_id, 'error': 'rate_limited'}
+    if not is_text(data.get('message')):
+        return {'client_id': client_id, 'error': 'invalid'}
+    room = rooms.normalize_room(data.get('room'))
+    if room is None or not in_room(sid, room):
+        return {'client_id': client_id, 'error': 'not_in_room'}
+    # 发送者以连接登记的用户名为准，不信任客户端提供的 username：
+    # 去重键和入库的用户名都用它，否则可以冒用别人的名字或占用别人的 client_id
+    username = await backplane.username_of(sid)
+    if not username:
+        return {'client_id': client_id, 'error': 'not_joined'}
+    data['username'] = username
+    if client_id is not None:
+        sent = recent_sends.get(username, client_id)
+        if sent is not None:
+            # 重试：按第一次的结果应答，不再写入和广播
+            return delivery_ack(client_id, await wait_for_store(sent))
+    now = datetime.datetime.now()
+    data['room'] = room
+    data['timestamp'] = now.strftime('%H:%M')
+    data['created_at'] = int(now.timestamp() * 1000)
+    future = message_store.save_message(
+        username, data['message'], data['timestamp'], data['created_at'], room, client_id)
+    if client_id is not None:
+        recent_sends.put(username, client_id, future)
+    recent_history.track(future, data)
+    stored = await wait_for_store(future)
+    if stored is not None:
+        if stored.duplicate:
+            return delivery_ack(client_id, stored)
+        data['id'] = stored.id
+        data['seq'] = stored.seq
+    await sio.emit('chat message', data, to=rooms.room_channel(room))
+    return delivery_ack(client_id, stored)
 
 # -----------------
 # 5. 辅助函数
 # -----------------
 # 这些辅助函数基本保持不变，因为它们不直接与框架交互
 
-def get_sid_by_username(username):
-    for sid, user_data in users.items():
-        if user_data.get('username') == username:
-            return sid
+async def flush_presence_deltas():
+    """每个合并窗口广播一次在线列表增量"""
+    while True:
+        await sio.sleep(config.PRESENCE_BATCH_INTERVAL_MS / 1000)
+        delta = await presence_deltas.adrain()
+        if delta:
+            await sio.emit('presence_delta', delta)
+
+async def flush_typing_state():
+    """每个周期最多发一次输入状态汇总，且只在输入者集合变化时发送"""
+    while True:
+        await sio.sleep(config.TYPING_INTERVAL_MS / 1000)
+        for room, typing_users in typing_aggregator.collect():
+            # 多进程部署时每个进程只汇总自己的连接，客户端按 node 合并
+            await sio.emit('typing_state', {'room': room, 'users': typing_users,
+                                            'node': backplane.node_id},
+                           to=rooms.room_channel(room))
+
+async def monitor_event_loop_lag():
+    """测量定时器比预期晚多久触发，反映事件循环是否被阻塞"""
+    while True:
+        start = time.perf_counter()
+        await sio.sleep(LAG_SAMPLE_INTERVAL)
+        metrics.observe_lag(time.perf_counter() - start - LAG_SAMPLE_INTERVAL)
+
+async def run_retention():
+    """定期归档过期消息；在线程中执行，不占用事件循环"""
+    while True:
+        await sio.sleep(config.RETENTION_INTERVAL_S)
+        start = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(retention.run)
+        except (sqlite3.Error, OSError) as exc:
+            repository.metrics.observe('retention', time.perf_counter() - start, error=True)
+            print('Retention failed:', exc)
+            continue
+        repository.metrics.observe('retention', time.perf_counter() - start)
+        recent_history.discard_through(result['max_message_id'])
+
+async def expire_resumable_sessions():
+    """保存的会话过期后，没有回来的用户按下线处理：通知其私聊对象"""
+    delay = resume_store.expires_in()
+    if delay is None:
+        return
+    await sio.sleep(delay)
+    for username, saved in (await asyncio.to_thread(resume_store.expire)).items():
+        partner = saved.get('partner')
+        if not partner:
+            continue
+        # 共享的后端里私聊会话还在，先结束；对方已经开始新的私聊时不再通知
+        if await backplane.private_partner(username) == partner:
+            await remove_private_chat_session(username)
+        elif await is_user_in_private_chat(partner):
+            continue
+        if await backplane.is_online(partner):
+            await sio.emit('private_chat_ended_by_disconnect', {
+                'username': username,
+                'message': f'{username} 已断线，私聊会话结束'
+            }, to=user_room(partner))
+
+async def backplane_heartbeat():
+    """续期本进程在 backplane 中的心跳；已崩溃进程上的用户按下线处理
+
+    指标采集是同步的，不能在其中等待 Redis，私聊会话数也在这里顺便刷新。
+    """
+    global private_session_count
+    while True:
+        try:
+            for username in await backplane.heartbeat():
+                await user_went_offline(username)
+            private_session_count = await backplane.private_session_count()
+        except Exception as exc:
+            # 下一个周期重试；连续失败超过心跳 TTL 时，本进程的连接会被其他进程清理
+            print('Backplane heartbeat failed:', exc)
+        await sio.sleep(config.BACKPLANE_HEARTBEAT_S)
+
+async def drain():
+    """优雅关闭：拒绝新连接，保存可恢复的会话，通知客户端错开时间重连，再等客户端断开"""
+    global draining
+    draining = True
+    await asyncio.to_thread(lambda: resume_store.save(backplane.sync.local_sessions()))
+    await sio.emit('server_shutdown', {'reconnect_window_ms': config.DRAIN_RECONNECT_WINDOW_MS})
+    deadline = time.monotonic() + config.DRAIN_TIMEOUT_S
+    while local_recipients(sio.manager, '/', None) and time.monotonic() < deadline:
+        await sio.sleep(0.1)
+
+async def stop_gracefully(previous, signum, frame):
+    try:
+        await drain()
+    finally:
+        # 交还给 uvicorn 的信号处理，照常关闭
+        previous(signum, frame)
+
+def install_drain_on_exit():
+    """在 uvicorn 的退出信号处理之前先排空连接
+
+    uvicorn 在 lifespan 启动之前安装信号处理，这里包装它：第一次收到信号时先 drain，
+    排空期间再收到信号就直接交给 uvicorn。只能在主线程安装（TestClient 等场景下跳过）。
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for exit_signal in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(exit_signal)
+        if not callable(previous):
+            continue
+
+        def handle_exit_signal(signum, frame, previous=previous):
+            if draining:
+                previous(signum, frame)
+                return
+            loop.call_soon_threadsafe(loop.create_task, stop_gracefully(previous, signum, frame))
+        signal.signal(exit_signal, handle_exit_signal)
+
+async def refresh_snapshot():
+    """按配置的间隔重新生成只读快照"""
+    while True:
+        try:
+            await asyncio.to_thread(snapshot.refresh)
+        except (sqlite3.Error, OSError) as exc:
+            print('Snapshot refresh failed:', exc)
+        await sio.sleep(config.READ_SNAPSHOT_INTERVAL_S)
+
+async def run_history_query(name, table, before, fn, *args):
+    """游标 before 之前的行都已在快照中时查快照，否则查主库"""
+    if snapshot is not None and snapshot.covers(table, before):
+        return await snapshot.arun(name, fn, *args)
+    return await repository.arun(name, fn, *args)
+
+async def wait_for_store(future):
+    """按持久化策略等待消息落盘，等待期间不占用事件循环"""
+    if message_store.wait_for_commit:
+        return await asyncio.wrap_future(future)
     return None
 
-def is_user_in_private_chat(username):
-    return username in private_chat_sessions
+def is_text(value):
+    """消息正文、接收者等字段必须是非空字符串"""
+    return isinstance(value, str) and bool(value)
 
-def add_private_chat_session(user1, user2):
-    private_chat_sessions[user1] = user2
-    private_chat_sessions[user2] = user1
+def delivery_ack(client_id, stored):
+    """发送方的应答：落盘后带上 id 和会话内序号；enqueue 模式下只确认已接收"""
+    if stored is None:
+        return {'client_id': client_id, 'queued': True}
+    return {'client_id': client_id, 'id': stored.id, 'seq': stored.seq}
 
-def remove_private_chat_session(username):
-    if username in private_chat_sessions:
-        other_user = private_chat_sessions.pop(username, None)
-        if other_user and other_user in private_chat_sessions:
-            private_chat_sessions.pop(other_user, None)
+async def is_user_in_private_chat(username):
+    return await backplane.private_partner(username) is not None
+
+async def add_private_chat_session(user1, user2):
+    return await backplane.start_private_session(user1, user2)
+
+async def remove_private_chat_session(username):
+    return await backplane.end_private_session(username)
 
 
 # -----------------
@@ -176,25 +676,25 @@ def remove_private_chat_session(username):
 @sio.on('private_chat_request')
 async def handle_private_chat_request(sid, data):
     recipient_username = data['recipient_username']
-    sender_username = users.get(sid, {}).get('username')
+    sender_username = await backplane.username_of(sid)
     if not sender_username:
         return
         
-    if is_user_in_private_chat(sender_username):
+    if await is_user_in_private_chat(sender_username):
         await sio.emit('private_chat_request_failed', {
             'error': 'you_are_busy', 'message': '您当前正在私聊中，无法发起新的私聊请求'
         }, to=sid)
         return
     
-    if is_user_in_private_chat(recipient_username):
+    if await is_user_in_private_chat(recipient_username):
         await sio.emit('private_chat_request_failed', {
             'error': 'recipient_busy', 'message': f'{recipient_username} 正在和别人私聊，无法接受新的私聊请求'
         }, to=sid)
         return
     
-    recipient_sid = get_sid_by_username(recipient_username)
-    if recipient_sid:
-        await sio.emit('private_chat_request', {'sender_username': sender_username}, to=recipient_sid)
+    if await backplane.is_online(recipient_username):
+        await sio.emit('private_chat_request', {'sender_username': sender_username},
+                       to=user_room(recipient_username))
     else:
         await sio.emit('private_chat_request_failed', {
             'error': 'user_offline', 'message': f'{recipient_username} 当前不在线'
@@ -203,20 +703,18 @@ async def handle_private_chat_request(sid, data):
 @sio.on('private_chat_accepted')
 async def handle_private_chat_accepted(sid, data):
     sender_username = data['sender_username']
-    recipient_username = users.get(sid, {}).get('username')
+    recipient_username = await backplane.username_of(sid)
     if not recipient_username:
         return
         
-    if is_user_in_private_chat(sender_username) or is_user_in_private_chat(recipient_username):
-        await sio.emit('private_chat_accept_failed', {
-            'error': 'session_conflict', 'message': '会话冲突，请稍后重试'
-        }, to=sid)
-        return
-        
-    sender_sid = get_sid_by_username(sender_username)
-    if sender_sid:
-        add_private_chat_session(sender_username, recipient_username)
-        await sio.emit('private_chat_started', {'other_user': recipient_username}, to=sender_sid)
+    if await backplane.is_online(sender_username):
+        # 检查双方是否空闲与写入会话是原子的，多进程并发接受时只有一个能成功
+        if not await add_private_chat_session(sender_username, recipient_username):
+            await sio.emit('private_chat_accept_failed', {
+                'error': 'session_conflict', 'message': '会话冲突，请稍后重试'
+            }, to=sid)
+            return
+        await sio.emit('private_chat_started', {'other_user': recipient_username}, to=user_room(sender_username))
         await sio.emit('private_chat_started', {'other_user': sender_username}, to=sid)
     else:
         await sio.emit('private_chat_accept_failed', {
@@ -226,68 +724,127 @@ async def handle_private_chat_accepted(sid, data):
 @sio.on('private_chat_rejected')
 async def handle_private_chat_rejected(sid, data):
     sender_username = data['sender_username']
-    recipient_username = users.get(sid, {}).get('username')
+    recipient_username = await backplane.username_of(sid)
     if not recipient_username:
         return
-    sender_sid = get_sid_by_username(sender_username)
-    if sender_sid:
-        await sio.emit('private_chat_rejected', {'recipient_username': recipient_username}, to=sender_sid)
+    if await backplane.is_online(sender_username):
+        await sio.emit('private_chat_rejected', {'recipient_username': recipient_username},
+                       to=user_room(sender_username))
 
 @sio.on('private_chat_ended')
 async def handle_private_chat_ended(sid, data):
-    username = users.get(sid, {}).get('username')
+    username = await backplane.username_of(sid)
     if not username:
         return
     
-    other_username = private_chat_sessions.get(username)
+    other_username = await remove_private_chat_session(username)
     if other_username:
-        remove_private_chat_session(username)
-        other_sid = get_sid_by_username(other_username)
-        if other_sid:
-            await sio.emit('private_chat_ended_by_other', {'username': username}, to=other_sid)
+        if await backplane.is_online(other_username):
+            await sio.emit('private_chat_ended_by_other', {'username': username}, to=user_room(other_username))
         await sio.emit('private_chat_ended_confirmed', {'other_user': other_username}, to=sid)
 
 
 @sio.on('private_message')
-async def handle_private_message(sid, data):
-    sender_username = users.get(sid, {}).get('username')
-    recipient_username = data['receiver_username']
-    message = data['message']
+async def handle_private_message(sid, data=None):
+    """返回值作为发送方的应答，与 chat message 相同"""
+    if not isinstance(data, dict):
+        return {'client_id': None, 'error': 'invalid'}
+    client_id = message_ids.normalize_client_id(data.get('client_id'))
+    if not await within_rate_limit(sid, 'private_message'):
+        return {'client_id': client_id, 'error': 'rate_limited'}
+    recipient_username = data.get('receiver_username')
+    message = data.get('message')
+    if not (is_text(recipient_username) and is_text(message)):
+        return {'client_id': client_id, 'error': 'invalid'}
+    sender_username = await backplane.username_of(sid)
+    if not sender_username:
+        return {'client_id': client_id, 'error': 'not_joined'}
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    if sender_username and recipient_username and message:
-        recipient_sid = get_sid_by_username(recipient_username)
-
-        with sqlite3.connect('chat.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO private_messages (sender_username, receiver_username, message, timestamp) VALUES (?, ?, ?, ?)',
-                (sender_username, recipient_username, message, timestamp)
-            )
-            conn.commit()
-
-        # 发送给接收者（如果在线）
-        if recipient_sid:
-            await sio.emit('private_message', {
-                'sender_username': sender_username,
-                'message': message,
-                'timestamp': timestamp
-            }, to=recipient_sid)
-
-        # 回传给发送者，确认消息已发送
-        await sio.emit('private_message_sent', {
-            'recipient_username': recipient_username,
+    if client_id is not None:
+        sent = recent_private_sends.get(sender_username, client_id)
+        if sent is not None:
+            return delivery_ack(client_id, await wait_for_store(sent))
+    # 接收者在线时直接投递，但先按未读入库，收到接收者的 private_message_ack 才标为已读；
+    # 连接已断但还没超时、或者还没发出去就断开时，留给上线时的离线投递。
+    # enqueue 模式下发出时还不知道 id，无法确认，只能按在线即已读入库
+    recipient_online = await backplane.is_online(recipient_username)
+    future = message_store.save_private_message(
+        sender_username, recipient_username, message, timestamp,
+        is_read=recipient_online and not message_store.wait_for_commit, client_id=client_id)
+    if client_id is not None:
+        recent_private_sends.put(sender_username, client_id, future)
+    # id 用于客户端与加载的私聊记录去重；enqueue 模式下为 None
+    stored = await wait_for_store(future)
+    if stored is not None and stored.duplicate:
+        return delivery_ack(client_id, stored)
+    message_id, seq = (stored.id, stored.seq) if stored is not None else (None, None)
+
+    # 发送给接收者（如果在线）
+    if recipient_online:
+        await sio.emit('private_message', {
+            'id': message_id,
+            'seq': seq,
+            'sender_username': sender_username,
             'message': message,
             'timestamp': timestamp
-        }, to=sid)
+        }, to=user_room(recipient_username))
+
+    # 回传给发送者的所有标签页，确认消息已发送
+    await sio.emit('private_message_sent', {
+        'id': message_id,
+        'seq': seq,
+        'client_id': client_id,
+        'recipient_username': recipient_username,
+        'message': message,
+        'timestamp': timestamp
+    }, to=user_room(sender_username))
+    return delivery_ack(client_id, stored)
+
+@sio.on('private_history')
+async def handle_private_history(sid, data=None):
+    """按 id 游标向前翻页加载与某个用户的私聊记录
+
+    一页记录和错误都通过应答返回：{with, before, messages, next_cursor} 或 {error}
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        return {'error': 'invalid'}
+    username = await backplane.username_of(sid)
+    if not username:
+        return {'error': 'not_joined'}
+    other_username = data.get('with')
+    if not isinstance(other_username, str) or not other_username:
+        return {'error': 'invalid'}
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return {'error': 'invalid'}
+    try:
+        page = await run_history_query('private_history', 'private_messages', before,
+                                       private_history.fetch_page, username, other_username, before,
+                                       data.get('limit'))
+    except sqlite3.Error as exc:
+        print('Private history failed:', exc)
+        return {'error': 'unavailable'}
+    return batch(sid, {'with': other_username, 'before': before, **page}, 'messages')
 
 @sio.on('typing')
 async def handle_typing(sid, data):
-    await sio.emit('typing', data, skip_sid=sid)
+    if not await within_rate_limit(sid, 'typing'):
+        return
+    # 只记录状态，由 flush_typing_state 周期性汇总广播
+    username = await backplane.username_of(sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if username and room and in_room(sid, room):
+        typing_aggregator.touch(room, username)
 
 @sio.on('stop typing')
 async def handle_stop_typing(sid, data):
-    await sio.emit('stop typing', data, skip_sid=sid)
+    username = await backplane.username_of(sid)
+    room = rooms.normalize_room((data or {}).get('room'))
+    if username and room:
+        typing_aggregator.stop(room, username)
 
 # -----------------
 # 7. 启动应用
@@ -296,6 +853,5 @@ async def handle_stop_typing(sid, data):
 app.mount('/socket.io', socket_app)
 
 if __name__ == '__main__':
-    init_db()
     # 使用 uvicorn 运行 FastAPI 应用
-    uvicorn.run("app_fastapi:app", host="0.0.0.0", port=5000, reload=True)
\ No newline at end of file
+    uvicorn.run("app_fastapi:app", host="0.0.0.0", port=config.PORT, reload=True)
\ No newline at end of file
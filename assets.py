@@ -0,0 +1,133 @@
+"""静态资源与页面外壳的缓存
+
+不需要构建步骤，进程启动时处理 static/ 下的所有文件：
+
+- 指纹：按内容哈希生成带指纹的文件名（script.<hash>.js），页面只引用带指纹的 URL。
+  内容一变 URL 就变，这些响应可以缓存一年（immutable），浏览器不再回源验证
+- 预压缩：文本类文件预先压缩成 gzip，安装了 brotli（pip install brotli）时再加一份 br，
+  保存在内存中，请求时按 Accept-Encoding 直接返回，不在每次请求时压缩
+- 不带指纹的原文件名仍然可以访问，但要求每次回源验证（no-cache + ETag）
+
+页面外壳（index.html）不再内嵌消息，只依赖传输格式和资源指纹，每个进程渲染一次，
+同样预压缩并带 ETag；消息由页面加载后请求 /history（JSON）。请求带 If-None-Match
+且与当前 ETag 相同时返回 304，不再传输页面内容。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    # 可选依赖，未安装时只提供 gzip
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# 同时接受时优先使用的编码
+_ENCODINGS = ('br', 'gzip')
+
+
+def _content_type(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith(('text/', 'application/javascript')):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def _accepted_encodings(accept_encoding):
+    """Accept-Encoding 中 q > 0 的编码"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            q = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            q = 0.0
+        if name.strip() and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _etag_matches(if_none_match, etag):
+    tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return '*' in tags or etag in tags
+
+
+class Resource:
+    """一个静态响应：原文、预压缩的版本和内容哈希"""
+
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()
+        self._variants = {None: body}
+        if content_type.startswith(_COMPRESSIBLE):
+            self._compress(body)
+
+    def _compress(self, body):
+        candidates = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            candidates['br'] = brotli.compress(body, quality=11)
+        for encoding, compressed in candidates.items():
+            # 很小的文件压缩后可能反而变大，只保留原文
+            if len(compressed) < len(body):
+                self._variants[encoding] = compressed
+
+    def respond(self, if_none_match=None, accept_encoding=None, cache_control=REVALIDATE):
+        """按请求头选出响应，返回 (状态码, 响应体, 响应头)"""
+        accepted = _accepted_encodings(accept_encoding)
+        encoding = next((name for name in _ENCODINGS if name in accepted and name in self._variants), None)
+        # 每种编码是不同的表示，ETag 也不同
+        etag = f'"{self.digest[:16]}-{encoding}"' if encoding else f'"{self.digest[:16]}"'
+        headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, b'', headers
+        headers['Content-Type'] = self.content_type
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return 200, self._variants[encoding], headers
+
+
+class AssetManifest:
+    """static/ 下所有文件的指纹与预压缩版本"""
+
+    def __init__(self, directory=STATIC_DIR):
+        self.directory = directory
+        # 原文件名 -> 带指纹的文件名
+        self._hashed = {}
+        # 文件名（带或不带指纹） -> (Resource, Cache-Control)
+        self._resources = {}
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    resource = Resource(f.read(), _content_type(name))
+                stem, suffix = os.path.splitext(name)
+                hashed = f'{stem}.{resource.digest[:12]}{suffix}'
+                self._hashed[name] = hashed
+                self._resources[name] = (resource, REVALIDATE)
+                self._resources[hashed] = (resource, IMMUTABLE)
+
+    def url(self, name):
+        """页面中引用的 URL，带指纹"""
+        return f'/static/{self._hashed.get(name, name)}'
+
+    def respond(self, name, if_none_match=None, accept_encoding=None):
+        """返回 (状态码, 响应体, 响应头)；文件不存在时返回 None"""
+        entry = self._resources.get(name)
+        if entry is None:
+            return None
+        resource, cache_control = entry
+        return resource.respond(if_none_match, accept_encoding, cache_control)
+
+
+def page_shell(html):
+    """渲染好的页面外壳；内容只在进程重启（资源或模板更新）时变化"""
+    return Resource(html.encode('utf-8'), 'text/html; charset=utf-8')
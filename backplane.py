@@ -0,0 +1,541 @@
+"""跨进程共享状态的后端（backplane）
+
+在线用户、私聊会话、在线列表版本号以及跨进程广播都通过这里完成，
+事件处理函数不再直接操作模块级的字典：
+
+- InMemoryBackplane：单进程部署，状态保存在进程内
+- RedisBackplane：多进程/多机部署，状态保存在 Redis 中，跨进程广播
+  交给 python-socketio 自带的 Redis client manager。本机测试时运行一个
+  redis-server（或任何兼容 Redis 协议的服务）即可。
+
+以上都是同步接口，给 eventlet 应用（app.py）使用。ASGI 应用（app_fastapi.py）通过
+create_async_backplane() 拿到协程版本：进程内实现直接调用，Redis 实现改用
+redis.asyncio 客户端，等待 Redis 时不阻塞事件循环。
+
+多进程部署时，负载均衡器需要开启会话粘滞（或客户端只用 websocket 传输）。
+
+进程崩溃时来不及释放自己的连接。RedisBackplane 为每个进程维护一个带 TTL 的心跳键，
+并记录每个连接所在的进程：心跳过期的进程上的连接在认领用户名和 is_online 时不算数，
+存活的进程在 heartbeat() 中把它们清理掉，按下线处理。
+"""
+import threading
+import uuid
+
+import config
+from presence import Claim, PresenceRegistry, Release
+from resume import FileResumeStore, RedisResumeStore
+
+
+class Backplane:
+    """backplane 接口"""
+
+    # 为 None 时 Socket.IO 只在本进程内广播
+    message_queue_url = None
+
+    def __init__(self):
+        # 标识当前进程，用于区分各进程各自汇总的数据（例如输入状态）
+        self.node_id = uuid.uuid4().hex[:12]
+
+    # --- 在线用户 ---
+    def claim(self, username, sid, token=None):
+        raise NotImplementedError
+
+    def release(self, sid):
+        raise NotImplementedError
+
+    def username_of(self, sid):
+        raise NotImplementedError
+
+    def is_online(self, username):
+        raise NotImplementedError
+
+    def usernames(self):
+        raise NotImplementedError
+
+    # --- 在线列表版本号 ---
+    def presence_version(self):
+        raise NotImplementedError
+
+    def next_presence_version(self):
+        raise NotImplementedError
+
+    # --- 私聊会话 ---
+    def private_partner(self, username):
+        """返回正在和 username 私聊的用户，没有则返回 None"""
+        raise NotImplementedError
+
+    def start_private_session(self, user1, user2):
+        """双方都空闲时原子地建立私聊会话，成功返回 True"""
+        raise NotImplementedError
+
+    def end_private_session(self, username):
+        """结束 username 所在的私聊会话，返回对方用户名或 None"""
+        raise NotImplementedError
+
+    def private_session_count(self):
+        """当前进行中的私聊会话数"""
+        raise NotImplementedError
+
+    # --- 重启后的会话恢复 ---
+    def local_sessions(self):
+        """本进程上在线的用户：{用户名: {'token': ..., 'partner': 私聊对象或 None}}"""
+        raise NotImplementedError
+
+    def resume_store(self):
+        """保存关闭前会话的 ResumeStore"""
+        raise NotImplementedError
+
+    # --- Socket.IO ---
+    def async_client_manager(self):
+        """给 socketio.AsyncServer 使用的 client manager，None 表示使用默认的进程内实现"""
+        return None
+
+    def heartbeat(self):
+        """续期本进程的心跳，清理已崩溃进程上的连接；返回因此下线的用户名"""
+        return []
+
+    def close(self):
+        """释放本进程持有的状态"""
+
+
+class InMemoryBackplane(Backplane):
+    """单进程实现"""
+
+    def __init__(self):
+        super().__init__()
+        self._registry = PresenceRegistry()
+        self._lock = threading.Lock()
+        self._private_sessions = {}
+        self._presence_version = 0
+
+    def claim(self, username, sid, token=None):
+        return self._registry.claim(username, sid, token)
+
+    def release(self, sid):
+        return self._registry.release(sid)
+
+    def username_of(self, sid):
+        return self._registry.username_of(sid)
+
+    def is_online(self, username):
+        return self._registry.is_online(username)
+
+    def usernames(self):
+        return self._registry.usernames()
+
+    def presence_version(self):
+        return self._presence_version
+
+    def next_presence_version(self):
+        with self._lock:
+            self._presence_version += 1
+            return self._presence_version
+
+    def private_partner(self, username):
+        return self._private_sessions.get(username)
+
+    def start_private_session(self, user1, user2):
+        with self._lock:
+            if user1 in self._private_sessions or user2 in self._private_sessions:
+                return False
+            self._private_sessions[user1] = user2
+            self._private_sessions[user2] = user1
+            return True
+
+    def end_private_session(self, username):
+        with self._lock:
+            other = self._private_sessions.pop(username, None)
+            if other is not None and self._private_sessions.get(other) == username:
+                del self._private_sessions[other]
+            return other
+
+    def private_session_count(self):
+        return len(self._private_sessions) // 2
+
+    def local_sessions(self):
+        return {username: {'token': self._registry.token_of(username),
+                           'partner': self._private_sessions.get(username)}
+                for username in self._registry.usernames()}
+
+    def resume_store(self):
+        return FileResumeStore()
+
+
+# 心跳键为 <进程键前缀><node_id>:alive；没有记录进程的连接（旧版本写入的）视为存活
+_NODE_ALIVE_LUA = """
+local function node_alive(node_prefix, node)
+    return not node or redis.call('EXISTS', node_prefix .. node .. ':alive') == 1
+end
+"""
+
+# KEYS: sid->username 哈希, 用户的 sid 集合, username->token 哈希, 在线用户集合, 本进程的 sid 集合,
+#       sid->进程 哈希, 进程集合
+# ARGV: username, sid, 客户端携带的 token（可为空）, 新生成的 token, 进程键前缀, 本进程 id, 心跳 TTL
+_CLAIM_SCRIPT = _NODE_ALIVE_LUA + """
+redis.call('SET', ARGV[5] .. ARGV[6] .. ':alive', 1, 'EX', ARGV[7])
+redis.call('SADD', KEYS[7], ARGV[6])
+local current = redis.call('HGET', KEYS[1], ARGV[2])
+if current and current ~= ARGV[1] then return nil end
+-- 已崩溃进程上残留的连接不再占用这个用户名
+for _, sid in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    if not node_alive(ARGV[5], redis.call('HGET', KEYS[6], sid)) then
+        redis.call('SREM', KEYS[2], sid)
+        redis.call('HDEL', KEYS[1], sid)
+        redis.call('HDEL', KEYS[6], sid)
+    end
+end
+if redis.call('SCARD', KEYS[2]) > 0 then
+    local owner = redis.call('HGET', KEYS[3], ARGV[1])
+    if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 0 and ARGV[3] ~= owner then return nil end
+    redis.call('SADD', KEYS[2], ARGV[2])
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[1])
+    redis.call('SADD', KEYS[5], ARGV[2])
+    redis.call('HSET', KEYS[6], ARGV[2], ARGV[6])
+    return {owner, 0}
+end
+local token = ARGV[4]
+if ARGV[3] ~= '' then token = ARGV[3] end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], token)
+redis.call('SADD', KEYS[4], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[2])
+redis.call('HSET', KEYS[6], ARGV[2], ARGV[6])
+return {token, 1}
+"""
+
+# KEYS: sid->username 哈希, 本进程的 sid 集合, username->token 哈希, 在线用户集合, sid->进程 哈希
+# ARGV: sid, 用户 sid 集合的 key 前缀
+_RELEASE_SCRIPT = """
+local username = redis.call('HGET', KEYS[1], ARGV[1])
+if not username then return nil end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+local user_key = ARGV[2] .. username
+redis.call('SREM', user_key, ARGV[1])
+if redis.call('SCARD', user_key) > 0 then return {username, 0} end
+redis.call('DEL', user_key)
+redis.call('HDEL', KEYS[3], username)
+redis.call('SREM', KEYS[4], username)
+return {username, 1}
+"""
+
+# KEYS: 用户的 sid 集合, sid->进程 哈希
+# ARGV: 进程键前缀
+_IS_ONLINE_SCRIPT = _NODE_ALIVE_LUA + """
+for _, sid in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if node_alive(ARGV[1], redis.call('HGET', KEYS[2], sid)) then return 1 end
+end
+return 0
+"""
+
+# 续期本进程的心跳，把心跳已过期的进程上的连接全部释放，返回因此下线的用户名
+# KEYS: 进程集合, sid->username 哈希, username->token 哈希, 在线用户集合, sid->进程 哈希
+# ARGV: 进程键前缀, 用户 sid 集合的 key 前缀, 本进程 id, 心跳 TTL
+_HEARTBEAT_SCRIPT = """
+redis.call('SET', ARGV[1] .. ARGV[3] .. ':alive', 1, 'EX', ARGV[4])
+redis.call('SADD', KEYS[1], ARGV[3])
+local offline = {}
+for _, node in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if redis.call('EXISTS', ARGV[1] .. node .. ':alive') == 0 then
+        local node_sids = ARGV[1] .. node .. ':sids'
+        for _, sid in ipairs(redis.call('SMEMBERS', node_sids)) do
+            local username = redis.call('HGET', KEYS[2], sid)
+            redis.call('HDEL', KEYS[2], sid)
+            redis.call('HDEL', KEYS[5], sid)
+            if username then
+                local user_key = ARGV[2] .. username
+                redis.call('SREM', user_key, sid)
+                if redis.call('SCARD', user_key) == 0 then
+                    redis.call('DEL', user_key)
+                    redis.call('HDEL', KEYS[3], username)
+                    redis.call('SREM', KEYS[4], username)
+                    table.insert(offline, username)
+                end
+            end
+        end
+        redis.call('DEL', node_sids)
+        redis.call('SREM', KEYS[1], node)
+    end
+end
+return offline
+"""
+
+_START_PRIVATE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 or redis.call('HEXISTS', KEYS[1], ARGV[2]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+_END_PRIVATE_SCRIPT = """
+local other = redis.call('HGET', KEYS[1], ARGV[1])
+if not other then return nil end
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HGET', KEYS[1], other) == ARGV[1] then redis.call('HDEL', KEYS[1], other) end
+return other
+"""
+
+
+class RedisBackplane(Backplane):
+    """多进程实现，所有状态变更都用 Lua 脚本在 Redis 中原子完成
+
+    调用是同步的，只在 eventlet 应用中直接使用（monkey patch 之后 socket 是非阻塞的）；
+    asyncio 应用使用 AsyncRedisBackplane，共用这里的键和脚本参数。
+    """
+
+    def __init__(self, url=None, prefix='chat', client=None):
+        super().__init__()
+        self.message_queue_url = url or config.REDIS_URL
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(self.message_queue_url, decode_responses=True)
+        self.redis = client
+        self._prefix = prefix
+        self._sids_key = f'{prefix}:sids'
+        self._tokens_key = f'{prefix}:tokens'
+        self._online_key = f'{prefix}:online'
+        self._user_sids_prefix = f'{prefix}:user_sids:'
+        self._nodes_key = f'{prefix}:nodes'
+        self._node_prefix = f'{prefix}:node:'
+        self._node_sids_key = f'{self._node_prefix}{self.node_id}:sids'
+        self._node_alive_key = f'{self._node_prefix}{self.node_id}:alive'
+        self._sid_nodes_key = f'{prefix}:sid_nodes'
+        self._node_ttl = config.BACKPLANE_NODE_TTL_S
+        self._private_key = f'{prefix}:private'
+        self._version_key = f'{prefix}:presence_version'
+        self._claim = self.redis.register_script(_CLAIM_SCRIPT)
+        self._release = self.redis.register_script(_RELEASE_SCRIPT)
+        self._is_online = self.redis.register_script(_IS_ONLINE_SCRIPT)
+        self._heartbeat = self.redis.register_script(_HEARTBEAT_SCRIPT)
+        self._start_private = self.redis.register_script(_START_PRIVATE_SCRIPT)
+        self._end_private = self.redis.register_script(_END_PRIVATE_SCRIPT)
+
+    # 各脚本的 keys/args，同步和异步实现共用
+    def _claim_call(self, username, sid, token):
+        return {'keys': [self._sids_key, self._user_sids_prefix + username, self._tokens_key,
+                         self._online_key, self._node_sids_key, self._sid_nodes_key, self._nodes_key],
+                'args': [username, sid, token if isinstance(token, str) else '',
+                         PresenceRegistry.new_token(), self._node_prefix, self.node_id, self._node_ttl]}
+
+    def _release_call(self, sid):
+        return {'keys': [self._sids_key, self._node_sids_key, self._tokens_key, self._online_key,
+                         self._sid_nodes_key],
+                'args': [sid, self._user_sids_prefix]}
+
+    def _is_online_call(self, username):
+        # 只看心跳仍然存活的进程上的连接
+        return {'keys': [self._user_sids_prefix + username, self._sid_nodes_key],
+                'args': [self._node_prefix]}
+
+    def _heartbeat_call(self):
+        return {'keys': [self._nodes_key, self._sids_key, self._tokens_key, self._online_key,
+                         self._sid_nodes_key],
+                'args': [self._node_prefix, self._user_sids_prefix, self.node_id, self._node_ttl]}
+
+    @staticmethod
+    def _claim_result(result):
+        return None if result is None else Claim(result[0], bool(result[1]))
+
+    @staticmethod
+    def _release_result(result):
+        return None if result is None else Release(result[0], bool(result[1]))
+
+    def claim(self, username, sid, token=None):
+        return self._claim_result(self._claim(**self._claim_call(username, sid, token)))
+
+    def release(self, sid):
+        return self._release_result(self._release(**self._release_call(sid)))
+
+    def username_of(self, sid):
+        return self.redis.hget(self._sids_key, sid)
+
+    def is_online(self, username):
+        return bool(self._is_online(**self._is_online_call(username)))
+
+    def usernames(self):
+        return list(self.redis.smembers(self._online_key))
+
+    def presence_version(self):
+        return int(self.redis.get(self._version_key) or 0)
+
+    def next_presence_version(self):
+        return self.redis.incr(self._version_key)
+
+    def private_partner(self, username):
+        return self.redis.hget(self._private_key, username)
+
+    def start_private_session(self, user1, user2):
+        return bool(self._start_private(keys=[self._private_key], args=[user1, user2]))
+
+    def end_private_session(self, username):
+        return self._end_private(keys=[self._private_key], args=[username])
+
+    def private_session_count(self):
+        return self.redis.hlen(self._private_key) // 2
+
+    def local_sessions(self):
+        sids = list(self.redis.smembers(self._node_sids_key))
+        usernames = set(filter(None, self.redis.hmget(self._sids_key, sids))) if sids else set()
+        sessions = {}
+        for username in usernames:
+            token = self.redis.hget(self._tokens_key, username)
+            if token:
+                sessions[username] = {'token': token, 'partner': self.private_partner(username)}
+        return sessions
+
+    def resume_store(self):
+        return RedisResumeStore(self.redis, self._prefix)
+
+    def async_client_manager(self):
+        import socketio
+        return socketio.AsyncRedisManager(self.message_queue_url)
+
+    def heartbeat(self):
+        return self._heartbeat(**self._heartbeat_call())
+
+    def close(self):
+        # 进程退出时释放本进程上的连接，避免其他进程把这些用户当作在线
+        for sid in self.redis.smembers(self._node_sids_key):
+            self.release(sid)
+        self.redis.delete(self._node_alive_key)
+        self.redis.srem(self._nodes_key, self.node_id)
+
+
+class AsyncBackplane:
+    """asyncio 应用使用的 backplane：方法与 Backplane 相同，但都是协程
+
+    这里包装进程内的实现，直接调用。同步的 backplane 保留在 sync 上，
+    给线程中执行的代码使用（例如关闭时保存会话）。
+    """
+
+    def __init__(self, backplane):
+        self.sync = backplane
+        self.node_id = backplane.node_id
+        self.message_queue_url = backplane.message_queue_url
+
+    async def claim(self, username, sid, token=None):
+        return self.sync.claim(username, sid, token)
+
+    async def release(self, sid):
+        return self.sync.release(sid)
+
+    async def username_of(self, sid):
+        return self.sync.username_of(sid)
+
+    async def is_online(self, username):
+        return self.sync.is_online(username)
+
+    async def usernames(self):
+        return self.sync.usernames()
+
+    async def presence_version(self):
+        return self.sync.presence_version()
+
+    async def next_presence_version(self):
+        return self.sync.next_presence_version()
+
+    async def private_partner(self, username):
+        return self.sync.private_partner(username)
+
+    async def start_private_session(self, user1, user2):
+        return self.sync.start_private_session(user1, user2)
+
+    async def end_private_session(self, username):
+        return self.sync.end_private_session(username)
+
+    async def private_session_count(self):
+        return self.sync.private_session_count()
+
+    async def heartbeat(self):
+        return self.sync.heartbeat()
+
+    def resume_store(self):
+        return self.sync.resume_store()
+
+    def async_client_manager(self):
+        return self.sync.async_client_manager()
+
+    async def close(self):
+        self.sync.close()
+
+
+class AsyncRedisBackplane(AsyncBackplane):
+    """RedisBackplane 的协程版本：同样的键和 Lua 脚本，用 redis.asyncio 客户端执行"""
+
+    def __init__(self, backplane, client=None):
+        super().__init__(backplane)
+        if client is None:
+            import redis.asyncio
+            client = redis.asyncio.Redis.from_url(backplane.message_queue_url, decode_responses=True)
+        self.redis = client
+        self._claim = client.register_script(_CLAIM_SCRIPT)
+        self._release = client.register_script(_RELEASE_SCRIPT)
+        self._is_online = client.register_script(_IS_ONLINE_SCRIPT)
+        self._heartbeat = client.register_script(_HEARTBEAT_SCRIPT)
+        self._start_private = client.register_script(_START_PRIVATE_SCRIPT)
+        self._end_private = client.register_script(_END_PRIVATE_SCRIPT)
+
+    async def claim(self, username, sid, token=None):
+        return self.sync._claim_result(await self._claim(**self.sync._claim_call(username, sid, token)))
+
+    async def release(self, sid):
+        return self.sync._release_result(await self._release(**self.sync._release_call(sid)))
+
+    async def username_of(self, sid):
+        return await self.redis.hget(self.sync._sids_key, sid)
+
+    async def is_online(self, username):
+        return bool(await self._is_online(**self.sync._is_online_call(username)))
+
+    async def usernames(self):
+        return list(await self.redis.smembers(self.sync._online_key))
+
+    async def presence_version(self):
+        return int(await self.redis.get(self.sync._version_key) or 0)
+
+    async def next_presence_version(self):
+        return await self.redis.incr(self.sync._version_key)
+
+    async def private_partner(self, username):
+        return await self.redis.hget(self.sync._private_key, username)
+
+    async def start_private_session(self, user1, user2):
+        return bool(await self._start_private(keys=[self.sync._private_key], args=[user1, user2]))
+
+    async def end_private_session(self, username):
+        return await self._end_private(keys=[self.sync._private_key], args=[username])
+
+    async def private_session_count(self):
+        return await self.redis.hlen(self.sync._private_key) // 2
+
+    async def heartbeat(self):
+        return await self._heartbeat(**self.sync._heartbeat_call())
+
+    async def close(self):
+        for sid in await self.redis.smembers(self.sync._node_sids_key):
+            await self.release(sid)
+        await self.redis.delete(self.sync._node_alive_key)
+        await self.redis.srem(self.sync._nodes_key, self.node_id)
+        await self.redis.aclose()
+
+
+def create_async_backplane(backplane=None):
+    """asyncio 应用使用的 backplane，包装 create_backplane() 的结果"""
+    backplane = backplane or create_backplane()
+    if isinstance(backplane, RedisBackplane):
+        return AsyncRedisBackplane(backplane)
+    return AsyncBackplane(backplane)
+
+
+def create_backplane(kind=None):
+    """按配置创建 backplane"""
+    kind = kind or config.BACKPLANE
+    if kind == 'memory':
+        return InMemoryBackplane()
+    if kind == 'redis':
+        return RedisBackplane()
+    raise ValueError(f'unknown backplane: {kind}')
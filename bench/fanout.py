@@ -0,0 +1,142 @@
+"""广播扇出的微基准
+
+对 N 个假连接广播一条聊天消息，比较：
+
+- library：python-socketio 自带的 AsyncServer.emit（每个接收者一个 task），
+  再为指标统计序列化一次负载（本项目之前的做法）
+- once：broadcast.encode_event 只编码一次，逐个写入接收者的发送队列，
+  字节数直接取自编码结果
+
+以及标准库 json 与 orjson 两种编码器。假连接在“发送”时把 Engine.IO 包
+编码成 UTF-8 字节，模拟 websocket 写出的开销，不涉及真实网络。
+
+用法：
+    python bench/fanout.py
+    python bench/fanout.py --recipients 100 1000 5000 --rounds 200
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import socketio  # noqa: E402
+
+import broadcast  # noqa: E402
+from instrumentation import payload_size  # noqa: E402
+from serializers import json_module  # noqa: E402
+
+TEXTS = {
+    'cjk': '今天下午三点在三楼会议室开会，记得带上周的数据报表。' * 2,
+    'ascii': 'Meeting moved to 3pm in room 301, please bring last week\'s numbers. ' * 2,
+}
+
+
+def make_message(text, message_id):
+    return {
+        'username': 'bench-user',
+        'message': text,
+        'room': 'general',
+        'timestamp': '15:04',
+        'created_at': 1700000000000,
+        'id': message_id,
+    }
+
+
+class FakeSockets:
+    """代替 Engine.IO 服务端的 send_packet，只做编码并累计字节数"""
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.packets = 0
+
+    async def send_packet(self, eio_sid, pkt):
+        self.bytes_sent += len(pkt.encode().encode())
+        self.packets += 1
+
+
+async def make_server(json_backend, recipients):
+    sio = socketio.AsyncServer(async_mode='asgi', json=json_module(json_backend))
+    sockets = FakeSockets()
+    sio.eio.send_packet = sockets.send_packet
+    for i in range(recipients):
+        await sio.manager.connect(f'eio-{i}', '/')
+    return sio, sockets
+
+
+async def emit_library(sio, data):
+    payload_size(data)
+    await sio.emit('chat message', data)
+
+
+async def emit_once(sio, data):
+    eio_pkt, size = broadcast.encode_event(sio.packet_class, 'chat message', data, '/')
+    for eio_sid in broadcast.recipients(sio.manager, '/', None, None):
+        await sio._send_eio_packet(eio_sid, eio_pkt)
+
+
+VARIANTS = {'library': emit_library, 'once': emit_once}
+
+
+async def measure(variant, json_backend, recipients, rounds, text):
+    sio, sockets = await make_server(json_backend, recipients)
+    emit = VARIANTS[variant]
+    await emit(sio, make_message(text, 0))
+    sockets.bytes_sent = 0
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for i in range(rounds):
+        await emit(sio, make_message(text, i))
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return {
+        'variant': variant,
+        'json': json_backend,
+        'recipients': recipients,
+        'cpu_us_per_fanout': cpu / rounds * 1e6,
+        'cpu_us_per_recipient': cpu / rounds / recipients * 1e6,
+        'bytes_per_recipient': sockets.bytes_sent / rounds / recipients,
+        'mb_per_second': sockets.bytes_sent / wall / 1e6,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--recipients', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--json', nargs='+', default=['json', 'orjson'], choices=['json', 'orjson'])
+    parser.add_argument('--text', choices=sorted(TEXTS), default='cjk',
+                        help='消息正文：中文在标准库 json 下会被转义成 \\uXXXX，orjson 直接输出 UTF-8')
+    parser.add_argument('--save', help='把结果保存为 JSON')
+    return parser.parse_args(argv)
+
+
+async def run(args):
+    results = []
+    for recipients in args.recipients:
+        for json_backend in args.json:
+            for variant in VARIANTS:
+                results.append(await measure(variant, json_backend, recipients, args.rounds,
+                                             TEXTS[args.text]))
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print(f'{"recipients":>10} {"json":>7} {"variant":>8} {"cpu us/fanout":>14} '
+          f'{"cpu us/recipient":>17} {"bytes/recipient":>16} {"MB/s":>8}')
+    for row in results:
+        print(f'{row["recipients"]:>10} {row["json"]:>7} {row["variant"]:>8} '
+              f'{row["cpu_us_per_fanout"]:>14.1f} {row["cpu_us_per_recipient"]:>17.3f} '
+              f'{row["bytes_per_recipient"]:>16.0f} {row["mb_per_second"]:>8.1f}')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
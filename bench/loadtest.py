@@ -0,0 +1,428 @@
+"""聊天服务器压测脚本
+
+在本机启动 app.py（eventlet）或 app_fastapi.py（ASGI），用 K 个模拟的
+Socket.IO 客户端依次跑以下场景：
+
+- join：所有客户端同时连接并加入
+- chat：每个客户端按固定速率发公共消息，统计端到端投递延迟
+- typing：所有客户端持续发送 typing 事件
+- private：两两发起私聊握手，然后互发私信
+- storm：所有客户端同时断线再同时重连加入
+
+报告吞吐、p50/p95/p99 延迟、服务端 CPU 和 RSS（读 /proc）、数据库写入速率。
+每次运行使用临时数据库，不依赖网络。
+
+服务端默认的限流（CHAT_RATE_LIMITS，例如 typing=2:5）低于压测的发送速率
+（typing 场景每个客户端每秒 10 次），超出的事件会被丢弃，测到的就只是限流。
+所以压测时服务端使用 --rate-limits 给出的宽松预算（默认 BENCH_RATE_LIMITS），
+限流的开销仍然计入；要按线上的限流压测，传 --rate-limits ''（使用服务端默认值）。
+
+用法：
+    python bench/loadtest.py --server fastapi --clients 200
+    python bench/loadtest.py --server flask --save bench/results/flask.json
+    python bench/loadtest.py --server fastapi --baseline bench/results/fastapi.json
+
+需要额外安装客户端依赖：pip install "python-socketio[asyncio_client]" aiohttp
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import socketio
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ['join', 'chat', 'typing', 'private', 'storm']
+BENCH_PREFIX = 'bench|'
+# 压测时服务端的限流预算，远高于各场景的发送速率
+BENCH_RATE_LIMITS = 'chat message=1000:1000,private_message=1000:1000,typing=1000:1000,search=1000:1000'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ServerProcess:
+    """在子进程中启动聊天服务器，并从 /proc 读取其 CPU 与内存"""
+
+    def __init__(self, kind, port, db_path, extra_env=None):
+        self.kind = kind
+        self.port = port
+        self.db_path = db_path
+        # 停止时用 SIGINT 触发优雅关闭，保存的会话也写到临时目录里，不留在仓库中
+        resume_path = os.path.join(os.path.dirname(db_path), 'resume_state.json')
+        self.env = dict(os.environ, CHAT_DB_PATH=db_path, CHAT_PORT=str(port),
+                        CHAT_RESUME_STATE_PATH=resume_path, **(extra_env or {}))
+        self.process = None
+        self.peak_rss = 0
+
+    def start(self):
+        if self.kind == 'flask':
+            command = [sys.executable, 'app.py']
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'app_fastapi:app',
+                       '--host', '127.0.0.1', '--port', str(self.port), '--log-level', 'warning']
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, cwd=ROOT, env=self.env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                self.log.seek(0)
+                raise RuntimeError(f'server exited early:\n{self.log.read().decode(errors="replace")}')
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=0.2):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('server did not start listening in time')
+
+    def sample(self):
+        """返回 (累计 CPU 秒数, 当前 RSS 字节数)"""
+        pid = self.process.pid
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        rss = 0
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+        self.peak_rss = max(self.peak_rss, rss)
+        return cpu, rss
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def row_count(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return sum(conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                       for table in ('messages', 'private_messages'))
+
+
+class Recorder:
+    """收集延迟样本和计数"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.counts = {}
+
+    def latency(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def reset(self):
+        self.latencies.clear()
+        self.counts.clear()
+
+
+def stamp():
+    return f'{BENCH_PREFIX}{time.perf_counter()}'
+
+
+def elapsed_since(message):
+    if isinstance(message, str) and message.startswith(BENCH_PREFIX):
+        return time.perf_counter() - float(message[len(BENCH_PREFIX):])
+    return None
+
+
+class BenchClient:
+    """一个模拟用户"""
+
+    def __init__(self, index, url, recorder):
+        self.index = index
+        self.url = url
+        self.username = f'bench-{index}'
+        self.recorder = recorder
+        self.token = None
+        self.sio = None
+        self.joined = None
+        self.private_started = None
+        self._join_started = None
+        self._private_requested = None
+
+    def _new_client(self):
+        sio = socketio.AsyncClient(reconnection=False)
+        recorder = self.recorder
+
+        @sio.on('join successful')
+        async def on_join(data):
+            self.token = data.get('token')
+            recorder.latency('join', time.perf_counter() - self._join_started)
+            self.joined.set()
+
+        @sio.on('chat message')
+        async def on_chat(data):
+            seconds = elapsed_since(data.get('message'))
+            if seconds is not None:
+                recorder.latency('chat', seconds)
+                recorder.count('chat_delivered')
+
+        @sio.on('private_chat_request')
+        async def on_private_request(data):
+            await sio.emit('private_chat_accepted', {'sender_username': data['sender_username']})
+
+        @sio.on('private_chat_started')
+        async def on_private_started(data):
+            if self._private_requested is not None:
+                recorder.latency('private_handshake', time.perf_counter() - self._private_requested)
+                self._private_requested = None
+            self.private_started.set()
+
+        @sio.on('private_message')
+        async def on_private_message(data):
+            seconds = elapsed_since(data.get('message'))
+            if seconds is not None:
+                recorder.latency('private', seconds)
+                recorder.count('private_delivered')
+
+        @sio.on('missed_private_messages')
+        async def on_missed(chunk):
+            await sio.emit('missed_private_messages_ack', {'ids': [m['id'] for m in chunk['messages']]})
+
+        @sio.on('*')
+        async def on_other(event, *args):
+            recorder.count(f'recv:{event}')
+
+        return sio
+
+    async def connect_and_join(self):
+        self.sio = self._new_client()
+        self.joined = asyncio.Event()
+        self.private_started = asyncio.Event()
+        await self.sio.connect(self.url, transports=['websocket'])
+        self._join_started = time.perf_counter()
+        await self.sio.emit('user joined', {'username': self.username, 'token': self.token})
+        await self.joined.wait()
+
+    async def request_private_chat(self, other):
+        self._private_requested = time.perf_counter()
+        await self.sio.emit('private_chat_request', {'recipient_username': other.username})
+
+    async def disconnect(self):
+        if self.sio is not None and self.sio.connected:
+            await self.sio.disconnect()
+
+
+async def scenario_join(clients, args, recorder):
+    await asyncio.gather(*(client.connect_and_join() for client in clients))
+    return {'joined': len(clients)}
+
+
+async def scenario_chat(clients, args, recorder):
+    async def sender(client):
+        interval = 1 / args.rate
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            await client.sio.emit('chat message', {'username': client.username, 'message': stamp()})
+            recorder.count('chat_sent')
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*(sender(client) for client in clients))
+    await asyncio.sleep(args.drain)
+    return {}
+
+
+async def scenario_typing(clients, args, recorder):
+    async def typist(client):
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            await client.sio.emit('typing', {'username': client.username})
+            recorder.count('typing_sent')
+            await asyncio.sleep(0.1)
+        await client.sio.emit('stop typing', {'username': client.username})
+
+    await asyncio.gather(*(typist(client) for client in clients))
+    await asyncio.sleep(args.drain)
+    return {}
+
+
+async def scenario_private(clients, args, recorder):
+    pairs = list(zip(clients[0::2], clients[1::2]))
+    await asyncio.gather(*(a.request_private_chat(b) for a, b in pairs))
+    await asyncio.wait_for(asyncio.gather(*(a.private_started.wait() for a, _ in pairs)), 30)
+
+    async def talk(sender, receiver):
+        for _ in range(args.private_messages):
+            await sender.sio.emit('private_message', {'receiver_username': receiver.username,
+                                                      'message': stamp()})
+            recorder.count('private_sent')
+            await asyncio.sleep(1 / args.rate)
+
+    await asyncio.gather(*(talk(a, b) for a, b in pairs), *(talk(b, a) for a, b in pairs))
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*(a.sio.emit('private_chat_ended', {}) for a, _ in pairs))
+    await asyncio.sleep(0.5)
+    return {'pairs': len(pairs)}
+
+
+async def scenario_storm(clients, args, recorder):
+    await asyncio.gather(*(client.disconnect() for client in clients))
+    start = time.perf_counter()
+    await asyncio.gather(*(client.connect_and_join() for client in clients))
+    return {'rejoin_all_seconds': time.perf_counter() - start}
+
+
+SCENARIO_FUNCS = {
+    'join': scenario_join,
+    'chat': scenario_chat,
+    'typing': scenario_typing,
+    'private': scenario_private,
+    'storm': scenario_storm,
+}
+
+
+async def sample_rss(server, stop):
+    while not stop.is_set():
+        server.sample()
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_scenario(name, clients, args, server, recorder):
+    recorder.reset()
+    server.peak_rss = 0
+    rows_before = server.row_count()
+    cpu_before, _ = server.sample()
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(server, stop))
+    start = time.perf_counter()
+    extra = await SCENARIO_FUNCS[name](clients, args, recorder)
+    wall = time.perf_counter() - start
+    stop.set()
+    await sampler
+    cpu_after, _ = server.sample()
+    rows_after = server.row_count()
+
+    result = {
+        'wall_seconds': wall,
+        'server_cpu_percent': (cpu_after - cpu_before) / wall * 100,
+        'server_peak_rss_mb': server.peak_rss / 1024 / 1024,
+        'db_rows_per_second': (rows_after - rows_before) / wall,
+        'counts': dict(recorder.counts),
+        **extra,
+    }
+    for key in ('chat_delivered', 'private_delivered'):
+        if key in recorder.counts:
+            result[f'{key}_per_second'] = recorder.counts[key] / wall
+    for metric, values in recorder.latencies.items():
+        result[f'{metric}_latency_ms'] = {
+            'p50': percentile(values, 0.50) * 1000,
+            'p95': percentile(values, 0.95) * 1000,
+            'p99': percentile(values, 0.99) * 1000,
+            'samples': len(values),
+        }
+    return result
+
+
+async def run(args):
+    port = args.port or free_port()
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    extra_env = {'CHAT_RATE_LIMITS': args.rate_limits} if args.rate_limits else None
+    server = ServerProcess(args.server, port, os.path.join(workdir, 'chat.db'), extra_env)
+    server.start()
+    recorder = Recorder()
+    url = f'http://127.0.0.1:{port}'
+    clients = [BenchClient(i, url, recorder) for i in range(args.clients)]
+    results = {'server': args.server, 'clients': args.clients, 'scenarios': {}}
+    try:
+        scenarios = args.scenarios
+        if 'join' not in scenarios:
+            await scenario_join(clients, args, recorder)
+        for name in scenarios:
+            print(f'running {name} ...', file=sys.stderr)
+            results['scenarios'][name] = await run_scenario(name, clients, args, server, recorder)
+    finally:
+        await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+        server.stop()
+    return results
+
+
+def flatten(results):
+    """把结果展开成 {'chat.chat_latency_ms.p99': 值} 的形式，便于打印和对比"""
+    flat = {}
+    for scenario, metrics in results['scenarios'].items():
+        for key, value in metrics.items():
+            if key == 'counts':
+                continue
+            if isinstance(value, dict):
+                for sub, sub_value in value.items():
+                    if sub != 'samples':
+                        flat[f'{scenario}.{key}.{sub}'] = sub_value
+            else:
+                flat[f'{scenario}.{key}'] = value
+    return flat
+
+
+def report(results, baseline=None):
+    current = flatten(results)
+    previous = flatten(baseline) if baseline else {}
+    width = max(len(key) for key in current) if current else 10
+    print(f'server={results["server"]} clients={results["clients"]}')
+    for key, value in current.items():
+        line = f'{key:<{width}}  {value:>12.2f}'
+        if key in previous and previous[key]:
+            change = (value - previous[key]) / previous[key] * 100
+            line += f'  baseline {previous[key]:>12.2f}  ({change:+.1f}%)'
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--server', choices=['flask', 'fastapi'], default='fastapi')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='chat/typing 场景的持续秒数')
+    parser.add_argument('--rate', type=float, default=2, help='每个客户端每秒发送的消息数')
+    parser.add_argument('--private-messages', type=int, default=20, help='私聊场景中每人发送的私信数')
+    parser.add_argument('--drain', type=float, default=2, help='发送结束后等待投递完成的秒数')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--rate-limits', default=BENCH_RATE_LIMITS,
+                        help="服务端的 CHAT_RATE_LIMITS；传 '' 使用服务端默认的限流")
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--save', help='把结果保存为 JSON，作为之后对比的基线')
+    parser.add_argument('--baseline', help='与之前保存的 JSON 结果对比')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""传输格式的微基准
+
+把典型负载按不同格式编码成 Socket.IO 帧，比较帧大小和 CPU 开销：
+
+- 负载：离线私信的一块（backlog）、历史的一页（history）、单条聊天消息（chat）
+- 格式：json 与 msgpack（CHAT_WIRE_FORMAT），批量负载再分别比较逐行字典与列式编码
+  （batch_encoding='columnar'）
+- 压缩：permessage-deflate 的两种情况，每帧独立压缩（no_context_takeover）和
+  沿用上一帧的压缩上下文（浏览器与服务端的默认协商结果）
+
+压缩在每个连接上分别进行，广播时 deflate 的 CPU 开销要乘以接收者数，
+而编码只做一次（见 bench/fanout.py）。不涉及真实网络。
+
+用法：
+    python bench/wire.py
+    python bench/wire.py --rounds 2000 --save bench/results/wire.json
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from socketio import packet  # noqa: E402
+
+import broadcast  # noqa: E402
+from serializers import encode_batch  # noqa: E402
+
+PHRASES = [
+    '今天下午三点在三楼会议室开会', '记得带上周的数据报表', '收到，马上过去', '晚上一起吃饭吗',
+    '文档已经更新，麻烦再看一下', '这个问题我明天再跟进', '好的没问题', '刚才的链接打不开',
+]
+USERS = ['alice', 'bob', 'carol', 'dave', '小王']
+# 常用字，用来生成不重复的句子，避免压缩率被固定短语夸大
+COMMON_CHARS = ('的一是在不了有和人这中大为上个我以要他时来用们生到作地于出就分对成会可主发年动同工'
+                '也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起'
+                '小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事')
+
+
+def _text(rng):
+    parts = [rng.choice(PHRASES)]
+    parts.append(''.join(rng.choice(COMMON_CHARS) for _ in range(rng.randint(4, 20))))
+    rng.shuffle(parts)
+    return '，'.join(parts)
+
+
+def backlog_chunk(rng, size=100):
+    """离线私信的一块，与 offline_delivery.fetch_unread 的结构相同"""
+    messages = [{
+        'id': 1000 + i,
+        'sender_username': rng.choice(USERS[1:]),
+        'receiver_username': USERS[0],
+        'message': _text(rng),
+        'timestamp': f'2024-05-{10 + i // 40:02d} {9 + i % 10:02d}:{i % 60:02d}:00',
+    } for i in range(size)]
+    return 'missed_private_messages', {'messages': messages, 'has_more': True}, 'messages'
+
+
+def history_page(rng, size=50):
+    """历史的一页，与 history.fetch_page 的结构相同"""
+    messages = [{
+        'id': 5000 + i,
+        'username': rng.choice(USERS),
+        'message': _text(rng),
+        'timestamp': f'{9 + i % 10:02d}:{i % 60:02d}',
+        'created_at': 1715300000000 + i * 60000,
+        'room': 'general',
+    } for i in range(size)]
+    return 'missed_messages', {'room': 'general', 'messages': messages, 'has_more': False}, 'messages'
+
+
+def chat_message(rng):
+    return 'chat message', {'id': 9000, 'username': 'alice', 'message': _text(rng), 'room': 'general',
+                            'timestamp': '15:04', 'created_at': 1715300000000}, None
+
+
+PAYLOADS = {'backlog': backlog_chunk, 'history': history_page, 'chat': chat_message}
+
+
+def packet_class(wire_format):
+    if wire_format == 'msgpack':
+        from socketio.msgpack_packet import MsgPackPacket
+        return MsgPackPacket
+    return packet.Packet
+
+
+def frame_bytes(eio_pkt):
+    """websocket 上实际写出的帧内容"""
+    encoded = eio_pkt.encode()
+    return encoded if isinstance(encoded, bytes) else encoded.encode()
+
+
+def deflate(compressor, data):
+    # permessage-deflate 去掉同步刷新末尾的 00 00 ff ff
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)[:-4]
+
+
+def new_compressor():
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def measure(payload_name, wire_format, columnar, rounds, seed):
+    rng = random.Random(seed)
+    cls = packet_class(wire_format)
+    payloads = [PAYLOADS[payload_name](rng) for _ in range(rounds)]
+
+    start = time.process_time()
+    frames = []
+    for event, data, key in payloads:
+        if key is not None:
+            data = encode_batch(data, key, columnar)
+        eio_pkt, _ = broadcast.encode_event(cls, event, data, '/')
+        frames.append(frame_bytes(eio_pkt))
+    encode_cpu = time.process_time() - start
+
+    start = time.process_time()
+    fresh = sum(len(deflate(new_compressor(), frame)) for frame in frames)
+    deflate_cpu = time.process_time() - start
+
+    compressor = new_compressor()
+    shared = sum(len(deflate(compressor, frame)) for frame in frames)
+    return {
+        'payload': payload_name,
+        'format': wire_format + ('+columnar' if columnar else ''),
+        'bytes': sum(len(frame) for frame in frames) / rounds,
+        'deflate_bytes': fresh / rounds,
+        'deflate_context_bytes': shared / rounds,
+        'encode_us': encode_cpu / rounds * 1e6,
+        'deflate_us': deflate_cpu / rounds * 1e6,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--payloads', nargs='+', choices=sorted(PAYLOADS), default=list(PAYLOADS))
+    parser.add_argument('--formats', nargs='+', choices=['json', 'msgpack'], default=['json', 'msgpack'])
+    parser.add_argument('--rounds', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='把结果保存为 JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for payload_name in args.payloads:
+        batched = PAYLOADS[payload_name](random.Random(args.seed))[2] is not None
+        for wire_format in args.formats:
+            for columnar in ((False, True) if batched else (False,)):
+                results.append(measure(payload_name, wire_format, columnar, args.rounds, args.seed))
+    print(f'{"payload":>8} {"format":>17} {"bytes":>8} {"saved":>6} {"deflate":>8} {"saved":>6} '
+          f'{"deflate ctx":>11} {"encode us":>10} {"deflate us":>11}')
+    baseline = {}
+    for row in results:
+        base = baseline.setdefault(row['payload'], row)
+        print(f'{row["payload"]:>8} {row["format"]:>17} {row["bytes"]:>8.0f} '
+              f'{1 - row["bytes"] / base["bytes"]:>6.0%} {row["deflate_bytes"]:>8.0f} '
+              f'{1 - row["deflate_bytes"] / base["bytes"]:>6.0%} {row["deflate_context_bytes"]:>11.0f} '
+              f'{row["encode_us"]:>10.1f} {row["deflate_us"]:>11.1f}')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
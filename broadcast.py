@@ -0,0 +1,159 @@
+"""只序列化一次的广播
+
+python-socketio 的 manager 对一次 emit 只编码一次 Socket.IO 包，但异步版本
+会为每个接收者创建一个 task；指标统计还需要再序列化一次负载来计算字节数。
+这里把一次 emit 编码成带缓存的 Engine.IO 包，所有接收者复用同一个编码结果，
+字节数直接取自编码结果，再逐个写入接收者的发送队列。
+
+只用于进程内的 manager；跨进程的 pub/sub manager 仍走原来的 emit，
+由各进程在收到消息后各自编码一次。
+
+发送前按接收者发送队列的积压做背压：积压超过 drop_backlog 时丢弃可丢弃的
+事件（输入状态），超过 max_backlog 时认为客户端已无法跟上，丢弃积压并断开，
+避免一个慢客户端的队列无限增长。
+
+这两件事都依赖库的内部接口：Server._send_eio_packet 以及 Engine.IO Socket 的
+queue（qsize/get_nowait/task_done）。requirements.txt 固定了验证过的版本，
+启动时由 fast_path_supported 检查；库升级后版本对不上时退回公开的 emit，
+此时没有背压，直到重新验证并更新 TESTED_VERSIONS。
+"""
+import base64
+from importlib import metadata
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+import config
+
+# 积压过多时可以丢弃的事件：输入状态下一个周期还会再广播
+DROPPABLE_EVENTS = frozenset({'typing_state'})
+
+# 验证过内部接口的库版本，与 requirements.txt 保持一致
+TESTED_VERSIONS = {'python-socketio': '5.11.4', 'python-engineio': '4.9.0'}
+
+
+def _installed_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def fast_path_supported(server):
+    """server（socketio.Server 或 AsyncServer）能否走只编码一次和背压的发送路径"""
+    mismatched = {name: _installed_version(name) for name, version in TESTED_VERSIONS.items()
+                  if _installed_version(name) != version}
+    if mismatched:
+        print('Encode-once broadcast disabled, untested library versions:', mismatched)
+        return False
+    if not callable(getattr(server, '_send_eio_packet', None)):
+        print('Encode-once broadcast disabled, Server._send_eio_packet is missing')
+        return False
+    return True
+
+
+class _BinaryPacket(eio_packet.Packet):
+    """MessagePack 编码的 Engine.IO 包
+
+    Engine.IO 包只缓存第一次 encode() 的结果，而二进制包在 websocket 上发原始字节、
+    在长轮询里发 base64 文本；同一个包要发给不同传输方式的接收者，两种结果分开缓存。
+    """
+
+    def encode(self, b64=False):
+        if not b64:
+            return self.data
+        if self.encode_cache is None:
+            self.encode_cache = 'b' + base64.b64encode(self.data).decode('ascii')
+        return self.encode_cache
+
+
+def encode_event(packet_class, event, data, namespace):
+    """把一次 emit 编码成 Engine.IO 包，返回 (包, 字节数)；负载含二进制数据时返回 None"""
+    if isinstance(data, tuple):
+        args = list(data)
+    elif data is not None:
+        args = [data]
+    else:
+        args = []
+    encoded = packet_class(packet.EVENT, namespace=namespace, data=[event] + args).encode()
+    if isinstance(encoded, list):
+        return None
+    if isinstance(encoded, bytes):
+        return _BinaryPacket(eio_packet.MESSAGE, encoded), len(encoded)
+    eio_pkt = eio_packet.Packet(eio_packet.MESSAGE, encoded)
+    # Engine.IO 包会缓存第一次 encode() 的结果，之后每个接收者直接复用
+    size = len(eio_pkt.encode().encode())
+    return eio_pkt, size
+
+
+def recipients(manager, namespace, room, skip_sid):
+    """本进程内这次 emit 的接收者（Engine.IO sid 列表）"""
+    if not isinstance(skip_sid, list):
+        skip_sid = [skip_sid]
+    return [eio_sid for sid, eio_sid in manager.get_participants(namespace, room)
+            if sid not in skip_sid]
+
+
+def _discard_backlog(queue):
+    while not queue.empty():
+        queue.get_nowait()
+        queue.task_done()
+
+
+class Backpressure:
+    """按接收者发送队列的积压决定发送、丢弃还是断开"""
+
+    def __init__(self, drop_backlog=None, max_backlog=None, droppable=DROPPABLE_EVENTS):
+        self.drop_backlog = config.OUTBOUND_DROP_BACKLOG if drop_backlog is None else drop_backlog
+        self.max_backlog = config.OUTBOUND_MAX_BACKLOG if max_backlog is None else max_backlog
+        self.droppable = droppable
+        # 已安排断开、还没真正关闭的连接，避免重复断开
+        self._aborting = set()
+
+    def split(self, eio_server, targets, event):
+        """返回 (要发送的接收者, 因积压丢弃的数量, 需要断开的接收者)"""
+        droppable = event in self.droppable
+        sockets = eio_server.sockets
+        deliver = []
+        slow = []
+        dropped = 0
+        for eio_sid in targets:
+            socket = sockets.get(eio_sid)
+            backlog = socket.queue.qsize() if socket is not None else 0
+            if backlog >= self.max_backlog:
+                dropped += 1
+                if eio_sid not in self._aborting and not (socket.closing or socket.closed):
+                    self._aborting.add(eio_sid)
+                    slow.append(eio_sid)
+            elif droppable and backlog >= self.drop_backlog:
+                dropped += 1
+            else:
+                deliver.append(eio_sid)
+        return deliver, dropped, slow
+
+    def abort(self, eio_server, eio_sid):
+        """断开跟不上的连接：丢弃积压的包，不等它们发完"""
+        try:
+            socket = eio_server.sockets.get(eio_sid)
+            if socket is None or socket.closing or socket.closed:
+                return
+            _discard_backlog(socket.queue)
+            # 同步版本的 close 会放入结束标记，写出循环随之退出并关闭 websocket
+            socket.close(wait=False, abort=True)
+            eio_server.sockets.pop(eio_sid, None)
+        finally:
+            self._aborting.discard(eio_sid)
+
+    async def async_abort(self, eio_server, eio_sid):
+        """abort 的 asyncio 版本"""
+        try:
+            socket = eio_server.sockets.get(eio_sid)
+            if socket is None or socket.closing or socket.closed:
+                return
+            _discard_backlog(socket.queue)
+            await socket.close(wait=False, abort=True)
+            # 异步版本的 close 不放结束标记，需要手动放入让写出任务退出
+            socket.queue.put_nowait(None)
+            eio_server.sockets.pop(eio_sid, None)
+        finally:
+            self._aborting.discard(eio_sid)
@@ -0,0 +1,87 @@
+"""聊天室运行配置，所有项都可以通过环境变量覆盖"""
+import os
+
+DB_PATH = os.environ.get('CHAT_DB_PATH', 'chat.db')
+PORT = int(os.environ.get('CHAT_PORT', '5000'))
+
+# 消息存储后端：'write_behind'（后台线程攒批提交）或 'sync'（每条消息同步提交）
+STORE_BACKEND = os.environ.get('CHAT_STORE_BACKEND', 'write_behind')
+# 攒够多少行或等待多少毫秒后提交一次事务
+STORE_BATCH_SIZE = int(os.environ.get('CHAT_STORE_BATCH_SIZE', '100'))
+STORE_BATCH_INTERVAL_MS = int(os.environ.get('CHAT_STORE_BATCH_INTERVAL_MS', '20'))
+# 持久化策略：'commit' 表示落盘后再广播，'enqueue' 表示入队后立即广播
+STORE_DURABILITY = os.environ.get('CHAT_STORE_DURABILITY', 'commit')
+
+# 首屏渲染以及每次向前翻页加载的历史消息条数
+HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '50'))
+
+# 上线/下线增量的合并窗口
+PRESENCE_BATCH_INTERVAL_MS = int(os.environ.get('CHAT_PRESENCE_BATCH_INTERVAL_MS', '200'))
+
+# “正在输入”状态：超过 TTL 未刷新视为停止输入；每个周期最多广播一次汇总
+TYPING_TTL_MS = int(os.environ.get('CHAT_TYPING_TTL_MS', '5000'))
+TYPING_INTERVAL_MS = int(os.environ.get('CHAT_TYPING_INTERVAL_MS', '500'))
+
+# 跨进程共享状态：'memory'（单进程）或 'redis'（多进程/多机）
+BACKPLANE = os.environ.get('CHAT_BACKPLANE', 'memory')
+REDIS_URL = os.environ.get('CHAT_REDIS_URL', 'redis://localhost:6379/0')
+# redis：每个进程按这个间隔续期自己的心跳；心跳超过 TTL 没有续期的进程视为已崩溃，
+# 其上的连接不再算在线，由存活的进程清理
+BACKPLANE_HEARTBEAT_S = float(os.environ.get('CHAT_BACKPLANE_HEARTBEAT_S', '5'))
+BACKPLANE_NODE_TTL_S = int(os.environ.get('CHAT_BACKPLANE_NODE_TTL_S', '15'))
+
+# 上线时每块投递的离线私信条数
+OFFLINE_CHUNK_SIZE = int(os.environ.get('CHAT_OFFLINE_CHUNK_SIZE', '100'))
+
+# 读查询使用的连接池大小（同时也是查询线程数）
+DB_POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', '4'))
+
+# 未指定聊天室时进入的默认聊天室，也是旧数据迁移后所在的聊天室
+DEFAULT_ROOM = os.environ.get('CHAT_DEFAULT_ROOM', 'general')
+
+# 内存中为每个聊天室保留的最近消息条数，以及最多缓存的聊天室数；
+# 内存上限约为两者之积条消息。设为 0 关闭缓存
+RECENT_HISTORY_SIZE = int(os.environ.get('CHAT_RECENT_HISTORY_SIZE', '500'))
+RECENT_HISTORY_ROOMS = int(os.environ.get('CHAT_RECENT_HISTORY_ROOMS', '100'))
+
+# Socket.IO 负载的 JSON 编解码：'json'、'orjson' 或 'auto'（装了 orjson 就用 orjson）。
+# orjson 直接输出 UTF-8，中文消息的帧更小，但逐个连接写出时的编码更慢，见 bench/fanout.py
+JSON_BACKEND = os.environ.get('CHAT_JSON', 'json')
+
+# 每个连接的限流预算：'事件=每秒速率:突发上限'，逗号分隔；未列出的事件不限流
+RATE_LIMITS = os.environ.get('CHAT_RATE_LIMITS',
+                             'chat message=5:10,private_message=5:10,typing=2:5,search=2:5')
+# 单个连接发送队列的积压上限：超过 DROP 时丢弃可丢弃的事件（输入状态），
+# 超过 MAX 时认为客户端已无法跟上，直接断开
+OUTBOUND_DROP_BACKLOG = int(os.environ.get('CHAT_OUTBOUND_DROP_BACKLOG', '64'))
+OUTBOUND_MAX_BACKLOG = int(os.environ.get('CHAT_OUTBOUND_MAX_BACKLOG', '1000'))
+
+# 搜索结果每页条数
+SEARCH_PAGE_SIZE = int(os.environ.get('CHAT_SEARCH_PAGE_SIZE', '20'))
+
+# 消息保留天数，超过的移到按月压缩的归档文件中；0 表示永久保留
+RETENTION_DAYS = int(os.environ.get('CHAT_RETENTION_DAYS', '0'))
+ARCHIVE_DIR = os.environ.get('CHAT_ARCHIVE_DIR', 'archive')
+# 归档任务的运行间隔（秒）
+RETENTION_INTERVAL_S = int(os.environ.get('CHAT_RETENTION_INTERVAL_S', '3600'))
+
+# 向前翻页、搜索翻页等历史读取使用的只读快照的刷新间隔（秒），即快照最多落后多久；
+# 0 表示不使用快照，全部读主库
+READ_SNAPSHOT_INTERVAL_S = int(os.environ.get('CHAT_READ_SNAPSHOT_INTERVAL_S', '0'))
+
+# Socket.IO 包格式：'json' 或 'msgpack'（pip install msgpack；页面会改为加载带
+# msgpack 解析器的 socket.io 客户端）
+WIRE_FORMAT = os.environ.get('CHAT_WIRE_FORMAT', 'json')
+
+# 优雅关闭时保存的会话在这段时间内可以凭 token 恢复（秒），服务需要在此之前重启完毕
+RESUME_GRACE_S = int(os.environ.get('CHAT_RESUME_GRACE_S', '60'))
+# 单进程部署时保存会话的文件；默认放在数据库文件旁边，不随工作目录变化
+RESUME_STATE_PATH = os.environ.get('CHAT_RESUME_STATE_PATH',
+                                   os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'resume_state.json'))
+# 关闭时通知客户端在这个时间窗口内随机延迟重连（毫秒）
+DRAIN_RECONNECT_WINDOW_MS = int(os.environ.get('CHAT_DRAIN_RECONNECT_WINDOW_MS', '5000'))
+# 关闭时最多等待客户端自行断开的时间（秒），之后强制关闭
+DRAIN_TIMEOUT_S = float(os.environ.get('CHAT_DRAIN_TIMEOUT_S', '2'))
+
+# 每个进程记住最近多少个 (发送者, client_id)，重试的消息直接按原结果应答
+DEDUP_CACHE_SIZE = int(os.environ.get('CHAT_DEDUP_CACHE_SIZE', '10000'))
@@ -0,0 +1,20 @@
+"""数据库辅助函数"""
+import sqlite3
+
+import config
+
+
+def connect(db_path=None):
+    """打开一个以 sqlite3.Row 返回结果的连接"""
+    conn = sqlite3.connect(db_path or config.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def ensure_column(conn, table, column, ddl):
+    """列不存在时补上（用于给旧的 chat.db 加列），返回这次是否新加了列"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column in columns:
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+    return True
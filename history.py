@@ -0,0 +1,79 @@
+"""公共消息历史的分页读取
+
+首屏只渲染当前聊天室最近 N 条消息，更早的历史通过 id 游标（id < cursor）按页加载。
+按 (room, id) 索引倒序取一页，与表的总行数以及其他聊天室的消息量无关。
+"""
+import config
+
+MAX_PAGE_SIZE = 200
+
+_SELECT_COLUMNS = 'SELECT id, username, message, timestamp, created_at, room, seq FROM messages'
+
+
+def clamp_limit(limit):
+    """把客户端传来的 limit 限制在合法范围内"""
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return config.HISTORY_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def row_to_message(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'message': row[2],
+        'timestamp': row[3],
+        'created_at': row[4],
+        'room': row[5],
+        'seq': row[6],
+    }
+
+
+def fetch_page(conn, room, before_id=None, limit=None):
+    """取聊天室 room 中 id < before_id 的最近 limit 条消息，按时间正序返回
+
+    返回 {'messages': [...], 'next_cursor': 更早一页的游标或 None}
+    """
+    limit = clamp_limit(limit)
+    # 多取一条用来判断是否还有更早的消息
+    if before_id is None:
+        rows = conn.execute(f'{_SELECT_COLUMNS} WHERE room = ? ORDER BY id DESC LIMIT ?',
+                            (room, limit + 1)).fetchall()
+    else:
+        rows = conn.execute(f'{_SELECT_COLUMNS} WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                            (room, int(before_id), limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    messages = [row_to_message(row) for row in reversed(rows[:limit])]
+    next_cursor = messages[0]['id'] if has_more and messages else None
+    return {'messages': messages, 'next_cursor': next_cursor}
+
+
+def fetch_after(conn, room, after_id, limit=None):
+    """取聊天室 room 中 id > after_id 的消息（断线重连后补齐），按时间正序返回
+
+    返回 {'messages': [...], 'has_more': 是否还有更新的消息}
+    """
+    limit = clamp_limit(limit)
+    rows = conn.execute(f'{_SELECT_COLUMNS} WHERE room = ? AND id > ? ORDER BY id LIMIT ?',
+                        (room, int(after_id), limit + 1)).fetchall()
+    return {'messages': [row_to_message(row) for row in rows[:limit]], 'has_more': len(rows) > limit}
+
+
+def fetch_latest(conn, room, limit):
+    """取聊天室最近 limit 条消息，不受分页上限限制，用于填充内存缓存
+
+    返回 (按时间正序的消息列表, 是否已经是该聊天室的全部消息)
+    """
+    rows = conn.execute(f'{_SELECT_COLUMNS} WHERE room = ? ORDER BY id DESC LIMIT ?',
+                        (room, limit + 1)).fetchall()
+    return [row_to_message(row) for row in reversed(rows[:limit])], len(rows) <= limit
+
+
+def recent_rooms(conn, max_rooms, scan_limit):
+    """最近 scan_limit 条消息涉及的聊天室，按最近活跃程度排序"""
+    rows = conn.execute(
+        'SELECT room FROM (SELECT id, room FROM messages ORDER BY id DESC LIMIT ?) '
+        'GROUP BY room ORDER BY MAX(id) DESC LIMIT ?', (scan_limit, max_rooms)).fetchall()
+    return [row[0] for row in rows]
@@ -0,0 +1,258 @@
+"""运行指标的采集与 Prometheus 文本格式导出
+
+不依赖 prometheus_client，只实现本项目用到的三种指标：
+
+- Counter：只增不减的计数
+- Gauge：在导出时调用回调函数取当前值
+- Histogram：固定桶的分布统计
+
+ChatMetrics 汇总聊天服务关心的指标：每个 Socket.IO 事件处理函数的调用次数、
+错误数和耗时分布，每次 emit 的扇出人数和负载字节数，背压丢弃与限流拒绝次数，
+在线连接数、私聊会话数、数据库查询耗时以及事件循环延迟。两个应用都通过 /metrics 导出。
+"""
+import asyncio
+import bisect
+import functools
+import json
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 事件循环延迟的采样周期（秒）
+LAG_SAMPLE_INTERVAL = 0.5
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PAYLOAD_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            yield self.name, list(zip(self.labelnames, labelvalues)), value
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        yield self.name, [], self.function()
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # {labelvalues: [各桶计数..., 超出最大桶的计数, 总和]}
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+        for labelvalues, state in sorted(values.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + [('le', _format_value(float(bound)))], cumulative
+            yield f'{self.name}_sum', labels, state[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class QueryMetricsCollector:
+    """把 repository.QueryMetrics 的统计以 summary 的形式导出"""
+
+    type = 'summary'
+    name = 'chat_db_query_duration_seconds'
+    documentation = 'Database query latency over the most recent samples, by query name.'
+
+    def __init__(self, query_metrics):
+        self.query_metrics = query_metrics
+
+    def samples(self):
+        for query, stats in sorted(self.query_metrics.snapshot().items()):
+            labels = [('query', query)]
+            for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+                yield self.name, labels + [('quantile', quantile)], stats[key] / 1000
+            yield f'{self.name}_sum', labels, stats['total_ms'] / 1000
+            yield f'{self.name}_count', labels, stats['count']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def payload_size(data):
+    """估算一次 emit 的 JSON 负载字节数，用于没有现成编码结果的跨进程 emit"""
+    try:
+        return len(json.dumps(data, separators=(',', ':')))
+    except (TypeError, ValueError):
+        return 0
+
+
+def local_recipients(manager, namespace, to):
+    """本进程内会收到这次 emit 的连接数；to 为 None 表示广播给命名空间内所有连接"""
+    rooms = manager.rooms.get(namespace or '/', {})
+    if isinstance(to, (list, tuple, set)):
+        return sum(len(rooms.get(room, ())) for room in to)
+    return len(rooms.get(to, ()))
+
+
+class ChatMetrics:
+    """聊天服务的指标集合"""
+
+    def __init__(self):
+        self.registry = Registry()
+        self.events = self.registry.register(Counter(
+            'chat_socketio_events_total', 'Socket.IO events handled, by event.', ('event',)))
+        self.event_errors = self.registry.register(Counter(
+            'chat_socketio_event_errors_total', 'Socket.IO handlers that raised, by event.', ('event',)))
+        self.event_duration = self.registry.register(Histogram(
+            'chat_socketio_event_duration_seconds', 'Socket.IO handler latency, by event.', ('event',)))
+        self.emits = self.registry.register(Counter(
+            'chat_socketio_emits_total', 'Server emits, by event.', ('event',)))
+        self.emit_recipients = self.registry.register(Histogram(
+            'chat_socketio_emit_recipients', 'Local connections addressed by one emit, by event.',
+            ('event',), FANOUT_BUCKETS))
+        self.emit_payload = self.registry.register(Histogram(
+            'chat_socketio_emit_payload_bytes', 'Encoded frame size of one emit, by event.',
+            ('event',), PAYLOAD_BUCKETS))
+        self.emit_bytes = self.registry.register(Counter(
+            'chat_socketio_emit_delivered_bytes_total',
+            'Payload bytes times local recipients, by event.', ('event',)))
+        self.emit_dropped = self.registry.register(Counter(
+            'chat_socketio_emit_dropped_total',
+            'Recipients skipped because their outbound queue was backed up, by event.', ('event',)))
+        self.slow_consumers = self.registry.register(Counter(
+            'chat_slow_consumer_disconnects_total',
+            'Connections dropped because their outbound queue hit the limit.'))
+        self.rate_limited = self.registry.register(Counter(
+            'chat_rate_limited_total', 'Client events rejected by the rate limiter, by event.',
+            ('event',)))
+        self.loop_lag = self.registry.register(Histogram(
+            'chat_event_loop_lag_seconds', 'How late a periodic timer fires on the event loop.'))
+
+    def gauge(self, name, documentation, function):
+        return self.registry.register(Gauge(name, documentation, function))
+
+    def track_queries(self, query_metrics):
+        self.registry.register(QueryMetricsCollector(query_metrics))
+
+    def _finish(self, event, start, error):
+        self.events.inc(event)
+        if error:
+            self.event_errors.inc(event)
+        self.event_duration.observe(time.perf_counter() - start, event)
+
+    def instrument(self, event, handler):
+        """包装事件处理函数，记录调用次数、错误数和耗时；同时支持普通函数和协程"""
+        if asyncio.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = True
+                try:
+                    result = await handler(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    self._finish(event, start, error)
+            return async_wrapper
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = handler(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self._finish(event, start, error)
+        return wrapper
+
+    def observe_emit(self, event, size, recipients):
+        self.emits.inc(event)
+        self.emit_recipients.observe(recipients, event)
+        self.emit_payload.observe(size, event)
+        self.emit_bytes.inc(event, amount=size * recipients)
+
+    def observe_backpressure(self, event, dropped, disconnected):
+        if dropped:
+            self.emit_dropped.inc(event, amount=dropped)
+        if disconnected:
+            self.slow_consumers.inc(amount=disconnected)
+
+    def observe_rate_limited(self, event):
+        self.rate_limited.inc(event)
+
+    def observe_lag(self, seconds):
+        self.loop_lag.observe(max(seconds, 0.0))
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,121 @@
+"""客户端消息 id 的去重与按会话递增的序号
+
+发送方为每条消息生成 client_id，重试、断线重发时带同一个 id，服务端只写入一次：
+
+- 进程内由 RecentSends（有界 LRU）记住最近的 (发送者, client_id) 及其写入结果，
+  重试直接拿原来的结果应答（第一次还没落盘时等同一个 Future），不再写入、不再广播
+- LRU 之外（进程重启、多进程部署）由 (发送者, client_id) 的唯一索引兜底：
+  写入时在同一个写事务中先查一次，已经写过就返回原来那条
+
+每个聊天室、每对私聊用户各有一个从 1 开始单调递增的序号 seq，写消息时在同一个
+写事务中从计数表 message_sequences 分配，归档删除旧消息不影响后续序号。
+同一会话内 seq 与 id 同序；客户端发现 seq 不连续时再按 id 补齐，发送方可以
+连续发送而不必等上一条的应答。
+"""
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import config
+
+MAX_CLIENT_ID_LENGTH = 64
+
+CLIENT_ID_COLUMN_DDL = 'TEXT'
+SEQ_COLUMN_DDL = 'INTEGER'
+
+CREATE_SEQUENCES_SQL = (
+    'CREATE TABLE IF NOT EXISTS message_sequences ('
+    'scope TEXT PRIMARY KEY, last_seq INTEGER NOT NULL) WITHOUT ROWID'
+)
+CREATE_INDEX_SQL = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id '
+    'ON messages (username, client_id) WHERE client_id IS NOT NULL',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_private_messages_client_id '
+    'ON private_messages (sender_username, client_id) WHERE client_id IS NOT NULL',
+)
+
+# 给加列之前的旧消息按 id 顺序编号，再把每个会话的最大序号写入计数表；
+# 作用域的拼法与 room_scope() / conversation_scope() 一致
+BACKFILL_SQL = (
+    'UPDATE messages SET seq = numbered.seq FROM ('
+    'SELECT id, ROW_NUMBER() OVER (PARTITION BY room ORDER BY id) AS seq FROM messages'
+    ') AS numbered WHERE messages.id = numbered.id',
+    'UPDATE private_messages SET seq = numbered.seq FROM ('
+    'SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation_key ORDER BY id) AS seq FROM private_messages'
+    ') AS numbered WHERE private_messages.id = numbered.id',
+    "INSERT OR REPLACE INTO message_sequences (scope, last_seq) "
+    "SELECT 'room:' || room, MAX(seq) FROM messages GROUP BY room",
+    "INSERT OR REPLACE INTO message_sequences (scope, last_seq) "
+    "SELECT 'dm:' || conversation_key, MAX(seq) FROM private_messages GROUP BY conversation_key",
+)
+
+
+class StoredMessage(NamedTuple):
+    """写入结果；duplicate 为真表示 client_id 已经写入过，返回的是原来那条"""
+    id: int
+    seq: int
+    duplicate: bool = False
+
+
+def room_scope(room):
+    return f'room:{room}'
+
+
+def conversation_scope(key):
+    return f'dm:{key}'
+
+
+def normalize_client_id(value):
+    """客户端提供的 client_id；不合法时返回 None，按没有 id 处理（不去重）"""
+    if not isinstance(value, str) or not 0 < len(value) <= MAX_CLIENT_ID_LENGTH:
+        return None
+    return value
+
+
+def next_seq(conn, scope):
+    """分配 scope 的下一个序号；必须在写事务中调用"""
+    conn.execute('INSERT INTO message_sequences (scope, last_seq) VALUES (?, 1) '
+                 'ON CONFLICT (scope) DO UPDATE SET last_seq = last_seq + 1', (scope,))
+    return conn.execute('SELECT last_seq FROM message_sequences WHERE scope = ?', (scope,)).fetchone()[0]
+
+
+def find_sent(conn, table, sender_column, sender, client_id):
+    """sender 用 client_id 写入过的消息，没有则返回 None"""
+    row = conn.execute(f'SELECT id, seq FROM {table} WHERE {sender_column} = ? AND client_id = ?',
+                       (sender, client_id)).fetchone()
+    return StoredMessage(row[0], row[1], duplicate=True) if row is not None else None
+
+
+class RecentSends:
+    """最近发送的 (发送者, client_id) -> 写入结果的 Future，有界 LRU
+
+    写入失败的条目自动移除，客户端重试时重新写入。
+    """
+
+    def __init__(self, size=None):
+        self.size = config.DEDUP_CACHE_SIZE if size is None else size
+        self._futures = OrderedDict()
+        # Future 在写入线程中完成，回调也在写入线程中执行
+        self._lock = threading.Lock()
+
+    def get(self, sender, client_id):
+        with self._lock:
+            future = self._futures.get((sender, client_id))
+            if future is not None:
+                self._futures.move_to_end((sender, client_id))
+            return future
+
+    def put(self, sender, client_id, future):
+        key = (sender, client_id)
+        with self._lock:
+            self._futures[key] = future
+            self._futures.move_to_end(key)
+            while len(self._futures) > self.size:
+                self._futures.popitem(last=False)
+
+        def forget_failed(future):
+            if future.cancelled() or future.exception() is not None:
+                with self._lock:
+                    if self._futures.get(key) is future:
+                        del self._futures[key]
+        future.add_done_callback(forget_failed)
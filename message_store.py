@@ -0,0 +1,300 @@
+"""消息存储子系统
+
+事件处理函数只负责把消息交给存储层，由存储层决定何时真正落盘：
+
+- SyncMessageStore：每条消息单独连接、单独提交（原有行为）
+- WriteBehindMessageStore：单个长连接（WAL 模式）+ 队列，
+  在后台线程中每 N 行或每 M 毫秒合并提交一次，不占用事件循环
+
+save_* 方法统一返回 concurrent.futures.Future，结果为 message_ids.StoredMessage
+（新行的 id 与会话内序号）。每次写入都在 BEGIN IMMEDIATE 写事务中执行，
+client_id 查重与序号分配不会和其他进程的写入交错。
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import config
+import message_ids
+from message_ids import StoredMessage
+from private_history import conversation_key
+
+DURABILITY_COMMIT = 'commit'
+DURABILITY_ENQUEUE = 'enqueue'
+
+INSERT_MESSAGE_SQL = (
+    'INSERT INTO messages (username, message, timestamp, created_at, room, client_id, seq) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?)'
+)
+INSERT_PRIVATE_MESSAGE_SQL = (
+    'INSERT INTO private_messages '
+    '(sender_username, receiver_username, message, timestamp, is_read, conversation_key, client_id, seq) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+)
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+def insert_message(conn, username, message, timestamp, created_at, room, client_id=None):
+    """写入一条公共消息；同一发送者的 client_id 已经写入过时返回原来那条"""
+    if client_id is not None:
+        sent = message_ids.find_sent(conn, 'messages', 'username', username, client_id)
+        if sent is not None:
+            return sent
+    seq = message_ids.next_seq(conn, message_ids.room_scope(room))
+    cursor = conn.execute(INSERT_MESSAGE_SQL,
+                          (username, message, timestamp, created_at, room, client_id, seq))
+    return StoredMessage(cursor.lastrowid, seq)
+
+
+def insert_private_message(conn, sender_username, receiver_username, message, timestamp, is_read,
+                           client_id=None):
+    """写入一条私信，序号按会话（两个用户之间）分配"""
+    if client_id is not None:
+        sent = message_ids.find_sent(conn, 'private_messages', 'sender_username', sender_username,
+                                     client_id)
+        if sent is not None:
+            return sent
+    key = conversation_key(sender_username, receiver_username)
+    seq = message_ids.next_seq(conn, message_ids.conversation_scope(key))
+    cursor = conn.execute(INSERT_PRIVATE_MESSAGE_SQL,
+                          (sender_username, receiver_username, message, timestamp, int(is_read), key,
+                           client_id, seq))
+    return StoredMessage(cursor.lastrowid, seq)
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+
+class MessageStore:
+    """消息存储接口"""
+
+    def __init__(self, durability=DURABILITY_COMMIT, metrics=None):
+        if durability not in (DURABILITY_COMMIT, DURABILITY_ENQUEUE):
+            raise ValueError(f'unknown durability: {durability}')
+        self.durability = durability
+        # 可选的 repository.QueryMetrics，记录每次提交的耗时
+        self.metrics = metrics
+
+    def _observe(self, name, seconds, error=False):
+        if self.metrics is not None:
+            self.metrics.observe(name, seconds, error)
+
+    @property
+    def wait_for_commit(self):
+        """调用方是否需要等到落盘后再广播"""
+        return self.durability == DURABILITY_COMMIT
+
+    def save_message(self, username, message, timestamp, created_at, room, client_id=None):
+        return self.submit(insert_message, username, message, timestamp, created_at, room, client_id)
+
+    def save_private_message(self, sender_username, receiver_username, message, timestamp,
+                             is_read=False, client_id=None):
+        return self.submit(insert_private_message, sender_username, receiver_username, message,
+                           timestamp, is_read, client_id)
+
+    def execute(self, sql, params):
+        """执行一条写语句，结果为 lastrowid"""
+        return self.submit(_execute, sql, params)
+
+    def submit(self, write, *args):
+        """在写事务中执行 write(conn, *args)，返回结果的 Future"""
+        raise NotImplementedError
+
+    def flush(self, timeout=None):
+        """等待已提交给存储层的写入全部落盘"""
+
+    def close(self, timeout=None):
+        """刷新剩余写入并释放资源"""
+
+
+class SyncMessageStore(MessageStore):
+    """每次写入都同步提交"""
+
+    def __init__(self, db_path=None, durability=DURABILITY_COMMIT, metrics=None):
+        super().__init__(durability, metrics)
+        self.db_path = db_path or config.DB_PATH
+
+    def submit(self, write, *args):
+        future = Future()
+        start = time.perf_counter()
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                result = write(conn, *args)
+            future.set_result(result)
+            self._observe('store_commit', time.perf_counter() - start)
+        except Exception as exc:
+            future.set_exception(exc)
+            self._observe('store_commit', time.perf_counter() - start, error=True)
+        return future
+
+
+class WriteBehindMessageStore(MessageStore):
+    """后台线程攒批提交的存储实现"""
+
+    def __init__(self, db_path=None, batch_size=None, batch_interval_ms=None,
+                 durability=DURABILITY_COMMIT, metrics=None):
+        super().__init__(durability, metrics)
+        self.db_path = db_path or config.DB_PATH
+        self.batch_size = batch_size or config.STORE_BATCH_SIZE
+        self.batch_interval = (batch_interval_ms or config.STORE_BATCH_INTERVAL_MS) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _ensure_started(self):
+        # 延迟到第一次写入时才启动线程，避免仅 import 模块就创建线程
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-store-writer',
+                                                daemon=True)
+                self._thread.start()
+
+    def submit(self, write, *args):
+        if self._closed:
+            raise RuntimeError('message store is closed')
+        self._ensure_started()
+        future = Future()
+        self._queue.put((write, args, future))
+        return future
+
+    def flush(self, timeout=None):
+        if self._thread is None:
+            return
+        marker = Future()
+        self._queue.put((None, None, marker))
+        marker.result(timeout)
+
+    def close(self, timeout=None):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在检查点时 fsync，提交不再每次刷盘
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _collect_batch(self, first):
+        batch = [first]
+        if first is _STOP or first[0] is None:
+            return batch
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is _STOP or item[0] is None:
+                break
+        return batch
+
+    def _run(self):
+        conn = None
+        stopping = False
+        try:
+            while not stopping:
+                batch = self._collect_batch(self._queue.get())
+                if batch[-1] is _STOP:
+                    batch.pop()
+                    stopping = True
+                    # 把关闭前已经入队的写入也一并处理掉
+                    while True:
+                        try:
+                            batch.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                    self._write_batch(conn, batch)
+                except Exception as exc:
+                    # 写入线程不能退出，否则之后所有的 Future 都不会完成：
+                    # 这一批以异常结束，下一批重新连接
+                    logger.exception('message store writer failed')
+                    self._fail(batch, exc)
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+        finally:
+            if conn is not None:
+                conn.close()
+            if not stopping:
+                # 意外退出：拒绝之后的写入，已入队的写入以异常结束
+                self._closed = True
+                exc = RuntimeError('message store writer stopped')
+                while True:
+                    try:
+                        self._fail([self._queue.get_nowait()], exc)
+                    except queue.Empty:
+                        break
+
+    @staticmethod
+    def _fail(batch, exc):
+        for item in batch:
+            if item is not _STOP and not item[2].done():
+                item[2].set_exception(exc)
+
+    def _write_batch(self, conn, batch):
+        writes = [item for item in batch if item is not _STOP and item[0] is not None]
+        markers = [item[2] for item in batch if item is not _STOP and item[0] is None]
+        results = []
+        start = time.perf_counter()
+        try:
+            if writes:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    for write, args, _ in writes:
+                        results.append(write(conn, *args))
+                self._observe('store_commit', time.perf_counter() - start)
+        except Exception:
+            self._observe('store_commit', time.perf_counter() - start, error=True)
+            # 整批失败时逐条重试，避免一条坏数据（数据库错误，或参数里的类型错误、
+            # 越界的整数）拖垮同批的其他消息
+            results = []
+            for write, args, _ in writes:
+                try:
+                    with conn:
+                        conn.execute('BEGIN IMMEDIATE')
+                        results.append(write(conn, *args))
+                except Exception as exc:
+                    results.append(exc)
+        for (_, _, future), result in zip(writes, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        for marker in markers:
+            marker.set_result(None)
+
+
+def create_message_store(backend=None, durability=None, db_path=None, metrics=None):
+    """按配置创建消息存储"""
+    backend = backend or config.STORE_BACKEND
+    durability = durability or config.STORE_DURABILITY
+    if backend == 'sync':
+        return SyncMessageStore(db_path=db_path, durability=durability, metrics=metrics)
+    if backend == 'write_behind':
+        return WriteBehindMessageStore(db_path=db_path, durability=durability, metrics=metrics)
+    raise ValueError(f'unknown message store backend: {backend}')
@@ -0,0 +1,206 @@
+"""数据库结构的版本化迁移
+
+两个应用启动时都调用 migrate()。当前结构版本记在 PRAGMA user_version 中，
+只执行比它新的迁移，每个迁移在自己的事务里执行，成功后才更新版本号。
+
+早期的 chat.db 没有版本号（user_version 为 0），但可能已经有部分表和列，
+所以每个迁移都写成可重复执行的（IF NOT EXISTS、列不存在才加）。
+
+新建的数据库在建第一张表之前设置页大小和增量 auto_vacuum；旧数据库在
+切换到增量 auto_vacuum 时需要做一次完整的 VACUUM。最后打开 WAL 模式
+（持久化在数据库文件中，之后所有连接都生效）。
+
+多进程部署（--workers）时每个进程启动都会调用 migrate()：迁移期间持有数据库旁边的
+文件锁（<db>.migrate.lock），每一步执行前在锁内重新读取版本号，已经被其他进程
+完成的步骤直接跳过。
+
+用法：
+    python migrations.py [--db chat.db]
+"""
+import argparse
+import contextlib
+import logging
+import sqlite3
+
+import config
+import db
+import message_ids
+import offline_delivery
+import private_history
+import rooms
+import search
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 上没有 fcntl，只靠事务内重新读取版本号
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 4096
+# PRAGMA auto_vacuum 的取值
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS private_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_username TEXT NOT NULL,
+            receiver_username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            is_read INTEGER DEFAULT 0
+        )
+    ''')
+
+
+def _add_created_at(conn):
+    # created_at 为毫秒级时间戳，可排序；timestamp 只用于展示
+    db.ensure_column(conn, 'messages', 'created_at', 'INTEGER')
+
+
+def _add_rooms(conn):
+    # 加列之前的旧消息都归入默认聊天室
+    db.ensure_column(conn, 'messages', 'room', rooms.ROOM_COLUMN_DDL)
+    conn.execute(rooms.CREATE_INDEX_SQL)
+
+
+def _add_unread_index(conn):
+    conn.execute(offline_delivery.CREATE_INDEX_SQL)
+
+
+def _add_search_index(conn):
+    # 全文索引由触发器同步；第一次创建时从已有消息回填
+    search.create_schema(conn)
+
+
+def _add_conversation_key(conn):
+    # 会话键：加列时给旧私信回填，之后由写入路径填写
+    if db.ensure_column(conn, 'private_messages', 'conversation_key',
+                        private_history.CONVERSATION_COLUMN_DDL):
+        conn.execute(private_history.BACKFILL_SQL)
+    conn.execute(private_history.CREATE_INDEX_SQL)
+
+
+def _add_message_ids(conn):
+    # 客户端消息 id 与会话内序号：加列时给旧消息按 id 顺序编号，之后由写入路径分配
+    conn.execute(message_ids.CREATE_SEQUENCES_SQL)
+    added = False
+    for table in ('messages', 'private_messages'):
+        db.ensure_column(conn, table, 'client_id', message_ids.CLIENT_ID_COLUMN_DDL)
+        added |= db.ensure_column(conn, table, 'seq', message_ids.SEQ_COLUMN_DDL)
+    if added:
+        for sql in message_ids.BACKFILL_SQL:
+            conn.execute(sql)
+    for sql in message_ids.CREATE_INDEX_SQL:
+        conn.execute(sql)
+
+
+def _enable_incremental_vacuum(conn):
+    # 切换 auto_vacuum 需要重建整个文件；VACUUM 不能在事务中执行
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        return
+    logger.warning('switching to incremental auto_vacuum, running a one-time VACUUM')
+    conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+    conn.execute('VACUUM')
+
+
+# (版本号, 说明, 迁移函数, 是否在事务中执行)；只能在末尾追加，不能修改已发布的迁移
+MIGRATIONS = [
+    (1, 'messages and private_messages tables', _create_tables, True),
+    (2, 'messages.created_at', _add_created_at, True),
+    (3, 'messages.room and (room, id) index', _add_rooms, True),
+    (4, 'unread private messages index', _add_unread_index, True),
+    (5, 'full-text search index', _add_search_index, True),
+    (6, 'private_messages.conversation_key', _add_conversation_key, True),
+    (7, 'incremental auto_vacuum', _enable_incremental_vacuum, False),
+    (8, 'client message ids and per-conversation sequence numbers', _add_message_ids, True),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _prepare_new_database(conn):
+    """空数据库在建表之前设置页大小和 auto_vacuum，之后就不用再 VACUUM"""
+    if conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone() is None:
+        conn.execute(f'PRAGMA page_size = {PAGE_SIZE}')
+        conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+
+
+@contextlib.contextmanager
+def _migration_lock(db_path):
+    """同一时间只有一个进程在迁移；不支持文件锁时不加锁"""
+    if fcntl is None or db_path == ':memory:':
+        yield
+        return
+    with open(f'{db_path}.migrate.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def migrate(db_path=None):
+    """把数据库升级到最新版本，返回升级后的版本号"""
+    db_path = db_path or config.DB_PATH
+    # isolation_level=None：事务由这里显式控制
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        with _migration_lock(db_path):
+            _migrate(conn, db_path)
+        return current_version(conn)
+    finally:
+        conn.close()
+
+
+def _migrate(conn, db_path):
+    _prepare_new_database(conn)
+    for target, description, migration, transactional in MIGRATIONS:
+        # 每一步都重新读取版本号：其他进程可能已经完成了这一步
+        if target <= current_version(conn):
+            continue
+        logger.info('migrating %s to version %d: %s', db_path, target, description)
+        if not transactional:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 拿到写锁之后再确认一次，没有文件锁时也不会重复执行
+            if target <= current_version(conn):
+                conn.execute('COMMIT')
+                continue
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    conn.execute('PRAGMA journal_mode = WAL')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='升级数据库结构')
+    parser.add_argument('--db', default=config.DB_PATH, help='数据库文件，默认为 CHAT_DB_PATH')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    print(f'{args.db} is at schema version {migrate(args.db)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""离线私信的分批投递
+
+用户上线时按 id 顺序分块发送未读私信（missed_private_messages），
+客户端收到一块后回 missed_private_messages_ack 确认其中的 id，
+服务端只把确认过的行标为已读，然后再发下一块。这样：
+
+- 每块只需一次往返，积压几千条私信也不会产生几千次 emit
+- 查询与确认之间新插入的私信不会被误标为已读
+- 依赖 (receiver_username, is_read, id) 复合索引，查询不再全表扫描
+
+接收者在线时实时投递的私信也先按未读入库，接收者回 private_message_ack 后
+才用 mark_read 标为已读，投递途中断开的不会丢。
+"""
+import config
+
+CREATE_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_private_messages_unread '
+    'ON private_messages (receiver_username, is_read, id)'
+)
+
+
+def fetch_unread(conn, receiver_username, after_id=0, limit=None):
+    """取 id > after_id 的一块未读私信
+
+    返回 {'messages': [...], 'has_more': 是否还有下一块}
+    """
+    limit = limit or config.OFFLINE_CHUNK_SIZE
+    rows = conn.execute(
+        'SELECT id, sender_username, message, timestamp FROM private_messages '
+        'WHERE receiver_username = ? AND is_read = 0 AND id > ? ORDER BY id LIMIT ?',
+        (receiver_username, after_id, limit + 1)).fetchall()
+    messages = [{
+        'id': row[0],
+        'sender_username': row[1],
+        'message': row[2],
+        'timestamp': row[3],
+    } for row in rows[:limit]]
+    return {'messages': messages, 'has_more': len(rows) > limit}
+
+
+# SQLite INTEGER 的上限，超出的 id 不可能存在
+_MAX_ID = 2 ** 63 - 1
+
+
+def parse_ack(data):
+    """从客户端的确认 {'ids': [...]} 中取出合法的 id，数量不超过一块
+
+    格式不对（不是对象、ids 不是列表）时返回 []，例如 ids 为 '123' 时不能逐字符
+    当成 1、2、3；列表中不是正整数的值忽略。
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list):
+        return []
+    return [value for value in data['ids'][:config.OFFLINE_CHUNK_SIZE]
+            if isinstance(value, int) and not isinstance(value, bool) and 0 < value <= _MAX_ID]
+
+
+def mark_read(store, receiver_username, ids):
+    """把客户端确认过的私信标为已读，经由消息存储的写入通道执行"""
+    placeholders = ', '.join('?' for _ in ids)
+    return store.execute(
+        f'UPDATE private_messages SET is_read = 1 '
+        f'WHERE receiver_username = ? AND id IN ({placeholders})',
+        (receiver_username, *ids))
@@ -0,0 +1,178 @@
+"""在线用户登记表
+
+维护 sid -> username 和 username -> {sid, ...} 两个方向的索引，
+所有查询都是 O(1)。同一用户可以有多个 sid（多个标签页/设备），
+凭首次占用用户名时下发的 token 认领同一个用户名。
+"""
+import secrets
+import threading
+from collections import namedtuple
+
+# token：用户名的持有凭证；first_session：是否为该用户的第一个连接
+Claim = namedtuple('Claim', ['token', 'first_session'])
+# username：释放的用户名；last_session：是否为该用户的最后一个连接
+Release = namedtuple('Release', ['username', 'last_session'])
+
+
+def tokens_match(token, owner_token):
+    """客户端携带的 token 与持有者的 token 相同
+
+    token 来自客户端，可能不是字符串或含非 ASCII 字符，按 UTF-8 字节做定长比较。
+    """
+    return (isinstance(token, str) and bool(token)
+            and secrets.compare_digest(token.encode('utf-8'), owner_token.encode('utf-8')))
+
+
+def user_room(username):
+    """每个用户的所有 sid 都加入这个 Socket.IO 房间，按用户名发消息时直接发到房间"""
+    return f'user:{username}'
+
+
+class PresenceRegistry:
+    """sid 与 username 的双向索引，claim/release 在锁内原子完成"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._username_by_sid = {}
+        self._sids_by_username = {}
+        self._token_by_username = {}
+
+    def claim(self, username, sid, token=None):
+        """让 sid 占用 username
+
+        用户名空闲时占用成功并生成新 token；用户名已被占用时，
+        只有携带相同 token 的连接才能加入。失败返回 None。
+        """
+        if not isinstance(token, str):
+            token = None
+        with self._lock:
+            current = self._username_by_sid.get(sid)
+            if current is not None and current != username:
+                return None
+            sids = self._sids_by_username.get(username)
+            if sids:
+                owner_token = self._token_by_username[username]
+                if sid not in sids and not tokens_match(token, owner_token):
+                    return None
+                sids.add(sid)
+                self._username_by_sid[sid] = username
+                return Claim(owner_token, False)
+            owner_token = token or self.new_token()
+            self._sids_by_username[username] = {sid}
+            self._token_by_username[username] = owner_token
+            self._username_by_sid[sid] = username
+            return Claim(owner_token, True)
+
+    @staticmethod
+    def new_token():
+        return secrets.token_urlsafe(16)
+
+    def release(self, sid):
+        """释放 sid；sid 未登记时返回 None"""
+        with self._lock:
+            username = self._username_by_sid.pop(sid, None)
+            if username is None:
+                return None
+            sids = self._sids_by_username.get(username, set())
+            sids.discard(sid)
+            if sids:
+                return Release(username, False)
+            self._sids_by_username.pop(username, None)
+            self._token_by_username.pop(username, None)
+            return Release(username, True)
+
+    def username_of(self, sid):
+        return self._username_by_sid.get(sid)
+
+    def token_of(self, username):
+        return self._token_by_username.get(username)
+
+    def sids_of(self, username):
+        with self._lock:
+            return tuple(self._sids_by_username.get(username, ()))
+
+    def is_online(self, username):
+        return username in self._sids_by_username
+
+    def usernames(self):
+        with self._lock:
+            return list(self._sids_by_username)
+
+    def __len__(self):
+        return len(self._sids_by_username)
+
+
+class PresenceDeltas:
+    """把一段时间内的上线/下线变化合并成一个带版本号的增量
+
+    新连接先拿到全量快照（users + version），之后只接收 presence_delta。
+    增量按集合语义应用（重复添加/删除无副作用），所以快照里已经包含
+    尚未发出的变化也没有关系；客户端发现版本号不连续时重新请求快照。
+    在线用户和版本号都来自 backplane，多进程部署时版本号全局递增。
+    asyncio 应用传入 AsyncBackplane，使用 adrain()/asnapshot()。
+    """
+
+    def __init__(self, backplane):
+        self._backplane = backplane
+        self._lock = threading.Lock()
+        self._added = set()
+        self._removed = set()
+        # 两次 drain 之间任何时刻的快照都是有效的，同一版本号内复用同一份快照，
+        # 重连风暴时不必为每个连接重建一次在线列表
+        self._snapshot = None
+
+    def user_added(self, username):
+        # 同一窗口内的多次变化以最后一次为准；不能简单抵消，
+        # 因为窗口中途拿到快照的客户端可能已经看到了中间状态
+        with self._lock:
+            self._removed.discard(username)
+            self._added.add(username)
+
+    def user_removed(self, username):
+        with self._lock:
+            self._added.discard(username)
+            self._removed.add(username)
+
+    def drain(self):
+        """取出累积的变化；没有变化时返回 None"""
+        with self._lock:
+            if not self._added and not self._removed:
+                return None
+            delta = {
+                'version': self._backplane.next_presence_version(),
+                'added': sorted(self._added),
+                'removed': sorted(self._removed),
+            }
+            self._added.clear()
+            self._removed.clear()
+            self._snapshot = None
+            return delta
+
+    def snapshot(self):
+        version = self._backplane.presence_version()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot['version'] != version:
+            snapshot = {'version': version, 'users': self._backplane.usernames()}
+            self._snapshot = snapshot
+        return snapshot
+
+    # 以下是 backplane 为 AsyncBackplane 时的协程版本（asyncio 应用，只在事件循环中调用）
+    async def adrain(self):
+        with self._lock:
+            if not self._added and not self._removed:
+                return None
+            added, removed = sorted(self._added), sorted(self._removed)
+            self._added.clear()
+            self._removed.clear()
+            self._snapshot = None
+        # 等待版本号期间新的变化进入下一个增量；增量按集合语义应用，先后无妨
+        return {'version': await self._backplane.next_presence_version(),
+                'added': added, 'removed': removed}
+
+    async def asnapshot(self):
+        version = await self._backplane.presence_version()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot['version'] != version:
+            snapshot = {'version': version, 'users': await self._backplane.usernames()}
+            self._snapshot = snapshot
+        return snapshot
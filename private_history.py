@@ -0,0 +1,63 @@
+"""私聊记录的分页读取
+
+每行私信带一个会话键 conversation_key：由两个用户名按固定顺序拼成，同一对用户
+无论谁发给谁都得到同一个键。(conversation_key, id) 复合索引让“两人之间最近 N 条”
+只走索引倒序读一页，不再需要对 sender/receiver 做 OR 全表扫描。
+"""
+import history
+
+CONVERSATION_COLUMN_DDL = 'TEXT'
+
+CREATE_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_private_messages_conversation '
+    'ON private_messages (conversation_key, id)'
+)
+
+# 与 conversation_key() 的结果一致，用于给加列之前的旧私信回填
+_LOW = 'MIN(sender_username, receiver_username)'
+_HIGH = 'MAX(sender_username, receiver_username)'
+BACKFILL_SQL = (
+    f"UPDATE private_messages SET conversation_key = length({_LOW}) || ':' || {_LOW} || ':' || {_HIGH} "
+    'WHERE conversation_key IS NULL'
+)
+
+
+def conversation_key(user1, user2):
+    """两个用户之间私聊的会话键，与参数顺序无关
+
+    用户名可以包含任意字符，前面加上较小用户名的长度，拼接结果不会有歧义。
+    SQLite 按 UTF-8 字节比较字符串，与 Python 按码位比较的顺序一致。
+    """
+    low, high = sorted((user1, user2))
+    return f'{len(low)}:{low}:{high}'
+
+
+def row_to_message(row):
+    return {
+        'id': row[0],
+        'sender_username': row[1],
+        'receiver_username': row[2],
+        'message': row[3],
+        'timestamp': row[4],
+        'seq': row[5],
+    }
+
+
+def fetch_page(conn, username, other_username, before_id=None, limit=None):
+    """取 username 与 other_username 之间 id < before_id 的最近 limit 条私信，按时间正序返回
+
+    返回 {'messages': [...], 'next_cursor': 更早一页的游标或 None}
+    """
+    limit = history.clamp_limit(limit)
+    key = conversation_key(username, other_username)
+    select = ('SELECT id, sender_username, receiver_username, message, timestamp, seq '
+              'FROM private_messages WHERE conversation_key = ?')
+    if before_id is None:
+        rows = conn.execute(f'{select} ORDER BY id DESC LIMIT ?', (key, limit + 1)).fetchall()
+    else:
+        rows = conn.execute(f'{select} AND id < ? ORDER BY id DESC LIMIT ?',
+                            (key, int(before_id), limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    messages = [row_to_message(row) for row in reversed(rows[:limit])]
+    next_cursor = messages[0]['id'] if has_more and messages else None
+    return {'messages': messages, 'next_cursor': next_cursor}
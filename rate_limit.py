@@ -0,0 +1,101 @@
+"""按用户限流
+
+每个用户、每种事件一个令牌桶（加入前按连接计）：桶以 rate 个/秒的速度补充令牌，最多攒 burst 个，
+每处理一个事件消耗一个。令牌不够时拒绝该事件，由调用方通知客户端。
+
+预算写成 '事件=每秒速率:突发上限'，多个事件用逗号分隔，例如
+'chat message=5:10,typing=2:5'。没有配置预算的事件不限流。
+限流状态只在本进程内，多进程部署时每个进程各自计数。
+
+加入后的桶按用户名保存，断开连接不会丢弃：重连或多开标签页拿不到新的突发额度。
+这些桶补满后与新建的桶没有区别，断开连接时顺便清理（最多每 PRUNE_INTERVAL_S 一次）。
+"""
+import threading
+import time
+
+import config
+
+PRUNE_INTERVAL_S = 60.0
+
+
+def parse_budgets(spec):
+    """把 'chat message=5:10,typing=2:5' 解析成 {事件: (速率, 突发上限)}"""
+    budgets = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        event, _, budget = item.rpartition('=')
+        rate, _, burst = budget.partition(':')
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError(f'rate limit for {event.strip()!r} must be positive')
+        budgets[event.strip()] = (rate, float(burst) if burst else max(rate, 1.0))
+    return budgets
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'notified')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        # 这次耗尽后是否已经通知过客户端，避免每个被拒绝的事件都回一条通知
+        self.notified = False
+
+    def take(self, now):
+        """取一个令牌；成功返回 0，否则返回还需要等待的秒数"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        """到 now 时是否已经补满"""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """按 (用户或连接, 事件) 维护令牌桶"""
+
+    def __init__(self, budgets=None):
+        self.budgets = parse_budgets(config.RATE_LIMITS) if budgets is None else budgets
+        self._lock = threading.Lock()
+        # {key: {event: TokenBucket}}
+        self._buckets = {}
+        self._pruned = time.monotonic()
+
+    def check(self, key, event):
+        """返回 (是否放行, 需要等待的秒数, 是否应通知客户端)"""
+        budget = self.budgets.get(event)
+        if budget is None:
+            return True, 0.0, False
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._buckets.setdefault(key, {})
+            bucket = buckets.get(event)
+            if bucket is None:
+                bucket = buckets[event] = TokenBucket(budget[0], budget[1], now)
+            retry_after = bucket.take(now)
+            if not retry_after:
+                return True, 0.0, False
+            notify = not bucket.notified
+            bucket.notified = True
+            return False, retry_after, notify
+
+    def forget(self, key):
+        """连接断开后丢弃它的令牌桶，并清理已经补满的用户桶"""
+        now = time.monotonic()
+        with self._lock:
+            self._buckets.pop(key, None)
+            if now - self._pruned < PRUNE_INTERVAL_S:
+                return
+            self._pruned = now
+            idle = [k for k, buckets in self._buckets.items()
+                    if all(bucket.full(now) for bucket in buckets.values())]
+            for k in idle:
+                del self._buckets[k]
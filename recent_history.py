@@ -0,0 +1,176 @@
+"""最近消息的内存缓存
+
+每个聊天室在内存中保留最近 N 条消息（环形缓冲区），首屏渲染、向前翻页和
+断线重连后的补齐（id > X）只要落在缓冲区覆盖的范围内就不再查询 SQLite。
+
+- 写入路径：消息落盘（拿到 id）后由 track() 追加到对应聊天室的缓冲区
+- 启动时 warm() 从数据库加载最近活跃的聊天室；其他聊天室第一次被访问时再加载
+- 聊天室数量超过上限时淘汰最久未访问的聊天室，总内存有上限
+- 过期消息归档后由 discard_through() 同步移除
+
+缓冲区保证：包含该聊天室 id >= 第一条消息 id 的全部消息；complete 为真时
+表示数据库中没有更早的消息。多进程部署时其他进程的写入不经过本进程，
+缓存会过期，因此只在单进程时启用。
+"""
+import bisect
+import threading
+from collections import OrderedDict, deque
+
+import config
+import history
+
+# 缓存的消息只保留与 history.row_to_message 相同的字段（id 和 seq 落盘后补上）
+_FIELDS = ('username', 'message', 'timestamp', 'created_at', 'room')
+
+
+def _message_id(message):
+    return message['id']
+
+
+class _RoomBuffer:
+    __slots__ = ('messages', 'complete', 'loaded')
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)
+        self.complete = False
+        # 是否已经从数据库加载过；只由写入路径创建的缓冲区只含加入缓存之后的消息
+        self.loaded = False
+
+
+class RecentHistory:
+    """按聊天室缓存最近的消息"""
+
+    def __init__(self, capacity=None, max_rooms=None, enabled=True):
+        self.capacity = config.RECENT_HISTORY_SIZE if capacity is None else capacity
+        self.max_rooms = config.RECENT_HISTORY_ROOMS if max_rooms is None else max_rooms
+        self.enabled = enabled and self.capacity > 0 and self.max_rooms > 0
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()
+
+    def _buffer(self, room, create=False):
+        buffer = self._rooms.get(room)
+        if buffer is not None:
+            self._rooms.move_to_end(room)
+        elif create:
+            buffer = self._rooms[room] = _RoomBuffer(self.capacity)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        return buffer
+
+    def is_loaded(self, room):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            return buffer is not None and buffer.loaded
+
+    def track(self, future, message):
+        """消息落盘后把它（带上新行的 id 和序号）追加到缓存"""
+        if not self.enabled:
+            return
+        message = {key: message[key] for key in _FIELDS}
+
+        def on_done(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            stored = future.result()
+            # 重试的消息已经在缓存里了
+            if stored.duplicate:
+                return
+            message['id'] = stored.id
+            message['seq'] = stored.seq
+            self.append(message)
+        future.add_done_callback(on_done)
+
+    def append(self, message):
+        if not self.enabled:
+            return
+        with self._lock:
+            buffer = self._buffer(message['room'], create=True)
+            messages = buffer.messages
+            if messages and message['id'] <= messages[-1]['id']:
+                # 写入线程按 id 顺序回调，这里只是兜底：按 id 插入到窗口内部
+                index = bisect.bisect_left(messages, message['id'], key=_message_id)
+                if index == 0 or messages[index]['id'] == message['id']:
+                    return
+                if len(messages) == messages.maxlen:
+                    messages.popleft()
+                    buffer.complete = False
+                    index -= 1
+                messages.insert(index, message)
+                return
+            if len(messages) == messages.maxlen:
+                buffer.complete = False
+            messages.append(message)
+
+    def load(self, room, messages, complete):
+        """用数据库中最近的消息填充缓存，与加载期间新追加的消息合并"""
+        if not self.enabled:
+            return
+        with self._lock:
+            buffer = self._buffer(room, create=True)
+            existing = list(buffer.messages)
+            if existing:
+                messages = [m for m in messages if m['id'] < existing[0]['id']] + existing
+            buffer.messages = deque(messages[-self.capacity:], maxlen=self.capacity)
+            buffer.complete = complete and len(messages) <= self.capacity
+            buffer.loaded = True
+
+    def discard_through(self, max_id):
+        """归档删除了 id <= max_id 的公共消息之后，把它们从缓存中移除"""
+        if not self.enabled or max_id is None:
+            return
+        with self._lock:
+            for buffer in self._rooms.values():
+                messages = buffer.messages
+                if not messages or messages[0]['id'] > max_id:
+                    continue
+                while messages and messages[0]['id'] <= max_id:
+                    messages.popleft()
+                # 缓冲区原本包含第一条之后的全部消息，更早的都已归档，数据库中不再有更早的消息
+                buffer.complete = True
+
+    def warm(self, conn):
+        """启动时加载最近活跃的聊天室，conn 为数据库连接"""
+        if not self.enabled:
+            return
+        rooms = history.recent_rooms(conn, self.max_rooms, self.capacity * self.max_rooms)
+        # 最活跃的最后加载，淘汰顺序与活跃程度一致
+        for room in reversed(rooms):
+            self.load(room, *history.fetch_latest(conn, room, self.capacity))
+
+    def page(self, room, before_id=None, limit=None):
+        """与 history.fetch_page 返回相同的结构；缓存覆盖不到时返回 None"""
+        if not self.enabled:
+            return None
+        limit = history.clamp_limit(limit)
+        with self._lock:
+            buffer = self._buffer(room)
+            if buffer is None:
+                return None
+            messages = list(buffer.messages)
+            complete = buffer.complete
+        end = len(messages)
+        if before_id is not None:
+            end = bisect.bisect_left(messages, int(before_id), key=_message_id)
+        start = max(0, end - limit)
+        if end - start < limit and not complete:
+            return None
+        page = messages[start:end]
+        has_more = start > 0 or not complete
+        return {'messages': page, 'next_cursor': page[0]['id'] if has_more and page else None}
+
+    def since(self, room, after_id, limit=None):
+        """与 history.fetch_after 返回相同的结构；缓存覆盖不到时返回 None"""
+        if not self.enabled:
+            return None
+        limit = history.clamp_limit(limit)
+        after_id = int(after_id)
+        with self._lock:
+            buffer = self._buffer(room)
+            if buffer is None:
+                return None
+            messages = list(buffer.messages)
+            complete = buffer.complete
+        if not complete and (not messages or after_id < messages[0]['id'] - 1):
+            return None
+        start = bisect.bisect_right(messages, after_id, key=_message_id)
+        return {'messages': messages[start:start + limit], 'has_more': len(messages) > start + limit}
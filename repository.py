@@ -0,0 +1,173 @@
+"""数据库读操作的执行层
+
+查询函数（history.fetch_page、offline_delivery.fetch_unread 等）都是
+fn(conn, *args) 的形式，Repository 负责：
+
+- 维护一个小的长连接池；sqlite3 会按连接缓存编译好的语句
+  （cached_statements），长连接上重复执行的查询不会再次解析 SQL
+- 在有界线程池中执行查询，asyncio 代码通过 arun() 调用，不阻塞事件循环
+- 按查询名记录耗时，提供 p50/p95/p99 等统计
+"""
+import asyncio
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# 每个查询保留的最近耗时样本数
+LATENCY_SAMPLES = 1024
+
+
+class QueryMetrics:
+    """按查询名统计调用次数、错误数和最近的耗时分布"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._counts = {}
+        self._errors = {}
+        self._totals = {}
+
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._totals[name] = self._totals.get(name, 0.0) + seconds
+            if error:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            counts = dict(self._counts)
+            errors = dict(self._errors)
+            totals = dict(self._totals)
+        return {
+            name: {
+                'count': counts[name],
+                'errors': errors.get(name, 0),
+                'p50_ms': _percentile(values, 0.50) * 1000,
+                'p95_ms': _percentile(values, 0.95) * 1000,
+                'p99_ms': _percentile(values, 0.99) * 1000,
+                'max_ms': values[-1] * 1000,
+                'total_ms': totals[name] * 1000,
+            }
+            for name, values in samples.items()
+        }
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class ConnectionPool:
+    """固定大小的 SQLite 连接池
+
+    read_only 时以只读、immutable 方式打开，用于生成后不再修改的快照文件；
+    文件被整体替换后调用 reset()，旧文件上的连接在归还时换成新连接。
+    """
+
+    def __init__(self, db_path=None, size=None, read_only=False):
+        self.db_path = db_path or config.DB_PATH
+        self.size = size or config.DB_POOL_SIZE
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._generation = 0
+        # 连接 -> 创建时的 generation
+        self._generations = {}
+
+    def _connect(self):
+        if self.read_only:
+            # immutable：文件不会再变，跳过文件锁和变更检测
+            uri = pathlib.Path(self.db_path).absolute().as_uri() + '?mode=ro&immutable=1'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        self._generations[conn] = self._generation
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._connect()
+        return self._idle.get()
+
+    def release(self, conn):
+        with self._lock:
+            if self._generations[conn] != self._generation:
+                del self._generations[conn]
+                conn.close()
+                conn = self._connect()
+        self._idle.put(conn)
+
+    def reset(self):
+        """数据库文件被替换后调用：之后取到的连接都打开新文件"""
+        with self._lock:
+            self._generation += 1
+            idle = []
+            while True:
+                try:
+                    idle.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+        for conn in idle:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Repository:
+    """在连接池上执行查询，并记录每个查询的耗时"""
+
+    def __init__(self, db_path=None, pool_size=None, read_only=False, metrics=None):
+        self.pool = ConnectionPool(db_path, pool_size, read_only)
+        self.metrics = metrics or QueryMetrics()
+        self._executor = ThreadPoolExecutor(max_workers=self.pool.size,
+                                            thread_name_prefix='chat-db')
+        # 限制排队中的查询数，超出时 arun 在事件循环里等待而不是无限堆积
+        self._in_flight = None
+
+    def run(self, name, fn, *args):
+        """同步执行 fn(conn, *args)"""
+        conn = self.pool.acquire()
+        start = time.perf_counter()
+        error = False
+        try:
+            return fn(conn, *args)
+        except sqlite3.Error:
+            error = True
+            raise
+        finally:
+            self.metrics.observe(name, time.perf_counter() - start, error)
+            self.pool.release(conn)
+
+    async def arun(self, name, fn, *args):
+        """在线程池中执行 fn(conn, *args)，不阻塞事件循环"""
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.pool.size * 4)
+        async with self._in_flight:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self.run, name, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
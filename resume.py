@@ -0,0 +1,132 @@
+"""重启后的会话恢复
+
+在线用户和私聊会话只保存在进程内（或 Redis 中、随进程退出释放），重启会让所有
+客户端同时重新登录：每个人都广播一次“加入”、查询一次离线私信，私聊也全部断开。
+
+优雅关闭时（见两个应用的 drain）：
+
+- 先拒绝新连接，把本进程上在线用户的 {用户名: token, 私聊对象} 存入 ResumeStore，
+  有效期 RESUME_GRACE_S 秒
+- 广播一次 server_shutdown，带上重连时间窗口；客户端主动断开，在窗口内随机延迟后
+  重连，重连分散开，不会同时涌入
+- 排空期间的断开不算下线：不广播下线、不结束私聊
+
+客户端重连后发 resume（用户名、token、最后看到的消息 id）。token 与保存的一致时
+视为同一会话继续：不广播“加入”、不重新投递离线私信，双方都回来后恢复私聊，
+并在同一次往返中补发 last_id 之后的消息。有效期内没有回来的用户按下线处理，
+由 expire() 取出，通知其私聊对象会话已结束。
+"""
+import json
+import os
+import time
+
+import config
+from presence import tokens_match
+
+
+def _matches(entry, token):
+    return entry is not None and tokens_match(token, entry['token'])
+
+
+class ResumeStore:
+    """保存关闭前的会话，重启后按用户名取回"""
+
+    def save(self, sessions, ttl=None):
+        """sessions: {用户名: {'token': ..., 'partner': 私聊对象或 None}}"""
+        raise NotImplementedError
+
+    def take(self, username, token):
+        """token 匹配时取出（并删除）username 保存的会话，否则返回 None"""
+        raise NotImplementedError
+
+    def expires_in(self):
+        """保存的会话还有多少秒过期；没有保存的会话时返回 None"""
+        raise NotImplementedError
+
+    def expire(self):
+        """取出所有没有恢复的会话，返回 {用户名: 会话}"""
+        raise NotImplementedError
+
+
+class FileResumeStore(ResumeStore):
+    """单进程部署：保存在 JSON 文件中，启动时读入内存"""
+
+    def __init__(self, path=None):
+        self.path = path or config.RESUME_STATE_PATH
+        self._sessions = {}
+        self._expires_at = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            state = None
+        # 只恢复一次，读入后删除文件
+        os.remove(self.path)
+        if state and state['expires_at'] > time.time():
+            self._sessions = state['sessions']
+            self._expires_at = state['expires_at']
+
+    def save(self, sessions, ttl=None):
+        ttl = config.RESUME_GRACE_S if ttl is None else ttl
+        state = {'expires_at': time.time() + ttl, 'sessions': sessions}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def take(self, username, token):
+        entry = self._sessions.get(username)
+        if not _matches(entry, token) or self.expires_in() is None:
+            return None
+        return self._sessions.pop(username)
+
+    def expires_in(self):
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - time.time())
+
+    def expire(self):
+        sessions, self._sessions, self._expires_at = self._sessions, {}, None
+        return sessions
+
+
+class RedisResumeStore(ResumeStore):
+    """多进程部署：保存在 Redis 哈希中，重启的进程和其他进程都能取回"""
+
+    def __init__(self, redis, prefix='chat'):
+        self.redis = redis
+        self._key = f'{prefix}:resume'
+
+    def save(self, sessions, ttl=None):
+        if not sessions:
+            return
+        ttl = config.RESUME_GRACE_S if ttl is None else ttl
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key, mapping={username: json.dumps(entry, ensure_ascii=False)
+                                      for username, entry in sessions.items()})
+        pipe.expire(self._key, int(ttl))
+        pipe.execute()
+
+    def take(self, username, token):
+        raw = self.redis.hget(self._key, username)
+        entry = json.loads(raw) if raw else None
+        # HDEL 只有一个调用方能成功，同一会话不会被恢复两次
+        if not _matches(entry, token) or not self.redis.hdel(self._key, username):
+            return None
+        return entry
+
+    def expires_in(self):
+        ttl = self.redis.ttl(self._key)
+        return ttl if ttl >= 0 else None
+
+    def expire(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self._key)
+        pipe.delete(self._key)
+        raw, _ = pipe.execute()
+        return {username: json.loads(entry) for username, entry in raw.items()}
@@ -0,0 +1,170 @@
+"""过期消息的归档与空间回收
+
+超过保留期的消息从 chat.db 移到按月份分文件的压缩归档中，活跃数据库只保留
+最近的消息，工作集能留在页缓存里：
+
+- 归档文件为 <archive_dir>/<表名>-<YYYY-MM>.jsonl.gz，每行一条消息（JSON）；
+  每批追加一个 gzip 成员，整个文件仍可以直接用 gzip / zcat 读取
+- 按 id 从最旧的开始分批处理，每批一个短事务（先写归档文件再删除），
+  不会长时间占着写锁；中途失败时最多重复归档一批，不会丢消息
+- 未读的私信（离线投递尚未确认）不归档
+- 删除后用增量 vacuum 把空闲页还给文件系统（需要 auto_vacuum=INCREMENTAL，
+  由 migrations 设置），同样分步执行
+
+消息删除时全文索引由触发器同步删除。调用方需要把归档掉的消息从内存缓存中移除
+（RecentHistory.discard_through）。
+
+用法：
+    python retention.py --days 90 [--db chat.db] [--archive-dir archive]
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+
+import config
+
+BATCH_SIZE = 1000
+# 每次增量 vacuum 回收的页数
+VACUUM_STEP_PAGES = 1000
+
+_MESSAGE_COLUMNS = ('id', 'username', 'message', 'timestamp', 'created_at', 'room', 'seq')
+_PRIVATE_COLUMNS = ('id', 'sender_username', 'receiver_username', 'message', 'timestamp',
+                    'is_read', 'conversation_key', 'seq')
+
+
+def _message_month(row):
+    if row['created_at'] is None:
+        return 'undated'
+    return datetime.datetime.fromtimestamp(row['created_at'] / 1000).strftime('%Y-%m')
+
+
+def _message_expiry(conn, cutoff):
+    """返回判断公共消息是否过期的函数
+
+    加 created_at 列之前的旧消息没有时间，但都比第一条有时间的消息早，
+    第一条有时间的消息过期时它们也一起过期。
+    """
+    cutoff_ms = int(cutoff.timestamp() * 1000)
+    oldest = conn.execute('SELECT created_at FROM messages WHERE created_at IS NOT NULL '
+                          'ORDER BY id LIMIT 1').fetchone()
+    undated_expired = oldest is not None and oldest[0] < cutoff_ms
+    return lambda row: undated_expired if row['created_at'] is None else row['created_at'] < cutoff_ms
+
+
+def _private_expiry(conn, cutoff):
+    cutoff_text = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+    return lambda row: row['timestamp'] < cutoff_text
+
+
+# 表名 -> (列, 归档条件, 过期判断函数的工厂, 归档文件的月份)
+_TABLES = {
+    'messages': (_MESSAGE_COLUMNS, '', _message_expiry, _message_month),
+    'private_messages': (_PRIVATE_COLUMNS, 'AND is_read = 1', _private_expiry,
+                         lambda row: row['timestamp'][:7]),
+}
+
+
+def _write_archive(archive_dir, table, rows, month_of):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(month_of(row), []).append(row)
+    for month, month_rows in by_month.items():
+        path = os.path.join(archive_dir, f'{table}-{month}.jsonl.gz')
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for row in month_rows:
+                f.write(json.dumps(dict(row), ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def _archive_table(conn, table, cutoff, archive_dir):
+    """归档一张表中的过期行，返回 (归档行数, 最大的归档 id)"""
+    columns, condition, expiry, month_of = _TABLES[table]
+    is_expired = expiry(conn, cutoff)
+    archived = 0
+    max_id = None
+    last_id = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                f'SELECT {", ".join(columns)} FROM {table} WHERE id > ? {condition} '
+                f'ORDER BY id LIMIT ?', (last_id, BATCH_SIZE)).fetchall()
+            # id 与时间同序，碰到第一条未过期的消息就可以停下
+            expired = []
+            for row in rows:
+                if not is_expired(row):
+                    break
+                expired.append(row)
+            if expired:
+                _write_archive(archive_dir, table, expired, month_of)
+                conn.executemany(f'DELETE FROM {table} WHERE id = ?', [(row['id'],) for row in expired])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if expired:
+            archived += len(expired)
+            max_id = last_id = expired[-1]['id']
+        if len(expired) < BATCH_SIZE:
+            return archived, max_id
+
+
+def incremental_vacuum(conn):
+    """分步回收空闲页，返回回收的页数"""
+    freed = 0
+    while True:
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free_pages:
+            return freed
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+        remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if remaining >= free_pages:
+            # 不是增量 auto_vacuum 的数据库，回收不了
+            return freed
+        freed += free_pages - remaining
+
+
+def run(db_path=None, days=None, archive_dir=None, now=None):
+    """归档超过 days 天的消息并回收空间
+
+    返回 {'messages': 归档行数, 'private_messages': 归档行数,
+          'max_message_id': 归档的最大公共消息 id 或 None, 'freed_pages': 回收的页数}
+    """
+    days = config.RETENTION_DAYS if days is None else days
+    if days <= 0:
+        raise ValueError('retention days must be positive')
+    archive_dir = archive_dir or config.ARCHIVE_DIR
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=days)
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path or config.DB_PATH, isolation_level=None, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        result = {}
+        for table in _TABLES:
+            result[table], max_id = _archive_table(conn, table, cutoff, archive_dir)
+            if table == 'messages':
+                result['max_message_id'] = max_id
+        result['freed_pages'] = incremental_vacuum(conn)
+        return result
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='归档过期消息并回收数据库空间')
+    parser.add_argument('--days', type=int, default=config.RETENTION_DAYS or None,
+                        required=not config.RETENTION_DAYS,
+                        help='保留最近多少天的消息，默认为 CHAT_RETENTION_DAYS')
+    parser.add_argument('--db', default=config.DB_PATH, help='数据库文件，默认为 CHAT_DB_PATH')
+    parser.add_argument('--archive-dir', default=config.ARCHIVE_DIR,
+                        help='归档目录，默认为 CHAT_ARCHIVE_DIR')
+    args = parser.parse_args(argv)
+    result = run(args.db, args.days, args.archive_dir)
+    print(f'archived {result["messages"]} messages and {result["private_messages"]} private messages, '
+          f'freed {result["freed_pages"]} pages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""聊天室（频道）
+
+每个聊天室对应一个 Socket.IO 房间 room:<name>：公共消息和输入状态只发给
+该房间内的连接，单条消息的开销与聊天室人数成正比，而不是与全部在线人数成正比。
+messages 表按 room 列分区，(room, id) 索引让按聊天室翻页只走索引。
+"""
+import re
+
+import config
+
+_ROOM_NAME = re.compile(r'^[\w-]{1,32}$')
+
+
+def _default_room(name):
+    """规范化配置的默认聊天室名；它会写进建表语句，不合法时直接拒绝启动"""
+    room = str(name).strip().lower()
+    if not _ROOM_NAME.match(room):
+        raise ValueError(f'CHAT_DEFAULT_ROOM {name!r} is not a valid room name '
+                         '(1-32 letters, digits, underscores or hyphens)')
+    return room
+
+
+DEFAULT_ROOM = _default_room(config.DEFAULT_ROOM)
+
+ROOM_COLUMN_DDL = f"TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'"
+
+CREATE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)'
+
+
+def normalize_room(name):
+    """返回规范化的聊天室名；未指定时为默认聊天室，不合法时返回 None"""
+    if name is None or name == '':
+        return DEFAULT_ROOM
+    name = str(name).strip().lower()
+    return name if _ROOM_NAME.match(name) else None
+
+
+def room_channel(room):
+    """聊天室对应的 Socket.IO 房间名"""
+    return f'room:{room}'
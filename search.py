@@ -0,0 +1,188 @@
+"""公共消息和私信的全文搜索
+
+基于 SQLite FTS5 的外部内容表（content=messages / private_messages），
+索引只存倒排数据，消息正文仍只存一份：
+
+- 由触发器在插入、删除、修改消息时同步索引，写入路径（后台攒批提交）不需要改动，
+  索引更新和消息写入在同一个事务里
+- 使用 trigram 分词器，按子串匹配，中文不需要分词；每个词至少 3 个字符才能走索引，
+  更短的词只在索引命中的结果里用 LIKE 过滤
+- 查询在 Repository 的读连接池中执行，WAL 模式下不阻塞消息写入
+- 结果按 id 倒序（最新的在前），用 id 游标翻页
+
+已有的 chat.db 第一次建索引时会自动回填；也可以手动重建：
+    python search.py reindex [--db chat.db]
+"""
+import argparse
+import html
+import sqlite3
+
+import config
+from private_history import conversation_key
+
+MAX_PAGE_SIZE = 50
+# trigram 分词器下能走索引的最短词长
+MIN_TERM_LENGTH = 3
+# snippet() 最多保留的 token 数（trigram 下约等于字符数）
+SNIPPET_TOKENS = 48
+
+# 高亮标记用控制字符，转义 HTML 之后再换成 <mark>
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+_INDEXES = {
+    'messages_fts': ('messages', 'message'),
+    'private_messages_fts': ('private_messages', 'message'),
+}
+
+
+class SearchQueryError(ValueError):
+    """搜索词不合法（为空或没有足够长的词）"""
+
+
+def _schema_sql(fts_table, table, column):
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+        f"{column}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN '
+        f'INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN '
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {table} BEGIN '
+        f"INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f'INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END',
+    ]
+
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def create_schema(conn):
+    """创建全文索引和同步触发器；索引表是新建的就从已有数据回填"""
+    for fts_table, (table, column) in _INDEXES.items():
+        created = not _table_exists(conn, fts_table)
+        for sql in _schema_sql(fts_table, table, column):
+            conn.execute(sql)
+        if created:
+            conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+
+def reindex(conn):
+    """从消息表重建全部全文索引"""
+    for fts_table in _INDEXES:
+        conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+        conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('optimize')")
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return config.SEARCH_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def parse_query(text):
+    """把用户输入拆成 (FTS5 MATCH 表达式, 需要额外 LIKE 过滤的短词)
+
+    每个词都当作短语加引号，用户输入里的 FTS5 语法不会生效；多个词之间是 AND。
+    """
+    terms = list(dict.fromkeys(str(text or '').split()))
+    long_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    if not long_terms:
+        raise SearchQueryError(f'搜索词至少需要一个不少于 {MIN_TERM_LENGTH} 个字符的词')
+    match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+    short_terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+    return match, short_terms
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def _highlight(snippet):
+    """转义 HTML 后把高亮标记换成 <mark>，结果可以直接作为 HTML 插入"""
+    return (html.escape(snippet)
+            .replace(_MARK_START, '<mark>')
+            .replace(_MARK_END, '</mark>'))
+
+
+def _search(conn, fts_table, select, filters, params, query, before_id, limit):
+    match, short_terms = parse_query(query)
+    limit = clamp_limit(limit)
+    where = [f'{fts_table} MATCH ?'] + filters
+    args = [match] + list(params)
+    for term in short_terms:
+        where.append("m.message LIKE ? ESCAPE '\\'")
+        args.append(_like_pattern(term))
+    if before_id is not None:
+        where.append(f'{fts_table}.rowid < ?')
+        args.append(int(before_id))
+    rows = conn.execute(
+        f"SELECT {select}, snippet({fts_table}, 0, '{_MARK_START}', '{_MARK_END}', '…', "
+        f'{SNIPPET_TOKENS}) FROM {fts_table} JOIN {_INDEXES[fts_table][0]} m '
+        f'ON m.id = {fts_table}.rowid WHERE {" AND ".join(where)} '
+        f'ORDER BY {fts_table}.rowid DESC LIMIT ?',
+        (*args, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = rows[-1][0] if has_more and rows else None
+    return rows, next_cursor
+
+
+def search_messages(conn, room, query, before_id=None, limit=None):
+    """在聊天室 room 的公共消息中搜索，最新的在前
+
+    返回 {'results': [...], 'next_cursor': 下一页的游标或 None}
+    """
+    rows, next_cursor = _search(
+        conn, 'messages_fts', 'm.id, m.username, m.timestamp, m.created_at, m.room',
+        ['m.room = ?'], [room], query, before_id, limit)
+    results = [{
+        'id': row[0],
+        'username': row[1],
+        'timestamp': row[2],
+        'created_at': row[3],
+        'room': row[4],
+        'highlight': _highlight(row[5]),
+    } for row in rows]
+    return {'results': results, 'next_cursor': next_cursor}
+
+
+def search_private_messages(conn, username, query, other_username=None, before_id=None,
+                            limit=None):
+    """在 username 收发过的私信中搜索；指定 other_username 时只搜与对方的私信"""
+    if other_username:
+        filters = ['m.conversation_key = ?']
+        params = [conversation_key(username, other_username)]
+    else:
+        filters = ['(m.sender_username = ? OR m.receiver_username = ?)']
+        params = [username, username]
+    rows, next_cursor = _search(
+        conn, 'private_messages_fts', 'm.id, m.sender_username, m.receiver_username, m.timestamp',
+        filters, params, query, before_id, limit)
+    results = [{
+        'id': row[0],
+        'sender_username': row[1],
+        'receiver_username': row[2],
+        'timestamp': row[3],
+        'highlight': _highlight(row[4]),
+    } for row in rows]
+    return {'results': results, 'next_cursor': next_cursor}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='全文索引维护')
+    parser.add_argument('command', choices=['reindex'])
+    parser.add_argument('--db', default=config.DB_PATH, help='数据库文件，默认为 CHAT_DB_PATH')
+    args = parser.parse_args(argv)
+    with sqlite3.connect(args.db) as conn:
+        create_schema(conn)
+        reindex(conn)
+    print(f'reindexed {args.db}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Socket.IO 负载的编解码
+
+- JSON：python-socketio 接受任何提供 dumps/loads 的对象作为 json 模块。这里按配置
+  选择标准库 json 或 orjson。orjson 是可选依赖，未安装时 'auto' 回退到标准库。
+- 包格式：WIRE_FORMAT 为 'msgpack' 时整个 Socket.IO 包用 MessagePack 编码
+  （需要 pip install msgpack），页面改为加载带 msgpack 解析器的客户端
+- 批量负载（历史一页、补齐、离线私信、搜索结果）：连接时客户端在 auth 里声明
+  batch_encoding='columnar' 后，消息列表改为列式编码，每个键只出现一次
+"""
+import json
+
+import config
+
+
+class OrjsonModule:
+    """把 orjson 包装成 json 模块的接口，dumps 返回 str"""
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj, **kwargs):
+        # orjson 的输出本来就是紧凑格式，separators 等参数不需要
+        return self._orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return self._orjson.loads(s)
+
+
+def json_module(name=None):
+    """按配置返回 json 模块"""
+    name = name or config.JSON_BACKEND
+    if name == 'json':
+        return json
+    if name == 'orjson':
+        return OrjsonModule()
+    if name == 'auto':
+        try:
+            return OrjsonModule()
+        except ImportError:
+            return json
+    raise ValueError(f'unknown json backend: {name}')
+
+
+WIRE_FORMATS = ('json', 'msgpack')
+
+COLUMNAR = 'columnar'
+
+
+def socketio_serializer(name=None):
+    """按配置返回 python-socketio 的 serializer 参数"""
+    name = name or config.WIRE_FORMAT
+    if name not in WIRE_FORMATS:
+        raise ValueError(f'unknown wire format: {name}')
+    # python-socketio 把 JSON 包格式叫作 'default'
+    return 'default' if name == 'json' else name
+
+
+def wants_columnar(auth):
+    """客户端连接时是否声明接受列式批量负载"""
+    return isinstance(auth, dict) and auth.get('batch_encoding') == COLUMNAR
+
+
+def to_columns(rows):
+    """把字典列表编码成 {'fields': [键...], 'columns': [[第一个键的值...], ...]}
+
+    同一列的值（发送者、时间）相邻，压缩效果也比逐行的字典好。
+    """
+    fields = list(dict.fromkeys(key for row in rows for key in row))
+    return {'fields': fields, 'columns': [[row.get(field) for row in rows] for field in fields]}
+
+
+def encode_batch(payload, key, columnar):
+    """columnar 为真时把 payload[key] 换成列式编码，并标上 encoding"""
+    if not columnar:
+        return payload
+    return {**payload, key: to_columns(payload[key]), 'encoding': COLUMNAR}
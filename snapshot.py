@@ -0,0 +1,101 @@
+"""历史读取用的只读快照
+
+向前翻页、搜索翻页这类读流量与消息写入共用 chat.db，量大时会占用页缓存和
+磁盘带宽，长时间的读事务还会推迟 WAL 检查点。快照把这部分读流量移到另一个文件：
+
+- refresh() 用 SQLite 在线备份 API 把 chat.db 完整复制到临时文件，再原子替换快照文件；
+  备份只持有一个读事务，WAL 模式下不阻塞写入
+- 快照文件生成后不再修改，读连接以 immutable 方式打开，不加任何文件锁；
+  快照有自己的连接池和查询线程，不和主库的查询排队
+- 复制时记下每张表的最大 id（水位）。写入只有一个写连接、id 按提交顺序递增，
+  所以 id <= 水位的行都已在快照中：游标 before <= 水位 + 1 的一页在快照上查询，
+  结果与主库相同；最新的消息（首屏、断线补齐、第一页搜索结果）仍读主库或内存缓存
+- 快照最多落后一个刷新周期；超过保留期被归档的消息在下次刷新前仍可能查到
+
+每个进程维护自己的快照文件（文件名带进程号），关闭时删除。
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import config
+from repository import Repository
+
+# 记录水位的表
+_TABLES = ('messages', 'private_messages')
+
+
+class Snapshot:
+    """定期刷新的只读快照，以及在快照上执行查询的连接池"""
+
+    def __init__(self, db_path=None, path=None, pool_size=None, metrics=None):
+        self.db_path = db_path or config.DB_PATH
+        self.path = path or f'{self.db_path}.snapshot-{os.getpid()}'
+        self.repository = Repository(self.path, pool_size, read_only=True, metrics=metrics)
+        self.metrics = self.repository.metrics
+        # (每张表的水位, 刷新时间)；第一次刷新之前为 None，所有查询都走主库
+        self._state = None
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """重新生成快照，返回各表的水位"""
+        with self._refresh_lock:
+            start = time.perf_counter()
+            try:
+                watermarks = self._copy()
+            except (sqlite3.Error, OSError):
+                self.metrics.observe('snapshot_refresh', time.perf_counter() - start, error=True)
+                raise
+            # 先让连接池切换到新文件，再公布新水位
+            self.repository.pool.reset()
+            self._state = (watermarks, time.monotonic())
+            self.metrics.observe('snapshot_refresh', time.perf_counter() - start)
+            return watermarks
+
+    def _copy(self):
+        tmp_path = f'{self.path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target)
+            # 快照只读，不需要 WAL 文件
+            target.execute('PRAGMA journal_mode = DELETE')
+            watermarks = {table: target.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                          for table in _TABLES}
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp_path, self.path)
+        return watermarks
+
+    def covers(self, table, before_id):
+        """快照是否包含 table 中 id < before_id 的全部行"""
+        state = self._state
+        return state is not None and before_id is not None and int(before_id) - 1 <= state[0][table]
+
+    def age(self):
+        """距上次刷新的秒数；还没有快照时为 0"""
+        state = self._state
+        return time.monotonic() - state[1] if state is not None else 0.0
+
+    def run(self, name, fn, *args):
+        return self.repository.run(f'snapshot_{name}', fn, *args)
+
+    async def arun(self, name, fn, *args):
+        return await self.repository.arun(f'snapshot_{name}', fn, *args)
+
+    def close(self):
+        self.repository.close()
+        for path in (self.path, f'{self.path}.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def create_snapshot(metrics=None):
+    """按配置创建快照；READ_SNAPSHOT_INTERVAL_S 为 0 时不使用快照，返回 None"""
+    if config.READ_SNAPSHOT_INTERVAL_S <= 0:
+        return None
+    return Snapshot(metrics=metrics)
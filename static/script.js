@@ -1,20 +1,45 @@
 document.addEventListener('DOMContentLoaded', () => {
-    const socket = io();
+    // 批量负载（历史、补齐、离线私信、搜索结果）请服务端用列式编码
+    const socket = io({ auth: { batch_encoding: 'columnar' } });
     let username = '';
 
     const state = {
+        room: null,
+        // 与 #messages 中的 <li> 一一对应、顺序相同；messageIds、lastId、lastSeq 随之增量维护
         messages: [],
-        users: [],
+        messageIds: new Set(),
+        lastId: 0,
+        lastSeq: 0,
+        users: new Set(),
+        presenceVersion: 0,
         typingUsers: new Set(),
+        typingByNode: new Map(),
+        // 离线期间收到的私信，按发送者分组，打开与对方的私聊时展示
+        unreadPrivate: new Map(),
+        historyCursor: null,
+        loadingHistory: false,
+        // 当前聊天室第一页历史加载完成时 resolve；补齐要从这一页最新的消息之后开始
+        historyLoaded: Promise.resolve(),
+        // 当前搜索：结果按 id 倒序分页，cursor 为下一页的游标
+        search: { q: '', scope: 'room', cursor: null },
     };
 
     const ui = {
         sidebar: document.getElementById('sidebar'),
         chatArea: document.getElementById('chat-area'),
+        messagesContainer: document.getElementById('messages-container'),
         messages: document.getElementById('messages'),
         userList: document.getElementById('user-list'),
         typingIndicator: document.getElementById('typing-indicator'),
-        form: document.querySelector('form'),
+        form: document.getElementById('chat-form'),
+        roomName: document.getElementById('room-name'),
+        roomForm: document.getElementById('room-form'),
+        roomInput: document.getElementById('room-input'),
+        searchForm: document.getElementById('search-form'),
+        searchInput: document.getElementById('search-input'),
+        searchPrivate: document.getElementById('search-private'),
+        searchResults: document.getElementById('search-results'),
+        searchMore: document.getElementById('search-more'),
         input: document.getElementById('m'),
         sidebarToggle: document.getElementById('sidebar-toggle'),
         usernameModal: document.getElementById('username-modal'),
@@ -37,9 +62,24 @@ document.addEventListener('DOMContentLoaded', () => {
         privateMessageInput: document.getElementById('private-m'),
     };
 
+    // 列式编码的批量负载：payload[key] 为 { fields, columns }，还原成对象数组
+    function decodeBatch(payload, key) {
+        if (payload.encoding !== 'columnar') return payload;
+        const { fields, columns } = payload[key];
+        const length = columns.length ? columns[0].length : 0;
+        const rows = [];
+        for (let i = 0; i < length; i++) {
+            const row = {};
+            fields.forEach((field, j) => { row[field] = columns[j][i]; });
+            rows.push(row);
+        }
+        return { ...payload, [key]: rows };
+    }
+
     function createPrivateMessageElement(data) {
         const liWrapper = document.createElement('li');
         liWrapper.classList.add('private-message-wrapper');
+        if (data.id) liWrapper.dataset.id = data.id;
 
         const messageBubble = document.createElement('div');
         messageBubble.classList.add('private-message');
@@ -73,17 +113,9 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     const renderer = {
-        renderMessages() {
-            ui.messages.innerHTML = '';
-            state.messages.forEach(msg => {
-                const item = this.createMessageElement(msg);
-                ui.messages.appendChild(item);
-            });
-            ui.messages.scrollTop = ui.messages.scrollHeight;
-        },
-
         createMessageElement(data) {
             const item = document.createElement('li');
+            if (data.id) item.dataset.id = data.id;
             if (data.username === username) item.classList.add('self');
             if (data.type === 'user-joined') {
                 item.classList.add('user-joined');
@@ -115,6 +147,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 const statusIndicator = document.createElement('span');
                 statusIndicator.className = 'online-indicator';
                 item.append(statusIndicator, user);
+                const unread = state.unreadPrivate.get(user);
+                if (unread) {
+                    const unreadBadge = document.createElement('span');
+                    unreadBadge.className = 'unread-badge';
+                    unreadBadge.textContent = unread.length;
+                    item.appendChild(unreadBadge);
+                }
                 item.addEventListener('click', () => {
                     ui.customConfirmText.textContent = `Do you want to start a private chat with ${user}?`;
                     ui.customConfirmModal.style.display = 'flex'; // FIX: Use flex to center
@@ -151,6 +190,228 @@ document.addEventListener('DOMContentLoaded', () => {
         },
     };
 
+    // --- Messages ---
+    // 新消息只插入一个元素，不重新渲染整个列表。停在底部时最多保留 MAX_RENDERED_MESSAGES 条，
+    // 更早的从顶部裁掉，向上滚动时再按游标加载，单条消息的开销与聊天记录的长度无关
+    const MAX_RENDERED_MESSAGES = 500;
+    const messageList = {
+        reset() {
+            state.messages = [];
+            state.messageIds.clear();
+            state.lastId = 0;
+            state.lastSeq = 0;
+            ui.messages.replaceChildren();
+        },
+
+        track(msg) {
+            if (msg.id) {
+                state.messageIds.add(msg.id);
+                if (msg.id > state.lastId) state.lastId = msg.id;
+            }
+            if (msg.seq > state.lastSeq) state.lastSeq = msg.seq;
+        },
+
+        isAtBottom() {
+            const container = ui.messagesContainer;
+            return container.scrollHeight - container.scrollTop - container.clientHeight < 40;
+        },
+
+        scrollToBottom() {
+            ui.messagesContainer.scrollTop = ui.messagesContainer.scrollHeight;
+        },
+
+        // 按 id 插入，已有的 id 跳过；实时消息通常是最新的一条，直接追加
+        add(messages) {
+            const atBottom = this.isAtBottom();
+            messages.forEach(msg => {
+                if (msg.id && state.messageIds.has(msg.id)) return;
+                const entry = { type: 'chat', ...msg };
+                const index = entry.id && entry.id < state.lastId
+                    ? state.messages.findIndex(other => other.id > entry.id)
+                    : -1;
+                const item = renderer.createMessageElement(entry);
+                if (index === -1) {
+                    state.messages.push(entry);
+                    ui.messages.appendChild(item);
+                } else {
+                    state.messages.splice(index, 0, entry);
+                    ui.messages.insertBefore(item, ui.messages.children[index]);
+                }
+                this.track(entry);
+            });
+            if (atBottom) {
+                this.trim();
+                this.scrollToBottom();
+            }
+        },
+
+        // 更早的一页插到顶部，保持用户当前看到的位置不跳动
+        prepend(messages) {
+            const entries = messages
+                .filter(msg => !state.messageIds.has(msg.id))
+                .map(msg => ({ type: 'chat', ...msg }));
+            const previousHeight = ui.messagesContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            entries.forEach(entry => {
+                fragment.appendChild(renderer.createMessageElement(entry));
+                this.track(entry);
+            });
+            ui.messages.insertBefore(fragment, ui.messages.firstChild);
+            state.messages = entries.concat(state.messages);
+            ui.messagesContainer.scrollTop += ui.messagesContainer.scrollHeight - previousHeight;
+        },
+
+        trim() {
+            const excess = state.messages.length - MAX_RENDERED_MESSAGES;
+            if (excess <= 0) return;
+            state.messages.splice(0, excess).forEach(msg => {
+                ui.messages.firstElementChild.remove();
+                if (msg.id) state.messageIds.delete(msg.id);
+            });
+            // 裁掉的消息在向上滚动时重新加载
+            const oldest = state.messages.find(msg => msg.id);
+            if (oldest) state.historyCursor = oldest.id;
+        },
+    };
+
+    // --- History ---
+    const historyLoader = {
+        async loadOlder() {
+            if (!state.historyCursor || state.loadingHistory) return;
+            state.loadingHistory = true;
+            try {
+                const params = new URLSearchParams({
+                    room: state.room, before: state.historyCursor, encoding: 'columnar',
+                });
+                const response = await fetch(`/history?${params}`);
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const page = decodeBatch(await response.json(), 'messages');
+                messageList.prepend(page.messages);
+                state.historyCursor = page.next_cursor;
+            } catch (err) {
+                console.error('Failed to load history:', err);
+            } finally {
+                state.loadingHistory = false;
+            }
+        },
+    };
+
+    // --- Rooms ---
+    const roomController = {
+        // 切换聊天室：离开当前房间、加入新房间，服务端确认后再加载新房间的历史
+        switchTo(room) {
+            room = room.trim().toLowerCase();
+            if (!room || room === state.room) return;
+            if (!username) {
+                // 还没登录时直接打开新聊天室的页面
+                window.location.search = `?room=${encodeURIComponent(room)}`;
+                return;
+            }
+            stopTyping();
+            socket.emit('leave room', { room: state.room });
+            socket.emit('join room', { room });
+        },
+
+        // 页面本身不含消息，首屏和切换聊天室都从 /history 加载最近一页
+        async enter(room) {
+            state.room = room;
+            messageList.reset();
+            state.historyCursor = null;
+            state.typingByNode.clear();
+            state.typingUsers.clear();
+            ui.roomName.textContent = `# ${room}`;
+            window.history.replaceState(null, '', `/?room=${encodeURIComponent(room)}`);
+            renderer.renderTypingIndicator();
+            try {
+                const response = await fetch(`/history?${new URLSearchParams({ room, encoding: 'columnar' })}`);
+                // 地址栏里的聊天室名不合法时回到默认聊天室
+                if (response.status === 400 && room !== ui.messages.dataset.defaultRoom) {
+                    return this.enter(ui.messages.dataset.defaultRoom);
+                }
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const page = decodeBatch(await response.json(), 'messages');
+                if (state.room !== room) return;
+                // 加载期间已经收到的实时消息排在历史之后
+                messageList.prepend(page.messages);
+                state.historyCursor = page.next_cursor;
+            } catch (err) {
+                console.error('Failed to load room history:', err);
+            }
+            messageList.scrollToBottom();
+        },
+    };
+
+    ui.roomForm.addEventListener('submit', (e) => {
+        e.preventDefault();
+        roomController.switchTo(ui.roomInput.value);
+        ui.roomInput.value = '';
+    });
+
+    // --- Search ---
+    const searchController = {
+        submit() {
+            const q = ui.searchInput.value.trim();
+            const scope = ui.searchPrivate.checked ? 'private' : 'room';
+            state.search = { q, scope, cursor: null };
+            ui.searchResults.innerHTML = '';
+            ui.searchMore.style.display = 'none';
+            if (q) this.request();
+        },
+
+        request(before = null) {
+            const { q, scope } = state.search;
+            socket.emit('search', { q, scope, room: state.room, before });
+        },
+
+        // highlight 由服务端转义过 HTML，只包含 <mark> 标签
+        render(data) {
+            if (data.q !== state.search.q || data.scope !== state.search.scope) return;
+            if (data.before == null) ui.searchResults.innerHTML = '';
+            data.results.forEach(result => {
+                const item = document.createElement('li');
+                const meta = document.createElement('div');
+                meta.className = 'search-meta';
+                meta.textContent = data.scope === 'private'
+                    ? `${result.sender_username} → ${result.receiver_username} · ${result.timestamp}`
+                    : `${result.username} · ${result.timestamp}`;
+                const body = document.createElement('div');
+                body.className = 'search-snippet';
+                body.innerHTML = result.highlight;
+                item.append(meta, body);
+                ui.searchResults.appendChild(item);
+            });
+            if (data.before == null && data.results.length === 0) {
+                this.showMessage('No results');
+            }
+            state.search.cursor = data.next_cursor;
+            ui.searchMore.style.display = data.next_cursor ? '' : 'none';
+        },
+
+        showMessage(message) {
+            const item = document.createElement('li');
+            item.className = 'search-empty';
+            item.textContent = message;
+            ui.searchResults.appendChild(item);
+        },
+    };
+
+    ui.searchForm.addEventListener('submit', (e) => {
+        e.preventDefault();
+        searchController.submit();
+    });
+    ui.searchMore.addEventListener('click', () => searchController.request(state.search.cursor));
+
+    // 连接（或重连）成功后补齐从最后一条已知消息之后错过的消息
+    const catchUp = {
+        request(afterId) {
+            socket.emit('catch up', { room: state.room, after_id: afterId });
+        },
+    };
+
+    ui.messagesContainer.addEventListener('scroll', () => {
+        if (ui.messagesContainer.scrollTop < 40) historyLoader.loadOlder();
+    });
+
     const sidebarController = {
         isOpen: localStorage.getItem('sidebarOpen') !== 'false',
 
@@ -192,7 +453,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const handleUserLogin = () => {
         const enteredUsername = ui.usernameInput.value.trim();
         if (enteredUsername) {
-            socket.emit('user joined', { username: enteredUsername });
+            // 同一浏览器的其他标签页凭 token 认领同一个用户名
+            const token = localStorage.getItem(`chatToken:${enteredUsername}`);
+            socket.emit('user joined', { username: enteredUsername, token, room: state.room });
         }
     };
 
@@ -205,62 +468,172 @@ document.addEventListener('DOMContentLoaded', () => {
         ui.usernameError.textContent = '';
     });
 
+    // 已发出、还没收到应答的消息，按 client_id 记录。加入聊天室之后才发送，断线重连、
+    // 重新加入后原样重发，服务端按 client_id 去重；可以连续发送，不必等上一条的应答
+    const outbox = {
+        pending: new Map(),
+        ready: false,
+
+        send(event, payload) {
+            const clientId = window.crypto && crypto.randomUUID
+                ? crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            const entry = { event, payload: { ...payload, client_id: clientId } };
+            this.pending.set(clientId, entry);
+            if (this.ready) this.emit(entry);
+        },
+
+        emit(entry) {
+            socket.emit(entry.event, entry.payload, (ack) => {
+                if (!this.pending.delete(ack.client_id)) return;
+                // 限流另有 rate_limited 提示
+                if (ack.error && ack.error !== 'rate_limited') showNotification('消息发送失败');
+            });
+        },
+
+        flush() {
+            this.ready = true;
+            this.pending.forEach(entry => this.emit(entry));
+        },
+    };
+
     ui.form.addEventListener('submit', (e) => {
         e.preventDefault();
         if (ui.input.value) {
-            socket.emit('chat message', { username, message: ui.input.value });
-            socket.emit('stop typing', { username });
+            outbox.send('chat message', { username, message: ui.input.value, room: state.room });
+            stopTyping();
             ui.input.value = '';
         }
     });
 
+    // 输入期间最多每 TYPING_REFRESH_MS 发一次 typing（服务端按 TTL 过期），
+    // 停止输入 3 秒或清空输入框时发一次 stop typing
+    const TYPING_REFRESH_MS = 2000;
     let typingTimeout;
+    let lastTypingSent = 0;
+
+    const stopTyping = () => {
+        clearTimeout(typingTimeout);
+        if (lastTypingSent) {
+            socket.emit('stop typing', { username, room: state.room });
+            lastTypingSent = 0;
+        }
+    };
+
     ui.input.addEventListener('input', () => {
         clearTimeout(typingTimeout);
         if (ui.input.value) {
-            socket.emit('typing', { username });
-            typingTimeout = setTimeout(() => {
-                socket.emit('stop typing', { username });
-            }, 3000);
+            const now = Date.now();
+            if (now - lastTypingSent >= TYPING_REFRESH_MS) {
+                socket.emit('typing', { username, room: state.room });
+                lastTypingSent = now;
+            }
+            typingTimeout = setTimeout(stopTyping, 3000);
         } else {
-            socket.emit('stop typing', { username });
+            stopTyping();
         }
     });
 
     // --- Socket.IO Event Listeners ---
-    socket.on('connect', () => console.log('Connected to server'));
+    socket.on('connect', () => {
+        console.log('Connected to server');
+        // 断线重连后凭 token 恢复会话，服务端在同一次往返中补发错过的消息
+        if (username) {
+            const token = localStorage.getItem(`chatToken:${username}`);
+            socket.emit('resume', { username, token, room: state.room, last_id: state.lastId });
+        }
+    });
     socket.on('connect_error', (err) => console.error('Connection error:', err));
 
     socket.on('join successful', (data) => {
         username = data.username;
+        localStorage.setItem(`chatToken:${username}`, data.token);
         ui.usernameModal.style.display = 'none';
         ui.input.focus();
+        if (!data.resumed) {
+            // 等第一页历史加载完再补齐，否则 lastId 还是 0，会从头翻完整个聊天记录；
+            // 历史为空时没有需要补齐的消息
+            const room = state.room;
+            state.historyLoaded.then(() => {
+                if (state.room === room && state.lastId) catchUp.request(state.lastId);
+            });
+        }
+        outbox.flush();
+    });
+    socket.on('disconnect', () => { outbox.ready = false; });
+
+    // 服务端即将重启：主动断开，在给定的时间窗口内随机延迟后重连，避免所有客户端同时涌入
+    socket.on('server_shutdown', (data) => {
+        const delay = Math.random() * data.reconnect_window_ms;
+        socket.disconnect();
+        showNotification('服务器正在重启，稍后自动重连');
+        setTimeout(() => socket.connect(), delay);
+    });
+
+    socket.on('missed_messages', (payload) => {
+        const data = decodeBatch(payload, 'messages');
+        if (data.room !== state.room) return;
+        messageList.add(data.messages);
+        if (data.has_more) catchUp.request(data.messages[data.messages.length - 1].id);
     });
 
-    socket.on('user joined', (data) => {
-        state.messages.push({ type: 'user-joined', message: `${data.username} has joined.` });
-        renderer.renderMessages();
+    socket.on('room joined', (data) => { state.historyLoaded = roomController.enter(data.room); });
+    socket.on('room error', (data) => showNotification(data.message));
+    socket.on('search results', (data) => searchController.render(decodeBatch(data, 'results')));
+    socket.on('search error', (data) => {
+        if (data.q !== state.search.q) return;
+        ui.searchResults.innerHTML = '';
+        searchController.showMessage(data.message);
+    });
+
+    // 发送太快被服务端限流：被拒绝的消息不会送达，提示用户稍后再发；输入状态不用提示
+    socket.on('rate_limited', (data) => {
+        if (data.event === 'typing') return;
+        showNotification(`发送太频繁，请 ${Math.ceil(data.retry_after)} 秒后再试`);
     });
 
     socket.on('chat message', (data) => {
-        state.messages.push({ type: 'chat', ...data });
+        // 切换聊天室途中可能还会收到旧聊天室的消息
+        if (data.room !== state.room) return;
+        const { lastSeq, lastId } = state;
+        messageList.add([data]);
+        // 序号不连续说明中间有消息没收到，从已知的最后一条之后补齐
+        if (lastSeq && data.seq > lastSeq + 1) catchUp.request(lastId);
         state.typingUsers.delete(data.username);
-        renderer.renderMessages();
         renderer.renderTypingIndicator();
     });
 
-    socket.on('user list', (data) => {
-        state.users = data.users;
+    // 在线列表：连接时拿全量快照，之后按版本号应用增量，版本不连续时重新同步
+    socket.on('presence_snapshot', (data) => {
+        state.users = new Set(data.users);
+        state.presenceVersion = data.version;
         renderer.renderUserList();
     });
 
-    socket.on('typing', (data) => {
-        state.typingUsers.add(data.username);
-        renderer.renderTypingIndicator();
+    socket.on('presence_delta', (delta) => {
+        if (delta.version <= state.presenceVersion) return;
+        if (delta.version !== state.presenceVersion + 1) {
+            socket.emit('presence_sync');
+            return;
+        }
+        // 加入提示来自增量：只提示列表里原来没有的用户，重启后恢复的会话、
+        // 同一合并窗口内断开又重连的用户都不会重复提示
+        const joined = delta.added.filter(user => user !== username && !state.users.has(user));
+        delta.added.forEach(user => state.users.add(user));
+        delta.removed.forEach(user => state.users.delete(user));
+        state.presenceVersion = delta.version;
+        renderer.renderUserList();
+        if (joined.length) {
+            messageList.add(joined.map(user => ({ type: 'user-joined', message: `${user} has joined.` })));
+        }
     });
 
-    socket.on('stop typing', (data) => {
-        state.typingUsers.delete(data.username);
+    // 服务端周期性汇总的输入状态，收到的是某个服务进程上完整的输入者列表，
+    // 多进程部署时按 node 合并
+    socket.on('typing_state', (data) => {
+        if (data.room !== state.room) return;
+        state.typingByNode.set(data.node, data.users);
+        state.typingUsers = new Set(Array.from(state.typingByNode.values()).flat());
         renderer.renderTypingIndicator();
     });
 
@@ -295,10 +668,71 @@ document.addEventListener('DOMContentLoaded', () => {
         ui.rejectPrivateChat.addEventListener('click', rejectHandler);
     });
 
+    // --- Private history ---
+    // 打开私聊时加载与对方最近的私聊记录，向上滚动时按 id 游标加载更早的
+    const PRIVATE_HISTORY_TIMEOUT_MS = 10000;
+    const privateHistory = {
+        other: null,
+        cursor: null,
+        loading: false,
+
+        open(other) {
+            this.other = other;
+            this.cursor = null;
+            this.request();
+        },
+
+        // 一页记录和错误都在应答中返回；被拒绝、查询失败或超时都会结束 loading，之后还能再翻页
+        async request(before = null) {
+            const other = this.other;
+            this.loading = true;
+            try {
+                const page = await socket.timeout(PRIVATE_HISTORY_TIMEOUT_MS)
+                    .emitWithAck('private_history', { with: other, before });
+                if (page.error) throw new Error(page.error);
+                this.prepend(decodeBatch(page, 'messages'));
+            } catch (err) {
+                console.error('Failed to load private history:', err);
+            } finally {
+                if (this.other === other) this.loading = false;
+            }
+        },
+
+        // 已经显示的消息（离线私信、加载期间实时收到的）按 id 去重
+        prepend(page) {
+            if (page.with !== this.other) return;
+            this.cursor = page.next_cursor;
+            const previousHeight = ui.privateMessages.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            page.messages.forEach(msg => {
+                if (ui.privateMessages.querySelector(`[data-id="${msg.id}"]`)) return;
+                fragment.appendChild(createPrivateMessageElement(msg));
+            });
+            ui.privateMessages.insertBefore(fragment, ui.privateMessages.firstChild);
+            if (page.before == null) {
+                ui.privateMessages.scrollTop = ui.privateMessages.scrollHeight;
+            } else {
+                ui.privateMessages.scrollTop += ui.privateMessages.scrollHeight - previousHeight;
+            }
+        },
+    };
+
+    ui.privateMessages.addEventListener('scroll', () => {
+        if (ui.privateMessages.scrollTop < 40 && privateHistory.cursor && !privateHistory.loading) {
+            privateHistory.request(privateHistory.cursor);
+        }
+    });
+
+
     socket.on('private_chat_started', (data) => {
         ui.privateChatWith.textContent = data.other_user;
         ui.privateChatWindow.style.display = 'flex';
         ui.privateMessages.innerHTML = ''; // Clear previous messages
+        const unread = state.unreadPrivate.get(data.other_user) || [];
+        unread.forEach(msg => ui.privateMessages.appendChild(createPrivateMessageElement(msg)));
+        state.unreadPrivate.delete(data.other_user);
+        renderer.renderUserList();
+        privateHistory.open(data.other_user);
     });
 
     socket.on('private_chat_rejected', (data) => {
@@ -332,8 +766,24 @@ document.addEventListener('DOMContentLoaded', () => {
         showNotification(`已结束与 ${data.other_user} 的私聊`);
     });
 
+    // 离线私信分块送达：先记下来，再确认这一块，服务端收到确认后才标为已读并发下一块
+    socket.on('missed_private_messages', (payload) => {
+        const chunk = decodeBatch(payload, 'messages');
+        chunk.messages.forEach(msg => {
+            if (!state.unreadPrivate.has(msg.sender_username)) state.unreadPrivate.set(msg.sender_username, []);
+            state.unreadPrivate.get(msg.sender_username).push(msg);
+        });
+        socket.emit('missed_private_messages_ack', { ids: chunk.messages.map(msg => msg.id) });
+        if (!chunk.has_more) {
+            const senders = Array.from(state.unreadPrivate.keys());
+            if (senders.length) showNotification(`你有来自 ${senders.join(', ')} 的未读私信`);
+        }
+        renderer.renderUserList();
+    });
+
     socket.on('private_message_sent', (data) => {
         const item = createPrivateMessageElement({
+            id: data.id,
             sender_username: username, 
             message: data.message,
             timestamp: data.timestamp
@@ -342,10 +792,12 @@ document.addEventListener('DOMContentLoaded', () => {
         ui.privateMessages.scrollTop = ui.privateMessages.scrollHeight;
     });
     
+    // 收到后确认，服务端这时才把私信标为已读；没有确认的会在下次上线时作为离线私信再投递
     socket.on('private_message', (data) => {
         const item = createPrivateMessageElement(data);
         ui.privateMessages.appendChild(item);
         ui.privateMessages.scrollTop = ui.privateMessages.scrollHeight;
+        if (data.id) socket.emit('private_message_ack', { ids: [data.id] });
     });
 
     ui.closePrivateChat.addEventListener('click', () => {
@@ -359,7 +811,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (ui.privateMessageInput.value) {
             const message = ui.privateMessageInput.value;
             const recipient = ui.privateChatWith.textContent;
-            socket.emit('private_message', {
+            outbox.send('private_message', {
                 sender_username: username,
                 receiver_username: recipient,
                 message: message
@@ -371,6 +823,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Initialization ---
     sidebarController.init();
-    renderer.renderMessages();
     renderer.renderUserList();
+    const initialRoom = new URLSearchParams(window.location.search).get('room');
+    state.historyLoaded = roomController.enter((initialRoom || '').trim().toLowerCase() || ui.messages.dataset.defaultRoom);
 });
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""服务端的“正在输入”状态汇总
+
+客户端的 typing / stop typing 只更新这里的状态（带 TTL，过期自动清除），
+不再逐条转发。后台任务每隔一个周期调用 collect()，只有某个房间的
+输入者集合发生变化时才对该房间发一次 typing_state 汇总。
+"""
+import threading
+import time
+
+import config
+
+
+class TypingAggregator:
+    """按房间记录正在输入的用户及其过期时间"""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else config.TYPING_TTL_MS / 1000
+        self._lock = threading.Lock()
+        # {room: {username: expires_at}}
+        self._typing = {}
+        # {room: 上一次发出的输入者列表}
+        self._last_sent = {}
+
+    def touch(self, room, username, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._typing.setdefault(room, {})[username] = now + self.ttl
+
+    def stop(self, room, username):
+        with self._lock:
+            users = self._typing.get(room)
+            if users:
+                users.pop(username, None)
+
+    def remove_user(self, username):
+        """用户下线时从所有房间移除"""
+        with self._lock:
+            for users in self._typing.values():
+                users.pop(username, None)
+
+    def collect(self, now=None):
+        """清理过期状态，返回输入者集合有变化的房间 [(room, [username, ...]), ...]"""
+        now = time.monotonic() if now is None else now
+        changed = []
+        with self._lock:
+            for room in list(self._typing.keys() | self._last_sent.keys()):
+                users = self._typing.get(room, {})
+                for username in [u for u, expires_at in users.items() if expires_at <= now]:
+                    del users[username]
+                current = sorted(users)
+                if current != self._last_sent.get(room, []):
+                    changed.append((room, current))
+                if current:
+                    self._last_sent[room] = current
+                else:
+                    self._last_sent.pop(room, None)
+                    self._typing.pop(room, None)
+        return changed